@@ -1,11 +1,119 @@
 from ultralytics import YOLO
 import cv2
 import numpy as np
+import logging
+import math
 import os
-from typing import Dict, List, Optional, Tuple
+import threading
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from raster import (
+    BAND_ROWS,
+    BlockRaster,
+    RawRaster,
+    batch_size_for_budget,
+    ensure_raw,
+    iter_windows,
+    read_image_size,
+    resolve_memory_budget,
+    resolve_streaming,
+    write_png_bands,
+)
+import backends
+import detection_cache
+import projection
+import results
+import workers
+
+# Размер батча тайлов, отправляемых в модель за один проход
+DEFAULT_BATCH_SIZE = 8
+# Цвет заливки при доведении краевых тайлов до общего размера (как в ultralytics)
+LETTERBOX_FILL = 114
+# Способ объединения детекций с разных тайлов: "nms" или "wbf" (weighted box fusion)
+DEFAULT_MERGE_METHOD = "nms"
+MERGE_METHODS = ("nms", "wbf")
+# Предфильтр пустых тайлов: шаг прореживания, доля nodata и минимальная текстура
+DEFAULT_SKIP_STRIDE = 4
+DEFAULT_SKIP_NODATA_FRACTION = 0.95
+DEFAULT_SKIP_MIN_TEXTURE = 3.0
+# Сколько пикселей с градиентом не ниже порога достаточно, чтобы тайл не считался однотонным:
+# тонкой трещине хватает одной короткой линии
+DEFAULT_SKIP_MIN_TEXTURE_PIXELS = 8
+# Значения пикселей, которыми Metashape заполняет области без данных. Белый (255) по умолчанию
+# не nodata: пересвеченная светлая поверхность — это данные
+DEFAULT_NODATA_VALUES = "0"
+# Режим тайлинга: "exhaustive" — вся сетка, "adaptive" — грубый проход и уточнение у кандидатов
+DEFAULT_TILING_MODE = "exhaustive"
+TILING_MODES = ("exhaustive", "adaptive")
+# Адаптивный режим: во сколько раз уменьшается изображение в грубом проходе,
+# порог уверенности кандидатов и запас вокруг них в пикселях полного разрешения
+DEFAULT_COARSE_SCALE = 4
+DEFAULT_COARSE_CONF = 0.1
+DEFAULT_REFINE_MARGIN = 128
+
+logger = logging.getLogger(__name__)
 
 # Модель загружается лениво при первом использовании
 _model: Optional[YOLO] = None
+# Модель ultralytics не потокобезопасна: обработчики FastAPI работают в пуле потоков
+_model_lock = threading.Lock()
+
+
+def _resolve_batch_size(batch_size: Optional[int] = None) -> int:
+    """Размер батча из аргумента, переменной окружения YOLO_BATCH_SIZE или по умолчанию."""
+    if batch_size is None:
+        batch_size = int(os.getenv("YOLO_BATCH_SIZE", DEFAULT_BATCH_SIZE))
+    return max(1, batch_size)
+
+
+def _resolve_merge_method(method: Optional[str] = None) -> str:
+    """Способ объединения из аргумента, переменной окружения YOLO_MERGE_METHOD или по умолчанию."""
+    if method is None:
+        method = os.getenv("YOLO_MERGE_METHOD", DEFAULT_MERGE_METHOD)
+    method = method.lower()
+    if method not in MERGE_METHODS:
+        raise ValueError(
+            f"Неизвестный способ объединения детекций: {method}. "
+            f"Допустимые значения: {', '.join(MERGE_METHODS)}"
+        )
+    return method
+
+
+def _resolve_skip_thresholds() -> Tuple[float, float]:
+    """
+    Пороги предфильтра из AI_SKIP_NODATA_FRACTION и AI_SKIP_MIN_TEXTURE.
+    Нулевая доля nodata и нулевая текстура отключают соответствующую проверку.
+    """
+    nodata_fraction = float(os.getenv("AI_SKIP_NODATA_FRACTION", DEFAULT_SKIP_NODATA_FRACTION))
+    min_texture = float(os.getenv("AI_SKIP_MIN_TEXTURE", DEFAULT_SKIP_MIN_TEXTURE))
+    return nodata_fraction, min_texture
+
+
+def _resolve_nodata_values() -> Tuple[int, ...]:
+    """Значения nodata из AI_SKIP_NODATA_VALUES (через запятую, например "0,255")."""
+    raw = os.getenv("AI_SKIP_NODATA_VALUES", DEFAULT_NODATA_VALUES)
+    return tuple(int(value) for value in raw.split(",") if value.strip())
+
+
+def _resolve_tiling(tiling: Optional[str] = None) -> str:
+    """Режим тайлинга из аргумента, переменной окружения AI_TILING или по умолчанию."""
+    if tiling is None:
+        tiling = os.getenv("AI_TILING", DEFAULT_TILING_MODE)
+    tiling = tiling.lower()
+    if tiling not in TILING_MODES:
+        raise ValueError(
+            f"Неизвестный режим тайлинга: {tiling}. "
+            f"Допустимые значения: {', '.join(TILING_MODES)}"
+        )
+    return tiling
+
+
+def _resolve_adaptive_params() -> Tuple[int, float, int]:
+    """Параметры адаптивного режима из AI_COARSE_SCALE, AI_COARSE_CONF и AI_REFINE_MARGIN."""
+    scale = max(1, int(os.getenv("AI_COARSE_SCALE", DEFAULT_COARSE_SCALE)))
+    conf = float(os.getenv("AI_COARSE_CONF", DEFAULT_COARSE_CONF))
+    margin = max(0, int(os.getenv("AI_REFINE_MARGIN", DEFAULT_REFINE_MARGIN)))
+    return scale, conf, margin
 
 
 def _find_model_path() -> str:
@@ -35,14 +143,29 @@ def _find_model_path() -> str:
 
 
 def _get_model() -> YOLO:
-    """Ленивая загрузка модели YOLO."""
+    """
+    Ленивая загрузка модели YOLO (одна модель на процесс).
+    Бэкенд (PyTorch, ONNX Runtime, OpenVINO) выбирается через AI_BACKEND.
+    """
     global _model
-    if _model is None:
-        model_path = _find_model_path()
-        _model = YOLO(model_path)
+    with _model_lock:
+        if _model is None:
+            model_path = _find_model_path()
+            _model = backends.load_model(model_path)
     return _model
 
 
+def _model_cache_key() -> str:
+    """Идентификатор модели для кэша детекций: хеш весов и параметры экспорта под бэкенд."""
+    model_hash = detection_cache.model_hash(_find_model_path())
+    return f"{model_hash}:{backends.export_key(backends.resolve_backend())}"
+
+
+def _model_names(model: YOLO) -> Dict[int, str]:
+    """Словарь id класса -> имя класса."""
+    return model.names if isinstance(model.names, dict) else {int(k): v for k, v in enumerate(model.names)}
+
+
 def _compute_iou(box: np.ndarray, boxes: np.ndarray) -> np.ndarray:
     """Вычисляет IoU между боксом и массивом боксов."""
     if boxes.size == 0:
@@ -61,188 +184,973 @@ def _compute_iou(box: np.ndarray, boxes: np.ndarray) -> np.ndarray:
     return inter_area / np.maximum(union_area, 1e-6)
 
 
+def match_rate(
+    boxes: np.ndarray,
+    classes: np.ndarray,
+    other_boxes: np.ndarray,
+    other_classes: np.ndarray,
+    match_iou: float,
+) -> float:
+    """
+    Доля боксов первого набора, для которых во втором есть бокс того же класса
+    с IoU >= match_iou (полнота или точность одного набора детекций относительно
+    другого). Для пустого первого набора — 1.0.
+    """
+    if len(boxes) == 0:
+        return 1.0
+    found = 0
+    for box, cls in zip(boxes, classes):
+        candidates = other_boxes[other_classes == cls] if len(other_boxes) else other_boxes
+        if len(candidates) and _compute_iou(box, candidates).max() >= match_iou:
+            found += 1
+    return found / len(boxes)
+
+
+def _iter_image_tiles(
+    image: np.ndarray,
+    tile_size: int = 1200,
+    overlap: float = 0.165,
+) -> Iterator[Tuple[np.ndarray, int, int]]:
+    """Лениво отдаёт пересекающиеся тайлы изображения в памяти."""
+    h, w = image.shape[:2]
+    for x1, y1, x2, y2 in iter_windows(h, w, tile_size, overlap):
+        yield image[y1:y2, x1:x2], x1, y1
+
+
 def _split_image_into_tiles(
     image: np.ndarray,
     tile_size: int = 1200,
     overlap: float = 0.165,
 ) -> List[Tuple[np.ndarray, int, int]]:
     """Разбивает изображение на пересекающиеся тайлы."""
-    h, w = image.shape[:2]
-    tiles: List[Tuple[np.ndarray, int, int]] = []
-    step = max(1, int(tile_size * (1 - overlap)))
+    return list(_iter_image_tiles(image, tile_size, overlap))
 
-    for y in range(0, h, step):
-        for x in range(0, w, step):
-            x2 = min(x + tile_size, w)
-            y2 = min(y + tile_size, h)
-            tile = image[y:y2, x:x2]
 
-            if tile.shape[0] < tile_size // 4 or tile.shape[1] < tile_size // 4:
-                continue
+def _tile_skip_reason(
+    tile: np.ndarray,
+    nodata_fraction: float,
+    min_texture: float,
+    stride: int = DEFAULT_SKIP_STRIDE,
+    nodata_values: Optional[Tuple[int, ...]] = None,
+) -> Optional[str]:
+    """
+    Дешёвая проверка тайла.
+    Возвращает "nodata", если тайл почти целиком без данных, "flat", если в нём
+    нет текстуры (небо, однотонная заливка), и None, если тайл нужно обработать.
+
+    Доля nodata оценивается по прореженной копии, а текстура — в полном
+    разрешении: прореживание теряет линию в пару пикселей. Тайл однотонный,
+    если меньше DEFAULT_SKIP_MIN_TEXTURE_PIXELS пикселей имеют градиент
+    max(|dx|, |dy|) не ниже min_texture, поэтому тонкая трещина любой
+    ориентации тайл не отбрасывает.
+    """
+    if nodata_values is None:
+        nodata_values = _resolve_nodata_values()
+
+    if nodata_fraction > 0 and nodata_values:
+        sample = tile[::stride, ::stride]
+        nodata = np.zeros(sample.shape[:2], dtype=bool)
+        for value in nodata_values:
+            nodata |= (sample == value).all(axis=2)
+        if nodata.mean() >= nodata_fraction:
+            return "nodata"
+
+    if min_texture > 0:
+        gray = cv2.cvtColor(np.ascontiguousarray(tile), cv2.COLOR_BGR2GRAY)
+        grad_x = cv2.absdiff(gray[:, 1:], gray[:, :-1])[:-1]
+        grad_y = cv2.absdiff(gray[1:], gray[:-1])[:, :-1]
+        grad = cv2.max(grad_x, grad_y)
+        if grad.size == 0 or np.count_nonzero(grad >= min_texture) < DEFAULT_SKIP_MIN_TEXTURE_PIXELS:
+            return "flat"
+
+    return None
+
+
+def _filter_tiles(
+    tiles: Iterable[Tuple[np.ndarray, int, int]],
+    stats: Dict[str, int],
+) -> Iterator[Tuple[np.ndarray, int, int]]:
+    """Пропускает пустые тайлы и считает их в stats."""
+    nodata_fraction, min_texture = _resolve_skip_thresholds()
+    nodata_values = _resolve_nodata_values()
+    for tile, x, y in tiles:
+        stats["tiles_total"] += 1
+        reason = _tile_skip_reason(tile, nodata_fraction, min_texture, nodata_values=nodata_values)
+        if reason is not None:
+            stats[f"tiles_skipped_{reason}"] += 1
+            continue
+        stats["tiles_inferred"] += 1
+        yield tile, x, y
+
+
+def _letterbox_tile(tile: np.ndarray, tile_size: int) -> np.ndarray:
+    """
+    Дополняет краевой тайл справа и снизу до tile_size x tile_size,
+    чтобы все тайлы батча имели одну форму. Координаты при этом не сдвигаются.
+    """
+    h, w = tile.shape[:2]
+    if h == tile_size and w == tile_size:
+        return tile
+    return cv2.copyMakeBorder(
+        tile,
+        0,
+        tile_size - h,
+        0,
+        tile_size - w,
+        cv2.BORDER_CONSTANT,
+        value=(LETTERBOX_FILL, LETTERBOX_FILL, LETTERBOX_FILL),
+    )
+
+
+def _iter_batches(
+    tiles: Iterable[Tuple[np.ndarray, int, int]],
+    batch_size: int,
+) -> Iterator[List[Tuple[np.ndarray, int, int]]]:
+    """Группирует тайлы в батчи по batch_size штук."""
+    batch: List[Tuple[np.ndarray, int, int]] = []
+    for item in tiles:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _result_to_arrays(result) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Достаёт боксы, классы и уверенности из результата ultralytics."""
+    boxes = result.boxes.xyxy.cpu().numpy()
+    classes = result.boxes.cls.cpu().numpy().astype(int)
+    scores = result.boxes.conf.cpu().numpy()
+    return boxes, classes, scores
+
+
+def _infer_tiles(
+    model: YOLO,
+    tiles: List[np.ndarray],
+    tile_size: int,
+    conf: Optional[float] = None,
+) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    Прогоняет батч тайлов через модель.
+    conf — порог уверенности модели (None — порог ultralytics по умолчанию).
+    Возвращает детекции в координатах каждого тайла.
+    """
+    if not tiles:
+        return []
+
+    inputs = [_letterbox_tile(tile, tile_size) for tile in tiles]
+    options: Dict[str, Any] = {"verbose": False}
+    if conf is not None:
+        options["conf"] = conf
+    with _model_lock:
+        results = model(inputs, **options)
+
+    output: List[Tuple[np.ndarray, np.ndarray, np.ndarray]] = []
+    for tile, result in zip(tiles, results):
+        boxes, classes, scores = _result_to_arrays(result)
 
-            tiles.append((tile, x, y))
+        # Боксы не должны выходить в область дополнения краевого тайла
+        tile_h, tile_w = tile.shape[:2]
+        boxes[:, [0, 2]] = np.clip(boxes[:, [0, 2]], 0, tile_w)
+        boxes[:, [1, 3]] = np.clip(boxes[:, [1, 3]], 0, tile_h)
+        valid = (boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1])
+        output.append((boxes[valid], classes[valid], scores[valid]))
 
-    return tiles
+    return output
+
+
+def _infer_keyed(
+    items: Iterable[Tuple[Any, List[np.ndarray]]],
+    tile_size: int,
+    conf: Optional[float] = None,
+) -> Iterator[Tuple[Any, List[Tuple[np.ndarray, np.ndarray, np.ndarray]]]]:
+    """Инференс пар (ключ, тайлы) в процессе API или в пуле процессов (AI_WORKERS > 0)."""
+    if workers.get_pool() is not None:
+        yield from workers.map_batches(items, tile_size, conf)
+        return
+
+    model = _get_model()
+    for key, tiles in items:
+        yield key, _infer_tiles(model, tiles, tile_size, conf)
+
+
+def _infer_batches(
+    batches: Iterable[List[Tuple[np.ndarray, int, int]]],
+    tile_size: int,
+    conf: Optional[float] = None,
+) -> Iterator[Tuple[List[Tuple[int, int, int, int]], List[Tuple[np.ndarray, np.ndarray, np.ndarray]]]]:
+    """
+    Выполняет инференс батчей тайлов.
+    Для каждого батча отдаёт геометрию тайлов (x, y, w, h) и их детекции.
+    Тайлы, уже встречавшиеся с той же моделью, берутся из кэша детекций.
+    """
+    def with_keys(items: Iterable[List[Tuple[np.ndarray, int, int]]]) -> Iterator[Tuple[Any, List[np.ndarray]]]:
+        for batch in items:
+            keys = [(x, y, tile.shape[1], tile.shape[0]) for tile, x, y in batch]
+            yield keys, [tile for tile, _, _ in batch]
+
+    if not detection_cache.is_enabled():
+        yield from _infer_keyed(with_keys(batches), tile_size, conf)
+        return
+
+    model_key = _model_cache_key()
+
+    def split_cached(items: Iterator[Tuple[Any, List[np.ndarray]]]) -> Iterator[Tuple[Any, List[np.ndarray]]]:
+        for keys, tiles in items:
+            cache_keys = [
+                detection_cache.make_key("tile", detection_cache.tile_hash(tile), model_key, {"tile_size": tile_size, "conf": conf})
+                for tile in tiles
+            ]
+            cached = detection_cache.get_many(cache_keys)
+            missing = [i for i, entry in enumerate(cached) if entry is None]
+            yield (keys, cache_keys, cached, missing), [tiles[i] for i in missing]
+
+    for (keys, cache_keys, cached, missing), results in _infer_keyed(split_cached(with_keys(batches)), tile_size, conf):
+        merged = [
+            detection_cache.unpack_detections(entry)[:3] if entry is not None else None
+            for entry in cached
+        ]
+        for index, result in zip(missing, results):
+            merged[index] = result
+        detection_cache.put_many(
+            [(cache_keys[index], detection_cache.pack_detections(*result)) for index, result in zip(missing, results)]
+        )
+        yield keys, merged
+
+
+def _pairwise_iou(boxes_a: np.ndarray, boxes_b: np.ndarray) -> np.ndarray:
+    """Поэлементный IoU для двух массивов боксов одинаковой длины."""
+    x1 = np.maximum(boxes_a[:, 0], boxes_b[:, 0])
+    y1 = np.maximum(boxes_a[:, 1], boxes_b[:, 1])
+    x2 = np.minimum(boxes_a[:, 2], boxes_b[:, 2])
+    y2 = np.minimum(boxes_a[:, 3], boxes_b[:, 3])
+
+    inter_area = np.maximum(0, x2 - x1) * np.maximum(0, y2 - y1)
+    area_a = (boxes_a[:, 2] - boxes_a[:, 0]) * (boxes_a[:, 3] - boxes_a[:, 1])
+    area_b = (boxes_b[:, 2] - boxes_b[:, 0]) * (boxes_b[:, 3] - boxes_b[:, 1])
+    union_area = area_a + area_b - inter_area
+
+    return inter_area / np.maximum(union_area, 1e-6)
+
+
+def _overlap_candidates(boxes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Пространственный индекс sweep-and-prune: возвращает пары (i, j),
+    у которых пересекаются проекции на обе оси. Остальные пары имеют IoU = 0
+    и не сравниваются вовсе.
+    """
+    n = boxes.shape[0]
+    if n < 2:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty
+
+    order = np.argsort(boxes[:, 0], kind="stable")
+    sorted_x1 = boxes[order, 0]
+    # Для i-го бокса кандидаты — все последующие, чей x1 левее его x2
+    starts = np.arange(1, n + 1)
+    ends = np.searchsorted(sorted_x1, boxes[order, 2], side="left")
+    counts = np.maximum(ends - starts, 0)
+    total = int(counts.sum())
+    if total == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty
+
+    first = np.repeat(np.arange(n), counts)
+    shift = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    second = np.repeat(starts, counts) + shift
+
+    a = order[first]
+    b = order[second]
+    overlap_y = (boxes[a, 1] < boxes[b, 3]) & (boxes[b, 1] < boxes[a, 3])
+    return a[overlap_y], b[overlap_y]
+
+
+def _seam_mask(boxes: np.ndarray, tile_ids: np.ndarray, tile_rects: np.ndarray) -> np.ndarray:
+    """
+    Отмечает боксы у швов: те, что заходят на площадь чужого тайла.
+    Бокс, целиком лежащий вне чужих тайлов, не может пересечься с их детекциями.
+    Бокс лежит внутри своего тайла, поэтому проверять нужно только тайлы,
+    перекрывающиеся с ним; их находит тот же sweep-and-prune.
+    """
+    seam = np.zeros(boxes.shape[0], dtype=bool)
+    a, b = _overlap_candidates(tile_rects)
+    if a.size == 0:
+        return seam
+
+    # Соседи каждого тайла в CSR: соседство симметрично
+    tile_a = np.concatenate((a, b))
+    tile_b = np.concatenate((b, a))
+    order = np.argsort(tile_a, kind="stable")
+    tile_a, tile_b = tile_a[order], tile_b[order]
+    indptr = np.searchsorted(tile_a, np.arange(tile_rects.shape[0] + 1))
+
+    # Пары (бокс, сосед его тайла)
+    counts = indptr[tile_ids + 1] - indptr[tile_ids]
+    total = int(counts.sum())
+    if total == 0:
+        return seam
+    box_index = np.repeat(np.arange(boxes.shape[0]), counts)
+    shift = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    neighbour = tile_b[np.repeat(indptr[tile_ids], counts) + shift]
+
+    pair_boxes = boxes[box_index]
+    pair_rects = tile_rects[neighbour]
+    inter_w = np.minimum(pair_boxes[:, 2], pair_rects[:, 2]) - np.maximum(pair_boxes[:, 0], pair_rects[:, 0])
+    inter_h = np.minimum(pair_boxes[:, 3], pair_rects[:, 3]) - np.maximum(pair_boxes[:, 1], pair_rects[:, 1])
+    seam[box_index[(inter_w > 0) & (inter_h > 0)]] = True
+    return seam
+
+
+def _merge_class(
+    boxes: np.ndarray,
+    scores: np.ndarray,
+    tile_ids: np.ndarray,
+    seam: np.ndarray,
+    iou_threshold: float,
+    method: str,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Жадный NMS (или WBF) для боксов одного класса по разреженному графу перекрытий.
+    Порядок и состав результата совпадают с последовательным NMS.
+    Возвращает боксы и их уверенности (для WBF — средняя по кластеру).
+    """
+    order = np.argsort(scores)[::-1]
+    rank = np.empty_like(order)
+    rank[order] = np.arange(order.size)
+
+    a, b = _overlap_candidates(boxes)
+    # Между тайлами сравниваем только боксы, лежащие у швов
+    same_or_seam = (tile_ids[a] == tile_ids[b]) | (seam[a] & seam[b])
+    a, b = a[same_or_seam], b[same_or_seam]
+
+    # Ребро направлено от более уверенного бокса к менее уверенному,
+    # как в последовательном NMS, где текущий бокс сравнивается с оставшимися
+    swap = rank[a] > rank[b]
+    high = np.where(swap, b, a)
+    low = np.where(swap, a, b)
+    ious = _pairwise_iou(boxes[high], boxes[low])
+    suppress = ious > iou_threshold
+    high, low = high[suppress], low[suppress]
+
+    edge_order = np.argsort(high, kind="stable")
+    high, low = high[edge_order], low[edge_order]
+    indptr = np.searchsorted(high, np.arange(boxes.shape[0] + 1))
+
+    suppressed = np.zeros(boxes.shape[0], dtype=bool)
+    merged: List[np.ndarray] = []
+    merged_scores: List[float] = []
+
+    for current in order:
+        if suppressed[current]:
+            continue
+        neighbours = low[indptr[current]:indptr[current + 1]]
+
+        if method == "wbf":
+            members = np.concatenate(([current], neighbours[~suppressed[neighbours]]))
+            weights = scores[members].astype(np.float64)
+            fused = (boxes[members] * weights[:, None]).sum(axis=0) / max(weights.sum(), 1e-6)
+            merged.append(fused.astype(boxes.dtype))
+            merged_scores.append(float(scores[members].mean()))
+        else:
+            merged.append(boxes[current])
+            merged_scores.append(float(scores[current]))
+
+        suppressed[neighbours] = True
+
+    return np.array(merged), np.array(merged_scores, dtype=np.float32)
 
 
 def _merge_detections(
     detections: List[Tuple[np.ndarray, np.ndarray, np.ndarray]],
     iou_threshold: float = 0.5,
-) -> Tuple[np.ndarray, np.ndarray]:
-    """Объединяет детекции с разных тайлов с применением NMS."""
+    tile_rects: Optional[List[Tuple[int, int, int, int]]] = None,
+    method: Optional[str] = None,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Объединяет детекции с разных тайлов с применением NMS или WBF.
+    Возвращает боксы, классы и уверенности.
+    tile_rects — прямоугольники (x1, y1, x2, y2) тайлов в том же порядке, что и detections;
+    если они переданы, межтайловые сравнения выполняются только для боксов у швов.
+    """
+    method = _resolve_merge_method(method)
     if not detections:
-        return np.array([]), np.array([])
+        return np.array([]), np.array([]), np.array([])
 
     all_boxes: List[np.ndarray] = []
     all_classes: List[np.ndarray] = []
     all_scores: List[np.ndarray] = []
+    all_tile_ids: List[np.ndarray] = []
+    rects: List[Tuple[int, int, int, int]] = []
 
-    for boxes, classes, scores in detections:
+    for index, (boxes, classes, scores) in enumerate(detections):
         if boxes.size == 0:
             continue
         all_boxes.append(boxes)
         all_classes.append(classes)
         all_scores.append(scores)
+        all_tile_ids.append(np.full(len(boxes), len(rects), dtype=np.int64))
+        if tile_rects is not None:
+            rects.append(tile_rects[index])
+        else:
+            rects.append((0, 0, 0, 0))
 
     if not all_boxes:
-        return np.array([]), np.array([])
+        return np.array([]), np.array([]), np.array([])
 
     boxes = np.concatenate(all_boxes, axis=0)
     classes = np.concatenate(all_classes, axis=0)
     scores = np.concatenate(all_scores, axis=0)
+    tile_ids = np.concatenate(all_tile_ids, axis=0)
+
+    if tile_rects is not None:
+        seam = _seam_mask(boxes, tile_ids, np.asarray(rects, dtype=boxes.dtype))
+    else:
+        # Без геометрии тайлов любой бокс считается лежащим у шва
+        seam = np.ones(len(boxes), dtype=bool)
 
     final_boxes: List[np.ndarray] = []
-    final_classes: List[int] = []
+    final_classes: List[np.ndarray] = []
+    final_scores: List[np.ndarray] = []
 
     for cls in np.unique(classes):
         idxs = np.where(classes == cls)[0]
-        cls_boxes = boxes[idxs]
-        cls_scores = scores[idxs]
-        order = np.argsort(cls_scores)[::-1]
+        merged, merged_scores = _merge_class(
+            boxes[idxs],
+            scores[idxs],
+            tile_ids[idxs],
+            seam[idxs],
+            iou_threshold,
+            method,
+        )
+        final_boxes.append(merged)
+        final_classes.append(np.full(len(merged), int(cls)))
+        final_scores.append(merged_scores)
 
-        while order.size > 0:
-            current = order[0]
-            final_boxes.append(cls_boxes[current])
-            final_classes.append(int(cls))
-            if order.size == 1:
-                break
-            rest = order[1:]
-            ious = _compute_iou(cls_boxes[current], cls_boxes[rest])
-            rest = rest[ious <= iou_threshold]
-            order = rest
+    return (
+        np.concatenate(final_boxes, axis=0),
+        np.concatenate(final_classes, axis=0),
+        np.concatenate(final_scores, axis=0),
+    )
 
-    return np.array(final_boxes), np.array(final_classes)
 
+def _coarse_regions(
+    read_window: Callable[[int, int, int, int], np.ndarray],
+    height: int,
+    width: int,
+    tile_size: int,
+    overlap: float,
+    batch_size: int,
+    stats: Dict[str, int],
+) -> np.ndarray:
+    """
+    Грубый проход адаптивного режима: крупные окна уменьшаются до tile_size
+    и прогоняются через модель с пониженным порогом уверенности.
+    Возвращает области (x1, y1, x2, y2) вокруг кандидатов в полном разрешении.
+    """
+    scale, conf, margin = _resolve_adaptive_params()
+    coarse_size = tile_size * scale
+    nodata_fraction, min_texture = _resolve_skip_thresholds()
+    nodata_values = _resolve_nodata_values()
+    stats["coarse_tiles"] = 0
 
-def _run_yolo_tiled(
+    def coarse_tiles() -> Iterator[Tuple[np.ndarray, int, int]]:
+        for x1, y1, x2, y2 in iter_windows(height, width, coarse_size, overlap):
+            window = read_window(x1, y1, x2, y2)
+            stats["coarse_tiles"] += 1
+            if _tile_skip_reason(window, nodata_fraction, min_texture, DEFAULT_SKIP_STRIDE * scale, nodata_values):
+                continue
+            size = (math.ceil((x2 - x1) / scale), math.ceil((y2 - y1) / scale))
+            yield cv2.resize(window, size, interpolation=cv2.INTER_AREA), x1, y1
+
+    regions: List[np.ndarray] = []
+    for keys, results in _infer_batches(_iter_batches(coarse_tiles(), batch_size), tile_size, conf):
+        for (offset_x, offset_y, _, _), (boxes, _, _) in zip(keys, results):
+            if boxes.size == 0:
+                continue
+            region = boxes.astype(np.float64) * scale
+            region[:, [0, 2]] += offset_x
+            region[:, [1, 3]] += offset_y
+            regions.append(region)
+
+    if not regions:
+        stats["candidates"] = 0
+        return np.zeros((0, 4))
+
+    result = np.concatenate(regions, axis=0)
+    stats["candidates"] = len(result)
+    result[:, :2] -= margin
+    result[:, 2:] += margin
+    result[:, [0, 2]] = np.clip(result[:, [0, 2]], 0, width)
+    result[:, [1, 3]] = np.clip(result[:, [1, 3]], 0, height)
+    return result
+
+
+def _windows_near(
+    windows: List[Tuple[int, int, int, int]],
+    regions: np.ndarray,
+) -> List[Tuple[int, int, int, int]]:
+    """Оставляет только окна сетки, пересекающиеся хотя бы с одной областью."""
+    if not windows or regions.size == 0:
+        return []
+    grid = np.asarray(windows, dtype=np.float64)
+    hits = (
+        (grid[:, None, 0] < regions[None, :, 2])
+        & (regions[None, :, 0] < grid[:, None, 2])
+        & (grid[:, None, 1] < regions[None, :, 3])
+        & (regions[None, :, 1] < grid[:, None, 3])
+    ).any(axis=1)
+    return [window for window, hit in zip(windows, hits) if hit]
+
+
+def _open_image(
     image_path: str,
-    tile_size: int = 640,
-    overlap: float = 0.3,
-) -> Tuple[np.ndarray, Dict[int, str], np.ndarray, np.ndarray, Dict[str, List[List[int]]]]:
-    """Запускает YOLO на изображении, разбитом на тайлы."""
+    streaming: Optional[bool] = None,
+) -> Tuple[np.ndarray, Callable[[int, int, int, int], np.ndarray], bool]:
+    """
+    Открывает изображение для тайлинга: (изображение, чтение окна, потоковый ли режим).
+    В потоковом режиме изображение — memmap несжатой копии, окна читаются с диска.
+    """
+    if resolve_streaming(image_path, streaming):
+        raster = RawRaster(ensure_raw(image_path))
+        return np.load(raster.path, mmap_mode="r"), raster.read_window, True
+
     image = cv2.imread(image_path)
     if image is None:
         raise ValueError(f"Не удалось прочитать изображение: {image_path}")
 
-    model = _get_model()
-    tiles = _split_image_into_tiles(image, tile_size, overlap)
+    def read_window(x1: int, y1: int, x2: int, y2: int) -> np.ndarray:
+        return image[y1:y2, x1:x2]
+
+    return image, read_window, False
+
+
+def _detect_tiled(
+    image_path: str,
+    tile_size: int = 640,
+    overlap: float = 0.3,
+    batch_size: Optional[int] = None,
+    iou_threshold: float = 0.5,
+    merge_method: Optional[str] = None,
+    streaming: Optional[bool] = None,
+    memory_budget_mb: Optional[int] = None,
+    stats: Optional[Dict[str, int]] = None,
+    tiling: Optional[str] = None,
+    on_progress: Optional[Callable[[int, int], None]] = None,
+    source: Optional[BlockRaster] = None,
+    load_image: bool = True,
+) -> Tuple[Optional[np.ndarray], Dict[int, str], np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Запускает YOLO на изображении, разбитом на тайлы.
+    Тайлы приводятся к одной форме и отправляются в модель батчами по batch_size,
+    затем детекции объединяются способом merge_method ("nms" или "wbf").
+
+    В потоковом режиме изображение один раз конвертируется в несжатый .npy,
+    тайлы читаются с диска лениво, а размер батча ограничен бюджетом памяти.
+    Вместо изображения возвращается memmap только для чтения.
+
+    Пустые тайлы (nodata, небо) отбрасываются до инференса; счётчики тайлов
+    записываются в stats, если он передан.
+
+    В режиме tiling="adaptive" сначала выполняется грубый проход по уменьшенному
+    изображению, а тайлы полного разрешения обрабатываются только возле кандидатов.
+
+    on_progress(done, total) вызывается после каждого батча: сколько тайлов
+    полного разрешения уже прочитано из скольких.
+
+    source — ортомозаика, которая ещё экспортируется сеткой блоков (см. raster.BlockRaster):
+    тайлы читаются по мере записи блоков, как в потоковом режиме.
+
+    Результат кэшируется по хешу изображения, хешу модели и параметрам тайлинга
+    (кроме source: пока растр собирается, его содержимое нельзя хешировать).
+    Кэш проверяется до декодирования; при попадании с load_image=False
+    изображение не читается вовсе и вместо него возвращается None.
+    Возвращает изображение, имена классов, классы, боксы и уверенности.
+    """
+    if stats is None:
+        stats = {}
+    for counter in ("tiles_total", "tiles_inferred", "tiles_skipped_nodata", "tiles_skipped_flat"):
+        stats[counter] = 0
+
+    merge_method = _resolve_merge_method(merge_method)
+    tiling = _resolve_tiling(tiling)
+    batch_size = _resolve_batch_size(batch_size)
+
+    params: Dict[str, Any] = {
+        "tile_size": tile_size,
+        "overlap": overlap,
+        "iou_threshold": iou_threshold,
+        "merge_method": merge_method,
+        "skip_thresholds": _resolve_skip_thresholds(),
+        "nodata_values": _resolve_nodata_values(),
+        "tiling": tiling,
+    }
+    if tiling == "adaptive":
+        params["adaptive"] = _resolve_adaptive_params()
+
+    cache_key: Optional[str] = None
+    if detection_cache.is_enabled() and source is None:
+        cache_key = detection_cache.make_key(
+            "image",
+            detection_cache.content_hash(image_path),
+            _model_cache_key(),
+            params,
+        )
+        cached = detection_cache.get(cache_key)
+        if cached is not None:
+            stats["cached"] = 1
+            if on_progress is not None:
+                on_progress(0, 0)
+            boxes, classes, scores, names = detection_cache.unpack_detections(cached)
+            image = _open_image(image_path, streaming)[0] if load_image else None
+            return image, names or {}, classes, boxes, scores
+
+    image, read_window, windowed = (
+        (source.image, source.read_window, True) if source is not None else _open_image(image_path, streaming)
+    )
+    if windowed:
+        batch_size = batch_size_for_budget(
+            tile_size, batch_size, resolve_memory_budget(memory_budget_mb)
+        )
+
+    height, width = image.shape[:2]
+    windows: List[Tuple[int, int, int, int]] = list(iter_windows(height, width, tile_size, overlap))
+    if tiling == "adaptive":
+        regions = _coarse_regions(read_window, height, width, tile_size, overlap, batch_size, stats)
+        windows = _windows_near(windows, regions)
+
+    tiles = _filter_tiles(
+        ((read_window(x1, y1, x2, y2), x1, y1) for x1, y1, x2, y2 in windows),
+        stats,
+    )
+
     detections: List[Tuple[np.ndarray, np.ndarray, np.ndarray]] = []
-    names: Dict[int, str] = model.names if isinstance(model.names, dict) else {int(k): v for k, v in enumerate(model.names)}
+    tile_rects: List[Tuple[int, int, int, int]] = []
 
-    for tile, offset_x, offset_y in tiles:
-        results = model(tile, verbose=False)[0]
-        boxes = results.boxes.xyxy.cpu().numpy()
-        classes = results.boxes.cls.cpu().numpy().astype(int)
-        scores = results.boxes.conf.cpu().numpy()
+    for keys, results in _infer_batches(_iter_batches(tiles, batch_size), tile_size):
+        for (offset_x, offset_y, tile_w, tile_h), (boxes, classes, scores) in zip(keys, results):
+            if boxes.size == 0:
+                continue
 
-        if boxes.size == 0:
-            continue
+            boxes = boxes.copy()
+            boxes[:, [0, 2]] += offset_x
+            boxes[:, [1, 3]] += offset_y
+            detections.append((boxes, classes, scores))
+            tile_rects.append((offset_x, offset_y, offset_x + tile_w, offset_y + tile_h))
+        if on_progress is not None:
+            on_progress(stats["tiles_total"], len(windows))
+    if on_progress is not None:
+        on_progress(len(windows), len(windows))
+
+    boxes, classes, scores = _merge_detections(
+        detections,
+        iou_threshold=iou_threshold,
+        tile_rects=tile_rects,
+        method=merge_method,
+    )
+
+    names = workers.model_names() if workers.get_pool() is not None else _model_names(_get_model())
+
+    logger.info(
+        "%s: тайлов %d, обработано %d, пропущено nodata %d, без текстуры %d",
+        image_path,
+        stats["tiles_total"],
+        stats["tiles_inferred"],
+        stats["tiles_skipped_nodata"],
+        stats["tiles_skipped_flat"],
+    )
+
+    if cache_key is not None:
+        detection_cache.put(
+            cache_key, detection_cache.pack_detections(boxes, classes, scores, names)
+        )
 
-        boxes[:, [0, 2]] += offset_x
-        boxes[:, [1, 3]] += offset_y
-        detections.append((boxes, classes, scores))
+    return image, names, classes, boxes, scores
 
-    boxes, classes = _merge_detections(detections)
 
+def _group_by_class(
+    names: Dict[int, str],
+    classes: np.ndarray,
+    boxes: np.ndarray,
+) -> Dict[str, List[List[int]]]:
+    """Группирует боксы по именам классов."""
     grouped_objects: Dict[str, List[List[int]]] = {}
     for cls, box in zip(classes, boxes):
         class_name = names.get(int(cls), str(cls))
         grouped_objects.setdefault(class_name, []).append(box.astype(int).tolist())
+    return grouped_objects
 
-    return image, names, classes, boxes, grouped_objects
 
+def _run_yolo_tiled(
+    image_path: str,
+    tile_size: int = 640,
+    overlap: float = 0.3,
+    **kwargs: Any,
+) -> Tuple[np.ndarray, Dict[int, str], np.ndarray, np.ndarray, Dict[str, List[List[int]]]]:
+    """Запускает YOLO на изображении, разбитом на тайлы (см. _detect_tiled)."""
+    image, names, classes, boxes, _ = _detect_tiled(image_path, tile_size, overlap, **kwargs)
+    return image, names, classes, boxes, _group_by_class(names, classes, boxes)
 
-def process_image(image_path: str) -> str:
-    """Обрабатывает изображение и сохраняет результат рядом с исходником."""
-    image, class_names, classes, boxes, grouped_objects = _run_yolo_tiled(image_path)
 
+def _draw_detections(
+    image: np.ndarray,
+    class_names: Dict[int, str],
+    classes: np.ndarray,
+    boxes: np.ndarray,
+    thickness: int,
+    font_scale: float,
+    top: int = 0,
+) -> None:
+    """
+    Рисует боксы и подписи классов прямо на изображении. image может быть
+    полосой строк: top — номер её первой строки в полном изображении.
+    """
+    color = (4, 44, 252)
     for class_id, box in zip(classes, boxes):
         class_name = class_names.get(int(class_id), str(class_id))
-        color = (4, 44, 252)
         x1, y1, x2, y2 = box.astype(int)
-        cv2.rectangle(image, (x1, y1), (x2, y2), color, 2)
+        cv2.rectangle(image, (x1, y1 - top), (x2, y2 - top), color, thickness)
         cv2.putText(
             image,
             class_name,
-            (x1, max(0, y1 - 10)),
+            (x1, max(0, y1 - 10) - top),
             cv2.FONT_HERSHEY_SIMPLEX,
-            0.6,
+            font_scale,
             color,
             2,
         )
 
+
+def _annotated_bands(
+    source: RawRaster,
+    class_names: Dict[int, str],
+    classes: np.ndarray,
+    boxes: np.ndarray,
+    thickness: int,
+    font_scale: float,
+) -> Iterator[np.ndarray]:
+    """Полосы строк растра с нарисованными детекциями, сверху вниз."""
+    # Подпись рисуется над боксом: полосе нужны и боксы, которые начинаются ниже неё
+    label_height = 0
+    for name in class_names.values():
+        (_, text_height), baseline = cv2.getTextSize(name, cv2.FONT_HERSHEY_SIMPLEX, font_scale, 2)
+        label_height = max(label_height, text_height + baseline)
+    above = 10 + label_height + 2 * thickness
+    below = 2 * thickness
+    boxes = np.asarray(boxes).reshape(-1, 4)
+    for y in range(0, source.height, BAND_ROWS):
+        y2 = min(y + BAND_ROWS, source.height)
+        band = source.read_window(0, y, source.width, y2)
+        near = (boxes[:, 1] - above < y2) & (boxes[:, 3] + below >= y)
+        _draw_detections(band, class_names, classes[near], boxes[near], thickness, font_scale, top=y)
+        yield band
+
+
+def _write_annotated(
+    image: np.ndarray,
+    output_path: str,
+    class_names: Dict[int, str],
+    classes: np.ndarray,
+    boxes: np.ndarray,
+    thickness: int,
+    font_scale: float,
+) -> None:
+    """
+    Сохраняет изображение с нарисованными детекциями.
+    memmap из потокового режима не загружается в память: PNG рисуется и
+    сжимается полосами строк (raster.write_png_bands). Другие форматы так
+    не пишутся — для них рисуем на копии растра на диске.
+    """
+    if not isinstance(image, np.memmap):
+        _draw_detections(image, class_names, classes, boxes, thickness, font_scale)
+        cv2.imwrite(output_path, image)
+        return
+
+    source = RawRaster(image.filename)
+    if output_path.lower().endswith(".png"):
+        write_png_bands(
+            output_path,
+            source.width,
+            source.height,
+            _annotated_bands(source, class_names, classes, boxes, thickness, font_scale),
+        )
+        return
+
+    canvas_path = output_path + ".draw.npy"
+    canvas = source.copy_to(canvas_path)
+    try:
+        _draw_detections(canvas, class_names, classes, boxes, thickness, font_scale)
+        cv2.imwrite(output_path, canvas)
+    finally:
+        del canvas
+        os.remove(canvas_path)
+
+
+def _image_size(image: np.ndarray) -> Tuple[int, int]:
+    height, width = image.shape[:2]
+    return width, height
+
+
+def _save_results(
+    store_dir: str,
+    image_path: str,
+    image_size: Tuple[int, int],
+    names: Dict[int, str],
+    classes: np.ndarray,
+    boxes: np.ndarray,
+    scores: np.ndarray,
+    stats: Optional[Dict[str, int]],
+) -> None:
+    """Сохраняет детекции в структурированное хранилище (см. results.py); image_size — (ширина, высота)."""
+    results.save(store_dir, boxes, classes, scores, names, image_path, image_size, stats)
+
+
+def process_image(image_path: str) -> str:
+    """Обрабатывает изображение и сохраняет результат рядом с исходником."""
+    stats: Dict[str, int] = {}
+    image, class_names, classes, boxes, scores = _detect_tiled(image_path, stats=stats)
+
     root, ext = os.path.splitext(image_path)
     new_image_path = root + "_yolo" + ext
-    cv2.imwrite(new_image_path, image)
+    _write_annotated(image, new_image_path, class_names, classes, boxes, 2, 0.6)
 
-    text_file_path = root + "_data.txt"
-    with open(text_file_path, "w", encoding="utf-8") as f:
-        for class_name, details in grouped_objects.items():
-            f.write(f"{class_name}:\n")
-            for detail in details:
-                f.write(
-                    f"Coordinates: ({detail[0]}, {detail[1]}, {detail[2]}, {detail[3]})\n"
-                )
+    _save_results(results.store_path(new_image_path), image_path, _image_size(image), class_names, classes, boxes, scores, stats)
 
     return new_image_path
 
 
-def process_ai_image(input_path: str, output_path: str) -> str:
-    """Вариант для бекенда: сохраняет результат в точный путь."""
-    image, class_names, classes, boxes, grouped_objects = _run_yolo_tiled(input_path)
+def process_ai_image(
+    input_path: str,
+    output_path: str,
+    stats: Optional[Dict[str, int]] = None,
+    on_progress: Optional[Callable[[int, int], None]] = None,
+) -> str:
+    """
+    Вариант для бекенда: сохраняет результат в точный путь.
+    Детекции с уверенностями сохраняются рядом в папку <имя>_detections.
+    Если передан stats, в него записываются счётчики обработанных и пропущенных тайлов;
+    on_progress получает число прочитанных тайлов и их общее число.
+    """
+    if stats is None:
+        stats = {}
+    image, class_names, classes, boxes, scores = _detect_tiled(input_path, stats=stats, on_progress=on_progress)
 
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
 
-    for class_id, box in zip(classes, boxes):
-        class_name = class_names.get(int(class_id), str(class_id))
-        color = (4, 44, 252)
-        x1, y1, x2, y2 = box.astype(int)
-        cv2.rectangle(image, (x1, y1), (x2, y2), color, 4)
-        cv2.putText(
-            image,
-            class_name,
-            (x1, max(0, y1 - 10)),
-            cv2.FONT_HERSHEY_SIMPLEX,
-            0.8,
-            color,
-            2,
-        )
+    _write_annotated(image, output_path, class_names, classes, boxes, 4, 0.8)
+
+    _save_results(results.store_path(output_path), input_path, _image_size(image), class_names, classes, boxes, scores, stats)
 
-    cv2.imwrite(output_path, image)
+    return output_path
+
+
+def detect_ai_image(
+    input_path: str,
+    output_path: str,
+    stats: Optional[Dict[str, int]] = None,
+    on_progress: Optional[Callable[[int, int], None]] = None,
+    source: Optional[BlockRaster] = None,
+) -> str:
+    """
+    Только детекция, без отрисовки и перекодирования изображения: оверлеи рисует клиент.
+    Детекции сохраняются туда же, куда их сохранил бы process_ai_image для output_path.
+    source — растр input_path, который ещё собирается из блоков экспорта.
+    Возвращает путь к папке с детекциями.
+    """
+    if stats is None:
+        stats = {}
+    image, class_names, classes, boxes, scores = _detect_tiled(
+        input_path, stats=stats, on_progress=on_progress, source=source, load_image=False
+    )
+    # При попадании в кэш изображение не декодировалось — размер берём из заголовка
+    image_size = _image_size(image) if image is not None else read_image_size(input_path)
+    if image_size is None:
+        raise ValueError(f"Не удалось прочитать размер изображения: {input_path}")
+
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
 
-    root, _ = os.path.splitext(output_path)
-    text_file_path = root + "_data.txt"
-    with open(text_file_path, "w", encoding="utf-8") as f:
-        for class_name, details in grouped_objects.items():
-            f.write(f"{class_name}:\n")
-            for detail in details:
-                f.write(
-                    f"Coordinates: ({detail[0]}, {detail[1]}, {detail[2]}, {detail[3]})\n"
-                )
+    store_dir = results.store_path(output_path)
+    _save_results(store_dir, input_path, image_size, class_names, classes, boxes, scores, stats)
 
+    return store_dir
+
+
+def render_ai_image(input_path: str, output_path: str) -> str:
+    """
+    Рисует детекции, уже сохранённые для output_path (см. detect_ai_image),
+    без повторного инференса. Если детекций нет, сохраняет изображение как есть.
+    """
+    store_dir = results.store_path(output_path)
+    names: Dict[int, str] = {}
+    classes = np.zeros(0, dtype=np.int32)
+    boxes = np.zeros((0, 4), dtype=np.float32)
+    if os.path.isdir(store_dir):
+        boxes, classes, _, meta = results.query(store_dir)
+        names = {int(k): v for k, v in meta["names"].items()}
+
+    if input_path.lower().endswith(".npy"):
+        image = np.load(input_path, mmap_mode="r")
+    else:
+        image = cv2.imread(input_path)
+        if image is None:
+            raise ValueError(f"Не удалось прочитать изображение: {input_path}")
+
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    _write_annotated(image, output_path, names, classes, boxes, 4, 0.8)
     return output_path
 
 
+def project_photo_detections(
+    stores: List[str],
+    cameras_path: str,
+    image_path: str,
+    output_path: str,
+    image_size: Tuple[int, int],
+    iou_threshold: float = 0.5,
+) -> Optional[str]:
+    """
+    Переносит детекции отдельных снимков (папки stores, см. detect_ai_image)
+    на ортомозаику по выравниванию камер (см. projection.py) и сохраняет их
+    как детекции ортомозаики для output_path. Дубликаты с перекрывающихся
+    снимков объединяются так же, как детекции тайлов: сравниваются только
+    боксы в зоне перекрытия снимков.
+    Возвращает папку детекций или None, если ни один снимок не выровнен.
+    """
+    homographies = projection.load(cameras_path)
+    width, height = image_size
+
+    detections: List[Tuple[np.ndarray, np.ndarray, np.ndarray]] = []
+    footprints: List[Tuple[int, int, int, int]] = []
+    names: Dict[int, str] = {}
+    for store_dir in stores:
+        boxes, classes, scores, meta = results.query(store_dir)
+        matrix = homographies.get(meta["image"]["path"])
+        if matrix is None:
+            continue
+        names.update({int(k): v for k, v in meta["names"].items()})
+
+        boxes = projection.project_boxes(boxes, matrix)
+        boxes[:, [0, 2]] = np.clip(boxes[:, [0, 2]], 0, width)
+        boxes[:, [1, 3]] = np.clip(boxes[:, [1, 3]], 0, height)
+        # Боксы за краем ортомозаики после обрезки вырождаются
+        inside = (boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1])
+        detections.append((boxes[inside], classes[inside], scores[inside]))
+        footprints.append(tuple(projection.footprint(meta["image"]["width"], meta["image"]["height"], matrix)))
+
+    if not detections:
+        return None
+
+    boxes, classes, scores = _merge_detections(
+        detections,
+        iou_threshold=iou_threshold,
+        tile_rects=footprints,
+    )
+    stats = {"photos_total": len(stores), "photos_projected": len(detections)}
+    return results.save(
+        results.store_path(output_path), boxes, classes, scores, names, image_path, image_size, stats
+    )
+
+
 def _run_yolo(image_path: str) -> tuple:
     """Обратная совместимость с предыдущим API."""
     return _run_yolo_tiled(image_path)
\ No newline at end of file
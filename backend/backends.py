@@ -0,0 +1,136 @@
+import hashlib
+import os
+import shutil
+import uuid
+from typing import Optional
+
+from ultralytics import YOLO
+
+import detection_cache
+
+# Бэкенд инференса: "torch" — исходные веса best.pt, остальные — экспортированные модели
+DEFAULT_BACKEND = "torch"
+BACKENDS = ("torch", "onnx", "onnx-int8", "openvino", "openvino-int8")
+# Размер входа экспортируемой модели (совпадает с размером тайла по умолчанию)
+DEFAULT_EXPORT_IMGSZ = 640
+DEFAULT_EXPORT_DIR = os.path.join("tmp", "exports")
+
+
+def resolve_backend(backend: Optional[str] = None) -> str:
+    """Бэкенд из аргумента, переменной окружения AI_BACKEND или по умолчанию."""
+    if backend is None:
+        backend = os.getenv("AI_BACKEND", DEFAULT_BACKEND)
+    backend = backend.lower()
+    if backend not in BACKENDS:
+        raise ValueError(
+            f"Неизвестный бэкенд инференса: {backend}. "
+            f"Допустимые значения: {', '.join(BACKENDS)}"
+        )
+    return backend
+
+
+def _export_imgsz() -> int:
+    return int(os.getenv("AI_EXPORT_IMGSZ", DEFAULT_EXPORT_IMGSZ))
+
+
+def _calibration_key() -> str:
+    """
+    Набор калибровки INT8 (AI_INT8_DATA): хеш пути и содержимого YAML,
+    для имени встроенного набора ultralytics — хеш имени.
+    """
+    data = os.getenv("AI_INT8_DATA")
+    if not data:
+        return "default"
+    digest = hashlib.sha256(os.path.abspath(data).encode("utf-8"))
+    if os.path.isfile(data):
+        digest.update(detection_cache.file_hash(data).encode("ascii"))
+    return digest.hexdigest()[:12]
+
+
+def export_key(backend: str) -> str:
+    """
+    Параметры экспорта, от которых зависят веса модели и её ответы: бэкенд,
+    размер входа и для INT8 OpenVINO набор калибровки. Для torch — только бэкенд.
+    """
+    if backend == "torch":
+        return backend
+    parts = [backend, str(_export_imgsz())]
+    if backend == "openvino-int8":
+        parts.append(_calibration_key())
+    return "_".join(parts)
+
+
+def _export_dir(model_path: str, backend: str) -> str:
+    """Папка экспорта: по хешу исходных весов и параметрам экспорта (см. export_key)."""
+    root = os.getenv("AI_EXPORT_DIR", DEFAULT_EXPORT_DIR)
+    digest = detection_cache.model_hash(model_path)[:16]
+    return os.path.join(root, f"{digest}_{export_key(backend)}")
+
+
+def _export(model_path: str, backend: str, target_dir: str) -> str:
+    """
+    Экспортирует веса в target_dir и возвращает имя артефакта внутри неё.
+    ultralytics кладёт результат рядом с весами, поэтому веса сначала копируются.
+    """
+    weights = os.path.join(target_dir, "best.pt")
+    shutil.copy2(model_path, weights)
+    model = YOLO(weights)
+    imgsz = _export_imgsz()
+
+    if backend in ("onnx", "onnx-int8"):
+        exported = model.export(format="onnx", imgsz=imgsz, dynamic=True)
+        if backend == "onnx":
+            return os.path.basename(exported)
+
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        quantized = os.path.join(target_dir, "best_int8.onnx")
+        quantize_dynamic(exported, quantized, weight_type=QuantType.QUInt8)
+        return os.path.basename(quantized)
+
+    # Для INT8 OpenVINO калибруется на наборе из AI_INT8_DATA (yaml датасета ultralytics)
+    options = {"format": "openvino", "imgsz": imgsz, "dynamic": True}
+    if backend == "openvino-int8":
+        options["int8"] = True
+        data = os.getenv("AI_INT8_DATA")
+        if data:
+            options["data"] = data
+    exported = model.export(**options)
+    return os.path.basename(os.path.normpath(exported))
+
+
+def model_file_for_backend(model_path: str, backend: str) -> str:
+    """
+    Путь к модели для бэкенда. Экспорт выполняется один раз и кэшируется на диске;
+    параллельные процессы экспортируют во временные папки, побеждает первый.
+    """
+    if backend == "torch":
+        return model_path
+
+    target_dir = _export_dir(model_path, backend)
+    marker = os.path.join(target_dir, "artifact.txt")
+    if not os.path.isfile(marker):
+        staging = f"{target_dir}.{uuid.uuid4().hex}.part"
+        os.makedirs(staging)
+        try:
+            artifact = _export(model_path, backend, staging)
+            with open(os.path.join(staging, "artifact.txt"), "w", encoding="utf-8") as f:
+                f.write(artifact)
+            try:
+                os.rename(staging, target_dir)
+            except OSError:
+                # Другой процесс успел раньше — используем его результат
+                pass
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+    with open(marker, encoding="utf-8") as f:
+        return os.path.join(target_dir, f.read().strip())
+
+
+def load_model(model_path: str, backend: Optional[str] = None) -> YOLO:
+    """Загружает модель YOLO для выбранного бэкенда."""
+    backend = resolve_backend(backend)
+    if backend == "torch":
+        return YOLO(model_path)
+    return YOLO(model_file_for_backend(model_path, backend), task="detect")
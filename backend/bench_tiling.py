@@ -0,0 +1,59 @@
+"""
+Сравнение полного и адаптивного тайлинга по скорости и полноте.
+
+Полнота считается относительно полного тайлинга: детекция полного прохода
+найдена, если в адаптивном есть бокс того же класса с IoU >= --match-iou.
+
+Пример:
+    python bench_tiling.py tmp/tmp1/metashape/orthomosaic.png --repeat 3
+"""
+import argparse
+import os
+import time
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+# Кэш детекций исказил бы замеры времени
+os.environ["AI_CACHE"] = "0"
+
+import ai  # noqa: E402
+
+
+def _run(image_path: str, tiling: str, repeat: int) -> Tuple[float, Dict[str, int], np.ndarray, np.ndarray]:
+    timings: List[float] = []
+    stats: Dict[str, int] = {}
+    boxes = classes = np.array([])
+    for _ in range(repeat):
+        stats = {}
+        started = time.perf_counter()
+        _, _, classes, boxes, _ = ai._detect_tiled(image_path, tiling=tiling, stats=stats)
+        timings.append(time.perf_counter() - started)
+    return min(timings), stats, boxes, classes
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("images", nargs="+", help="Изображения для замера")
+    parser.add_argument("--repeat", type=int, default=1, help="Число повторов, берётся лучшее время")
+    parser.add_argument("--match-iou", type=float, default=0.5, help="Порог IoU для сопоставления боксов")
+    args = parser.parse_args()
+
+    # Прогрев: загрузка модели не должна попадать в замер
+    ai._get_model()
+
+    print(f"{'изображение':<40} {'режим':<11} {'время, с':>9} {'тайлов':>7} {'боксов':>7} {'полнота':>8}")
+    for image_path in args.images:
+        full_time, full_stats, full_boxes, full_classes = _run(image_path, "exhaustive", args.repeat)
+        fast_time, fast_stats, fast_boxes, fast_classes = _run(image_path, "adaptive", args.repeat)
+        recall = ai.match_rate(full_boxes, full_classes, fast_boxes, fast_classes, args.match_iou)
+
+        name = os.path.basename(image_path)
+        print(f"{name:<40} {'exhaustive':<11} {full_time:>9.2f} {full_stats['tiles_inferred']:>7} {len(full_boxes):>7} {1.0:>8.3f}")
+        fast_tiles = fast_stats["tiles_inferred"] + fast_stats.get("coarse_tiles", 0)
+        print(f"{name:<40} {'adaptive':<11} {fast_time:>9.2f} {fast_tiles:>7} {len(fast_boxes):>7} {recall:>8.3f}")
+        print(f"{'':<40} ускорение x{full_time / max(fast_time, 1e-9):.1f}, кандидатов {fast_stats.get('candidates', 0)}")
+
+
+if __name__ == "__main__":
+    main()
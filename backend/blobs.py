@@ -0,0 +1,190 @@
+import errno
+import os
+import shutil
+import uuid
+from typing import Any, Dict, Iterable, Iterator, Optional
+
+DEFAULT_BLOBS_DIR = os.path.join("tmp", "blobs")
+# ioctl FICLONE: reflink-копия на файловых системах с copy-on-write (btrfs, xfs)
+FICLONE = 0x40049409
+
+HARDLINK = "hardlink"
+REFLINK = "reflink"
+COPY = "copy"
+
+
+def is_enabled() -> bool:
+    """Хранилище включено, если BLOB_STORE не равен "0"."""
+    return os.getenv("BLOB_STORE", "1").lower() not in ("0", "false", "no")
+
+
+def _blobs_dir() -> str:
+    return os.getenv("BLOBS_DIR", DEFAULT_BLOBS_DIR)
+
+
+def blob_path(sha256: str) -> str:
+    """Файл хранилища: <BLOBS_DIR>/<первые два символа хеша>/<хеш>."""
+    sha256 = sha256.lower()
+    return os.path.join(_blobs_dir(), sha256[:2], sha256)
+
+
+def _tmp_path(path: str) -> str:
+    return f"{path}.{uuid.uuid4().hex}.tmp"
+
+
+def _reflink(src: str, dest: str) -> None:
+    try:
+        import fcntl
+    except ImportError as exc:
+        raise OSError(errno.EOPNOTSUPP, "reflink недоступен") from exc
+    with open(src, "rb") as source, open(dest, "wb") as target:
+        try:
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+        except OSError:
+            target.close()
+            os.remove(dest)
+            raise
+
+
+def _link(src: str, dest: str) -> str:
+    """
+    Создаёт dest с содержимым src: жёсткой ссылкой, если файлы на одной файловой
+    системе, иначе reflink-копией, иначе обычной копией. Возвращает способ.
+    """
+    try:
+        os.link(src, dest)
+        return HARDLINK
+    except FileNotFoundError:
+        raise
+    except OSError:
+        pass
+    try:
+        _reflink(src, dest)
+        return REFLINK
+    except OSError:
+        pass
+    shutil.copyfile(src, dest)
+    return COPY
+
+
+def _replace_with_link(src: str, dest: str) -> str:
+    """Атомарно подменяет dest ссылкой на src."""
+    tmp_path = _tmp_path(dest)
+    try:
+        method = _link(src, tmp_path)
+        os.replace(tmp_path, dest)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    return method
+
+
+def exists(sha256: str, size: Optional[int] = None) -> bool:
+    path = blob_path(sha256)
+    try:
+        return size is None or os.path.getsize(path) == size
+    except OSError:
+        return False
+
+
+def adopt(path: str, sha256: str) -> Dict[str, Any]:
+    """
+    Переводит только что принятый файл на хранилище. Если такое содержимое
+    уже есть, файл заменяется ссылкой на него и его копия освобождается;
+    иначе файл сам становится содержимым хранилища. Файлы сессий с этого
+    момента нельзя менять на месте — только заменять целиком.
+    """
+    blob = blob_path(sha256)
+    if exists(sha256, os.path.getsize(path)):
+        try:
+            return {"deduplicated": True, "link": _replace_with_link(blob, path)}
+        except FileNotFoundError:
+            # Содержимое только что убрал gc — кладём файл заново
+            pass
+
+    os.makedirs(os.path.dirname(blob), exist_ok=True)
+    tmp_path = _tmp_path(blob)
+    method = _link(path, tmp_path)
+    os.replace(tmp_path, blob)
+    return {"deduplicated": False, "link": method}
+
+
+def link_into(sha256: str, size: int, dest: str) -> Optional[str]:
+    """
+    Создаёт dest из хранилища без передачи байтов, если содержимое с таким
+    хешем и размером уже есть. Возвращает способ или None.
+    """
+    if not is_enabled() or not exists(sha256, size):
+        return None
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    try:
+        return _replace_with_link(blob_path(sha256), dest)
+    except FileNotFoundError:
+        return None
+
+
+def _is_orphan(path: str) -> bool:
+    """
+    Содержимое больше не нужно, если на него не осталось жёстких ссылок
+    из сессий. Содержимое, разошедшееся по сессиям копиями, тоже считается
+    ненужным: копии в сессиях от его удаления не пострадают.
+    """
+    try:
+        return os.stat(path).st_nlink <= 1
+    except FileNotFoundError:
+        return False
+
+
+def _remove_orphan(path: str) -> int:
+    if not _is_orphan(path):
+        return 0
+    try:
+        size = os.path.getsize(path)
+        os.remove(path)
+    except FileNotFoundError:
+        return 0
+    return size
+
+
+def release(hashes: Iterable[str]) -> int:
+    """Удаляет из хранилища ставшее ненужным содержимое с этими хешами. Возвращает освобождённый объём."""
+    return sum(_remove_orphan(blob_path(sha256)) for sha256 in set(hashes))
+
+
+def _walk() -> Iterator[os.DirEntry]:
+    root = _blobs_dir()
+    if not os.path.isdir(root):
+        return
+    for bucket in os.scandir(root):
+        if bucket.is_dir():
+            for entry in os.scandir(bucket.path):
+                if entry.is_file() and not entry.name.endswith(".tmp"):
+                    yield entry
+
+
+def gc() -> Dict[str, int]:
+    """Удаляет всё содержимое, на которое не ссылается ни одна сессия."""
+    removed = 0
+    freed = 0
+    for entry in _walk():
+        size = _remove_orphan(entry.path)
+        if size:
+            removed += 1
+            freed += size
+    return {"removed": removed, "freed_bytes": freed}
+
+
+def stats() -> Dict[str, int]:
+    """Сколько содержимого в хранилище и сколько ссылок на него из сессий."""
+    blobs = 0
+    size = 0
+    links = 0
+    for entry in _walk():
+        stat = entry.stat()
+        blobs += 1
+        size += stat.st_size
+        links += max(0, stat.st_nlink - 1)
+    return {"blobs": blobs, "bytes": size, "links": links}
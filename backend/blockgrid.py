@@ -0,0 +1,111 @@
+import json
+import os
+import shutil
+import time
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+PNG = "png"
+BLOCKS = "blocks"
+EXPORT_MODES = (PNG, BLOCKS)
+DEFAULT_EXPORT = PNG
+# Сторона блока при экспорте ортомозаики сеткой, пиксели
+DEFAULT_BLOCK_PX = 4096
+
+GRID_SUFFIX = ".blocks"
+GRID_NAME = "grid.json"
+DONE_NAME = "export.done"
+BLOCK_EXT = ".tif"
+
+
+def export_mode() -> str:
+    """
+    Как Metashape отдаёт ортомозаику (METASHAPE_EXPORT): png — одним файлом,
+    blocks — сеткой блоков, которые AI начинает читать, пока экспорт ещё идёт.
+    """
+    mode = os.getenv("METASHAPE_EXPORT", DEFAULT_EXPORT).lower()
+    if mode not in EXPORT_MODES:
+        raise ValueError(f"Неизвестный режим экспорта ортомозаики: {mode}")
+    return mode
+
+
+def block_px() -> int:
+    return max(256, int(os.getenv("METASHAPE_BLOCK_PX", DEFAULT_BLOCK_PX)))
+
+
+def grid_dir(output_path: str) -> str:
+    """Папка сетки блоков для ортомозаики: orthomosaic.png -> orthomosaic.blocks."""
+    return os.path.splitext(output_path)[0] + GRID_SUFFIX
+
+
+def raster_path(output_path: str) -> str:
+    """Несжатый растр, собранный из блоков: orthomosaic.png -> orthomosaic.npy."""
+    return os.path.splitext(output_path)[0] + ".npy"
+
+
+def block_path(directory: str, row: int, col: int) -> str:
+    return os.path.join(directory, f"r{row:04d}_c{col:04d}{BLOCK_EXT}")
+
+
+def part_path(path: str) -> str:
+    """Временное имя блока на время записи; расширение сохраняется для кодировщика."""
+    root, ext = os.path.splitext(path)
+    return f"{root}.part{ext}"
+
+
+def start(directory: str, width: int, height: int, block_size: int) -> Dict[str, Any]:
+    """
+    Начинает экспорт: очищает папку и записывает геометрию сетки. Блоки затем
+    появляются в ней по одному (запись во временный файл и переименование),
+    а по окончании — метка export.done.
+    """
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    grid = {
+        "width": width,
+        "height": height,
+        "block_width": block_size,
+        "block_height": block_size,
+        "columns": -(-width // block_size),
+        "rows": -(-height // block_size),
+        "format": BLOCK_EXT[1:],
+        "created": time.time(),
+    }
+    path = os.path.join(directory, GRID_NAME)
+    tmp_path = path + ".part"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(grid, f)
+    os.replace(tmp_path, path)
+    return grid
+
+
+def iter_blocks(grid: Dict[str, Any]) -> Iterator[Tuple[int, int, int, int, int, int]]:
+    """Блоки по строкам: (строка, столбец, x1, y1, x2, y2) в пикселях ортомозаики."""
+    for row in range(grid["rows"]):
+        for col in range(grid["columns"]):
+            x1 = col * grid["block_width"]
+            y1 = row * grid["block_height"]
+            yield (
+                row,
+                col,
+                x1,
+                y1,
+                min(x1 + grid["block_width"], grid["width"]),
+                min(y1 + grid["block_height"], grid["height"]),
+            )
+
+
+def finish(directory: str) -> None:
+    with open(os.path.join(directory, DONE_NAME), "w", encoding="utf-8"):
+        pass
+
+
+def read_grid(directory: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(os.path.join(directory, GRID_NAME), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def is_done(directory: str) -> bool:
+    return os.path.isfile(os.path.join(directory, DONE_NAME))
@@ -0,0 +1,72 @@
+"""
+Проверка согласованности детекций между PyTorch и экспортированным бэкендом.
+
+Скрипт экспортирует модель (если это ещё не сделано), прогоняет изображения
+через оба бэкенда и сравнивает боксы. Детекция считается совпавшей, если во
+втором наборе есть бокс того же класса с IoU >= --match-iou. Код возврата 1,
+если полнота или точность ниже 1 - tolerance.
+
+Пример:
+    python check_backend.py onnx-int8 tmp/tmp1/metashape/orthomosaic.png
+"""
+import argparse
+import os
+import sys
+import time
+from typing import Tuple
+
+import numpy as np
+
+# Сравниваем сами бэкенды, а не кэш и не пул процессов
+os.environ["AI_CACHE"] = "0"
+os.environ["AI_WORKERS"] = "0"
+
+import ai  # noqa: E402
+import backends  # noqa: E402
+
+DEFAULT_TOLERANCE = 0.05
+
+
+def _detect(image_path: str, backend: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray, float]:
+    os.environ["AI_BACKEND"] = backend
+    ai._model = None
+    ai._get_model()
+    started = time.perf_counter()
+    _, _, classes, boxes, scores = ai._detect_tiled(image_path)
+    return boxes, classes, scores, time.perf_counter() - started
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("backend", choices=[b for b in backends.BACKENDS if b != "torch"])
+    parser.add_argument("images", nargs="+", help="Изображения для сравнения")
+    parser.add_argument("--match-iou", type=float, default=0.5, help="Порог IoU для сопоставления боксов")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=float(os.getenv("AI_BACKEND_TOLERANCE", DEFAULT_TOLERANCE)),
+        help="Допустимая доля несовпавших детекций",
+    )
+    args = parser.parse_args()
+
+    ok = True
+    for image_path in args.images:
+        ref_boxes, ref_classes, _, ref_time = _detect(image_path, "torch")
+        boxes, classes, _, backend_time = _detect(image_path, args.backend)
+
+        recall = ai.match_rate(ref_boxes, ref_classes, boxes, classes, args.match_iou)
+        precision = ai.match_rate(boxes, classes, ref_boxes, ref_classes, args.match_iou)
+        passed = min(recall, precision) >= 1 - args.tolerance
+        ok = ok and passed
+
+        print(
+            f"{os.path.basename(image_path)}: torch {len(ref_boxes)} боксов за {ref_time:.2f} с, "
+            f"{args.backend} {len(boxes)} боксов за {backend_time:.2f} с, "
+            f"полнота {recall:.3f}, точность {precision:.3f} — {'OK' if passed else 'РАСХОЖДЕНИЕ'}"
+        )
+
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
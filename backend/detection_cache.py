@@ -0,0 +1,236 @@
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+DEFAULT_CACHE_DIR = os.path.join("tmp", "cache")
+DEFAULT_CACHE_MAX_MB = 512
+HASH_CHUNK = 1024 * 1024
+# Сколько хешей снимков держать в памяти
+CONTENT_HASHES_MAX = 4096
+# Сколько ключей передаётся в один запрос IN (...) — меньше лимита параметров SQLite
+KEYS_PER_QUERY = 500
+TOTAL_SIZE = "total_size"
+
+_schema_lock = threading.Lock()
+_schema_ready = False
+# Хеши файлов моделей: (путь, размер, mtime) -> sha256
+_file_hashes: Dict[Tuple[str, int, float], str] = {}
+# Хеши снимков: (устройство, inode, размер, mtime) -> sha256
+_content_hashes: Dict[Tuple[int, int, int, float], str] = {}
+
+
+def is_enabled() -> bool:
+    """Кэш детекций включён, если AI_CACHE не равен "0"."""
+    return os.getenv("AI_CACHE", "1").lower() not in ("0", "false", "no")
+
+
+def _db_path() -> str:
+    cache_dir = os.getenv("AI_CACHE_DIR", DEFAULT_CACHE_DIR)
+    os.makedirs(cache_dir, exist_ok=True)
+    return os.path.join(cache_dir, "detections.sqlite")
+
+
+def _max_bytes() -> int:
+    return int(os.getenv("AI_CACHE_MAX_MB", DEFAULT_CACHE_MAX_MB)) * 1024 * 1024
+
+
+def _connect() -> sqlite3.Connection:
+    global _schema_ready
+    conn = sqlite3.connect(_db_path(), timeout=30)
+    with _schema_lock:
+        if not _schema_ready:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                " key TEXT PRIMARY KEY,"
+                " data BLOB NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " accessed REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+            # Суммарный размер записей ведётся инкрементально, чтобы не считать SUM при каждой записи
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            conn.execute(
+                "INSERT OR IGNORE INTO meta (name, value)"
+                " SELECT ?, COALESCE(SUM(size), 0) FROM entries",
+                (TOTAL_SIZE,),
+            )
+            conn.commit()
+            _schema_ready = True
+    return conn
+
+
+def file_hash(path: str) -> str:
+    """sha256 содержимого файла, читаемого кусками."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def model_hash(model_path: str) -> str:
+    """Хеш файла модели; пересчитывается только при изменении файла."""
+    stat = os.stat(model_path)
+    marker = (os.path.abspath(model_path), stat.st_size, stat.st_mtime)
+    if marker not in _file_hashes:
+        _file_hashes[marker] = file_hash(model_path)
+    return _file_hashes[marker]
+
+
+def content_hash(path: str) -> str:
+    """
+    Хеш снимка, запомненный по inode. Копии одного снимка в разных сессиях —
+    жёсткие ссылки на хранилище (см. blobs.py), поэтому он считается один раз
+    на все сессии, а детекции по нему общие.
+    """
+    stat = os.stat(path)
+    marker = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime)
+    if marker not in _content_hashes:
+        if len(_content_hashes) >= CONTENT_HASHES_MAX:
+            _content_hashes.clear()
+        _content_hashes[marker] = file_hash(path)
+    return _content_hashes[marker]
+
+
+def make_key(kind: str, content_hash: str, model: str, params: Dict[str, Any]) -> str:
+    """Ключ кэша: вид записи, хеш содержимого, хеш модели и параметры обработки."""
+    payload = json.dumps(
+        {"kind": kind, "content": content_hash, "model": model, "params": params},
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def tile_hash(tile: np.ndarray) -> str:
+    """Быстрый хеш пикселей тайла вместе с его формой."""
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(str(tile.shape).encode("ascii"))
+    digest.update(np.ascontiguousarray(tile).data)
+    return digest.hexdigest()
+
+
+def get_many(keys: Sequence[str]) -> List[Optional[Dict[str, np.ndarray]]]:
+    """
+    Записи для ключей (None — нет в кэше) одним запросом на пачку ключей;
+    время доступа попаданий обновляется одной транзакцией.
+    """
+    if not keys:
+        return []
+    found: Dict[str, bytes] = {}
+    conn = _connect()
+    try:
+        unique = list(dict.fromkeys(keys))
+        for start in range(0, len(unique), KEYS_PER_QUERY):
+            chunk = unique[start:start + KEYS_PER_QUERY]
+            placeholders = ", ".join("?" * len(chunk))
+            found.update(
+                conn.execute(f"SELECT key, data FROM entries WHERE key IN ({placeholders})", chunk).fetchall()
+            )
+        if found:
+            now = time.time()
+            conn.executemany("UPDATE entries SET accessed = ? WHERE key = ?", [(now, key) for key in found])
+            conn.commit()
+    finally:
+        conn.close()
+
+    return [_unpack(found[key]) if key in found else None for key in keys]
+
+
+def get(key: str) -> Optional[Dict[str, np.ndarray]]:
+    """Возвращает закэшированные массивы или None; попадание обновляет время доступа."""
+    return get_many([key])[0]
+
+
+def _unpack(blob: bytes) -> Dict[str, np.ndarray]:
+    with np.load(io.BytesIO(blob), allow_pickle=False) as data:
+        return {name: data[name] for name in data.files}
+
+
+def put_many(items: Sequence[Tuple[str, Dict[str, np.ndarray]]]) -> None:
+    """
+    Сохраняет записи одной транзакцией. Давно не использованные записи
+    вытесняются, только если суммарный размер превысил лимит.
+    """
+    if not items:
+        return
+    rows = []
+    for key, arrays in items:
+        buffer = io.BytesIO()
+        np.savez(buffer, **arrays)
+        rows.append((key, buffer.getvalue()))
+
+    conn = _connect()
+    try:
+        now = time.time()
+        for key, blob in rows:
+            # Размер заменяемой записи вычитается из суммы в той же транзакции
+            conn.execute(
+                "UPDATE meta SET value = value + ? - COALESCE((SELECT size FROM entries WHERE key = ?), 0)"
+                " WHERE name = ?",
+                (len(blob), key, TOTAL_SIZE),
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO entries (key, data, size, accessed) VALUES (?, ?, ?, ?)",
+                (key, blob, len(blob), now),
+            )
+        _evict(conn, _max_bytes())
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def put(key: str, arrays: Dict[str, np.ndarray]) -> None:
+    """Сохраняет массивы и вытесняет давно не использованные записи сверх лимита."""
+    put_many([(key, arrays)])
+
+
+def _evict(conn: sqlite3.Connection, max_bytes: int) -> None:
+    """LRU-вытеснение: удаляем самые старые по доступу записи, пока не уложимся в лимит."""
+    total = conn.execute("SELECT value FROM meta WHERE name = ?", (TOTAL_SIZE,)).fetchone()[0]
+    if total <= max_bytes:
+        return
+
+    stale = []
+    freed = 0
+    for key, size in conn.execute("SELECT key, size FROM entries ORDER BY accessed"):
+        if total - freed <= max_bytes:
+            break
+        stale.append((key,))
+        freed += size
+    conn.executemany("DELETE FROM entries WHERE key = ?", stale)
+    conn.execute("UPDATE meta SET value = value - ? WHERE name = ?", (freed, TOTAL_SIZE))
+
+
+def pack_detections(
+    boxes: np.ndarray,
+    classes: np.ndarray,
+    scores: np.ndarray,
+    names: Optional[Dict[int, str]] = None,
+) -> Dict[str, np.ndarray]:
+    """Упаковывает детекции в набор массивов для кэша."""
+    arrays = {
+        "boxes": np.asarray(boxes, dtype=np.float32).reshape(-1, 4),
+        "classes": np.asarray(classes, dtype=np.int64).reshape(-1),
+        "scores": np.asarray(scores, dtype=np.float32).reshape(-1),
+    }
+    if names is not None:
+        arrays["names"] = np.array(json.dumps({str(k): v for k, v in names.items()}))
+    return arrays
+
+
+def unpack_detections(
+    arrays: Dict[str, np.ndarray],
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, Optional[Dict[int, str]]]:
+    """Обратная операция к pack_detections."""
+    names = None
+    if "names" in arrays:
+        names = {int(k): v for k, v in json.loads(str(arrays["names"])).items()}
+    return arrays["boxes"], arrays["classes"], arrays["scores"], names
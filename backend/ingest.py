@@ -0,0 +1,122 @@
+import asyncio
+import hashlib
+import os
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import anyio
+from fastapi import UploadFile
+
+import blobs
+
+# Размер куска при потоковой записи загрузок, КБ
+DEFAULT_CHUNK_KB = 1024
+# Сколько файлов одной загрузки пишется на диск одновременно
+DEFAULT_UPLOAD_CONCURRENCY = 4
+
+PART_SUFFIX = ".part"
+
+# Сигнатуры форматов, которые принимает пайплайн (первые байты файла)
+IMAGE_SIGNATURES: Tuple[Tuple[bytes, str], ...] = (
+    (b"\xff\xd8\xff", "jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"II*\x00", "tiff"),
+    (b"MM\x00*", "tiff"),
+    (b"II+\x00", "tiff"),  # BigTIFF
+    (b"MM\x00+", "tiff"),
+    (b"BM", "bmp"),
+)
+HEADER_SIZE = max(len(signature) for signature, _ in IMAGE_SIGNATURES)
+
+
+def chunk_size() -> int:
+    return max(1, int(os.getenv("UPLOAD_CHUNK_KB", DEFAULT_CHUNK_KB))) * 1024
+
+
+def _upload_concurrency() -> int:
+    return max(1, int(os.getenv("UPLOAD_CONCURRENCY", DEFAULT_UPLOAD_CONCURRENCY)))
+
+
+def image_type(header: bytes) -> Optional[str]:
+    """Формат изображения по первым байтам или None, если это не изображение."""
+    for signature, name in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return name
+    return None
+
+
+async def stream_to_file(upload: UploadFile, dest_path: str) -> Dict[str, Any]:
+    """
+    Пишет загруженный файл на диск кусками фиксированного размера, не блокируя
+    цикл событий. По ходу записи считается sha256 и проверяется заголовок
+    изображения. Запись идёт во временный .part, который переименовывается
+    на место только после успешного завершения, после чего файл переводится
+    на хранилище по содержимому (см. blobs.py).
+    """
+    part_path = dest_path + PART_SUFFIX
+    digest = hashlib.sha256()
+    size = 0
+    header = b""
+    try:
+        async with await anyio.open_file(part_path, "wb") as out:
+            while True:
+                chunk = await upload.read(chunk_size())
+                if not chunk:
+                    break
+                if len(header) < HEADER_SIZE:
+                    header += chunk[:HEADER_SIZE - len(header)]
+                    if len(header) >= HEADER_SIZE and image_type(header) is None:
+                        raise ValueError(f"Файл {upload.filename} не является изображением")
+                digest.update(chunk)
+                size += len(chunk)
+                await out.write(chunk)
+
+        if image_type(header) is None:
+            raise ValueError(f"Файл {upload.filename} не является изображением")
+        await anyio.to_thread.run_sync(os.replace, part_path, dest_path)
+    except BaseException:
+        await anyio.to_thread.run_sync(_remove_quietly, part_path)
+        raise
+
+    sha256 = digest.hexdigest()
+    deduplicated = False
+    if blobs.is_enabled():
+        stored = await anyio.to_thread.run_sync(blobs.adopt, dest_path, sha256)
+        deduplicated = stored["deduplicated"]
+
+    return {
+        "name": os.path.basename(dest_path),
+        "size": size,
+        "sha256": sha256,
+        "format": image_type(header),
+        "deduplicated": deduplicated,
+    }
+
+
+def _remove_quietly(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+async def save_uploads(items: Sequence[Tuple[UploadFile, str]]) -> List[Dict[str, Any]]:
+    """
+    Сохраняет несколько загрузок параллельно, но не больше UPLOAD_CONCURRENCY
+    файлов одновременно. Ошибка в одном файле отменяет остальные.
+    Возвращает описания файлов в исходном порядке.
+    """
+    limit = asyncio.Semaphore(_upload_concurrency())
+
+    async def save_one(upload: UploadFile, dest_path: str) -> Dict[str, Any]:
+        async with limit:
+            return await stream_to_file(upload, dest_path)
+
+    tasks = [asyncio.ensure_future(save_one(upload, path)) for upload, path in items]
+    try:
+        return list(await asyncio.gather(*tasks))
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        # Дожидаемся отменённых задач, чтобы они успели удалить свои .part
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
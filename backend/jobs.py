@@ -0,0 +1,510 @@
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows: слоты этапов и владение задачами — в пределах одного процесса
+    fcntl = None
+
+DEFAULT_DB_PATH = os.path.join("tmp", "jobs.sqlite")
+# Сколько задач каждого этапа выполняется одновременно (переменные {ЭТАП}_CONCURRENCY)
+DEFAULT_STAGE_CONCURRENCY = {"metashape": 1, "ai": 1}
+# Как часто ожидающая слота задача проверяет, не отменили ли её, с
+POLL_INTERVAL = 0.5
+# Папка файлов блокировок рядом с базой: слоты этапов и «живые» процессы-владельцы
+LOCKS_DIR = "jobs.locks"
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED = (DONE, FAILED, CANCELLED)
+
+# Этап получает ID сессии, параметры задачи и состояние предыдущих этапов,
+# возвращает новое состояние
+StageFn = Callable[[int, Dict[str, Any], Dict[str, Any]], Dict[str, Any]]
+
+logger = logging.getLogger(__name__)
+
+_kinds: Dict[str, List[Tuple[str, StageFn]]] = {}
+_finish_hooks: Dict[str, Callable[[Dict[str, Any]], None]] = {}
+_semaphores: Dict[str, threading.BoundedSemaphore] = {}
+_semaphores_lock = threading.Lock()
+# События завершения задач этого процесса: создаются при постановке, удаляются при завершении
+_events: Dict[str, threading.Event] = {}
+_events_lock = threading.Lock()
+# Очередь каждого этапа и её исполнители: их столько же, сколько слотов этапа
+_queues: Dict[str, "queue.Queue[str]"] = {}
+_queues_lock = threading.Lock()
+# Задача, этап которой выполняет текущий поток исполнителя
+_current = threading.local()
+_schema_lock = threading.Lock()
+_schema_ready = False
+# Этот процесс как владелец задач: ID и файл, заблокированный, пока процесс жив
+_owner_lock = threading.Lock()
+_owner_id: Optional[str] = None
+_owner_pid: Optional[int] = None
+_owner_file: Optional[Any] = None
+
+
+def _db_path() -> str:
+    path = os.getenv("JOBS_DB", DEFAULT_DB_PATH)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    return path
+
+
+def _connect() -> sqlite3.Connection:
+    global _schema_ready
+    conn = sqlite3.connect(_db_path(), timeout=30)
+    conn.row_factory = sqlite3.Row
+    with _schema_lock:
+        if not _schema_ready:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id TEXT PRIMARY KEY,"
+                " kind TEXT NOT NULL,"
+                " session_id INTEGER NOT NULL,"
+                " params TEXT NOT NULL,"
+                " status TEXT NOT NULL,"
+                " stage TEXT,"
+                " completed INTEGER NOT NULL DEFAULT 0,"
+                " state TEXT NOT NULL DEFAULT '{}',"
+                " error TEXT,"
+                " error_status INTEGER,"
+                " cancel_requested INTEGER NOT NULL DEFAULT 0,"
+                " created REAL NOT NULL,"
+                " started REAL,"
+                " finished REAL,"
+                " owner TEXT)"
+            )
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if "owner" not in columns:
+                # База от версии без владельцев задач
+                conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+            conn.commit()
+            _schema_ready = True
+    return conn
+
+
+def _row_to_job(row: sqlite3.Row) -> Dict[str, Any]:
+    job = dict(row)
+    job["params"] = json.loads(job["params"])
+    job["state"] = json.loads(job["state"])
+    job["cancel_requested"] = bool(job["cancel_requested"])
+    job["stages"] = [name for name, _ in _kinds.get(job["kind"], [])]
+    return job
+
+
+def _update(job_id: str, statuses: Optional[Tuple[str, ...]] = None, **fields: Any) -> bool:
+    """
+    Обновляет поля задачи. Если заданы statuses — только когда её статус один
+    из них (атомарно относительно других потоков и процессов). True, если
+    задача обновлена.
+    """
+    if "state" in fields:
+        fields["state"] = json.dumps(fields["state"])
+    columns = ", ".join(f"{name} = ?" for name in fields)
+    query = f"UPDATE jobs SET {columns} WHERE id = ?"
+    args: List[Any] = [*fields.values(), job_id]
+    if statuses is not None:
+        query += f" AND status IN ({', '.join('?' for _ in statuses)})"
+        args.extend(statuses)
+    conn = _connect()
+    try:
+        cursor = conn.execute(query, args)
+        conn.commit()
+        return cursor.rowcount == 1
+    finally:
+        conn.close()
+
+
+def register(
+    kind: str,
+    stages: List[Tuple[str, StageFn]],
+    on_finish: Optional[Callable[[Dict[str, Any]], None]] = None,
+) -> None:
+    """
+    Регистрирует вид задачи как последовательность этапов.
+    on_finish вызывается с описанием задачи после её завершения (успех, ошибка, отмена).
+    """
+    _kinds[kind] = stages
+    if on_finish is not None:
+        _finish_hooks[kind] = on_finish
+
+
+def _locks_dir() -> str:
+    path = os.path.join(os.path.dirname(_db_path()) or ".", LOCKS_DIR)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _owner_path(owner: str) -> str:
+    return os.path.join(_locks_dir(), f"owner-{owner}.lock")
+
+
+def _owner() -> str:
+    """
+    ID этого процесса как владельца задач. Процесс держит блокировку своего
+    файла owner-<ID>.lock, пока жив: так другие воркеры uvicorn отличают
+    задачи живого процесса от задач упавшего. После fork ID новый.
+    """
+    global _owner_id, _owner_pid, _owner_file
+    with _owner_lock:
+        if _owner_pid != os.getpid():
+            _owner_id = f"{os.getpid()}-{uuid.uuid4().hex}"
+            _owner_pid = os.getpid()
+            _owner_file = None
+            if fcntl is not None:
+                _owner_file = open(_owner_path(_owner_id), "w")
+                fcntl.flock(_owner_file, fcntl.LOCK_EX)
+        return _owner_id
+
+
+def _owner_alive(owner: Optional[str]) -> bool:
+    """Жив ли процесс-владелец задачи. Файл мёртвого владельца удаляется."""
+    if owner is None:
+        return False
+    if owner == _owner():
+        return True
+    if fcntl is None:
+        # Без fcntl сервер — один процесс, чужие владельцы остались от прошлого запуска
+        return False
+    path = _owner_path(owner)
+    try:
+        fd = os.open(path, os.O_RDWR)
+    except FileNotFoundError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return True
+    finally:
+        os.close(fd)
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    return False
+
+
+def _stage_limit(stage: str) -> int:
+    default = DEFAULT_STAGE_CONCURRENCY.get(stage, 1)
+    return max(1, int(os.getenv(f"{stage.upper()}_CONCURRENCY", default)))
+
+
+def _semaphore(stage: str) -> threading.BoundedSemaphore:
+    with _semaphores_lock:
+        if stage not in _semaphores:
+            _semaphores[stage] = threading.BoundedSemaphore(_stage_limit(stage))
+        return _semaphores[stage]
+
+
+def _acquire_slot(stage: str, timeout: float = POLL_INTERVAL) -> Optional[Callable[[], None]]:
+    """
+    Пытается занять слот этапа (ждёт не дольше timeout). Слоты — файлы
+    <этап>-<N>.lock под flock, поэтому лимит {ЭТАП}_CONCURRENCY общий для всех
+    процессов сервера. Возвращает функцию освобождения или None.
+    """
+    if fcntl is None:
+        semaphore = _semaphore(stage)
+        acquired = semaphore.acquire(timeout=timeout) if timeout > 0 else semaphore.acquire(blocking=False)
+        return semaphore.release if acquired else None
+
+    for index in range(_stage_limit(stage)):
+        # flock привязан к открытому файлу: потоки одного процесса тоже исключают друг друга
+        slot = open(os.path.join(_locks_dir(), f"{stage}-{index}.lock"), "a")
+        try:
+            fcntl.flock(slot, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            slot.close()
+            continue
+        # Закрытие файла снимает блокировку
+        return slot.close
+    time.sleep(timeout)
+    return None
+
+
+@contextmanager
+def stage_slot(stage: str, job_id: Optional[str] = None, wait: bool = True) -> Iterator[bool]:
+    """
+    Занимает слот этапа на время блока. Для задачи ожидание прерывается отменой:
+    тогда блок получает False и должен сразу завершиться. С wait=False слот
+    не ждётся: если все заняты, блок сразу получает False.
+    """
+    release = _acquire_slot(stage, POLL_INTERVAL if wait else 0)
+    while release is None:
+        if not wait:
+            yield False
+            return
+        if job_id is not None and cancel_requested(job_id):
+            yield False
+            return
+        release = _acquire_slot(stage)
+    try:
+        yield True
+    finally:
+        release()
+
+
+def cancel_requested(job_id: str) -> bool:
+    """Запрошена ли отмена задачи (в любом процессе сервера)."""
+    job = get(job_id)
+    return job is None or job["cancel_requested"]
+
+
+def _release_event(job_id: str) -> None:
+    with _events_lock:
+        event = _events.pop(job_id, None)
+    if event is not None:
+        event.set()
+
+
+def _finished(job_id: str) -> None:
+    """Задача перешла в конечный статус: обработчик завершения и событие для wait()."""
+    job = get(job_id)
+    hook = _finish_hooks.get(job["kind"])
+    if hook is not None:
+        try:
+            hook(job)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Ошибка обработчика завершения задачи %s", job_id)
+    _release_event(job_id)
+
+
+def _finish(job_id: str, status: str, **fields: Any) -> None:
+    _update(job_id, status=status, stage=None, finished=time.time(), **fields)
+    _finished(job_id)
+
+
+def current_job_id() -> Optional[str]:
+    """ID задачи, этап которой выполняется в текущем потоке, или None."""
+    return getattr(_current, "job_id", None)
+
+
+def _schedule(job_id: str) -> None:
+    """
+    Ставит задачу в очередь её следующего незавершённого этапа или завершает,
+    если этапов не осталось.
+    """
+    job = get(job_id)
+    if job is None or job["status"] in FINISHED:
+        _release_event(job_id)
+        return
+    if job["cancel_requested"]:
+        # Отмену запросили, пока шёл этап
+        _finish(job_id, CANCELLED)
+        return
+    stages = _kinds[job["kind"]]
+    if job["completed"] >= len(stages):
+        _finish(job_id, DONE)
+        return
+    name = stages[job["completed"]][0]
+    if not _update(job_id, (QUEUED, RUNNING), status=QUEUED, stage=name):
+        # Задачу только что отменили
+        _release_event(job_id)
+        return
+    with _queues_lock:
+        if name not in _queues:
+            _queues[name] = queue.Queue()
+            for index in range(_stage_limit(name)):
+                threading.Thread(
+                    target=_worker, args=(name,), name=f"jobs-{name}-{index}", daemon=True
+                ).start()
+        _queues[name].put(job_id)
+
+
+def _worker(stage: str) -> None:
+    """Исполнитель этапа: берёт задачи из очереди этапа по одной."""
+    while True:
+        job_id = _queues[stage].get()
+        _current.job_id = job_id
+        try:
+            _run_stage(job_id)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Ошибка очереди задач на задаче %s", job_id)
+        finally:
+            _current.job_id = None
+
+
+def _run_stage(job_id: str) -> None:
+    """Выполняет очередной этап задачи и ставит её в очередь следующего."""
+    job = get(job_id)
+    if job is None or job["status"] in FINISHED:
+        # Ожидающую задачу отменил другой процесс
+        _release_event(job_id)
+        return
+
+    name, stage_fn = _kinds[job["kind"]][job["completed"]]
+    with stage_slot(name, job_id) as acquired:
+        # Пока задача ждала слот, её могли отменить (cancel() сам её завершает)
+        if not acquired or not _update(
+            job_id, (QUEUED,), status=RUNNING, started=job["started"] or time.time()
+        ):
+            _release_event(job_id)
+            return
+        if cancel_requested(job_id):
+            # Отмену запросили, пока задача переходила к этому этапу
+            _finish(job_id, CANCELLED)
+            return
+        try:
+            state = stage_fn(job["session_id"], job["params"], job["state"])
+        except Exception as exc:  # pylint: disable=broad-except
+            if cancel_requested(job_id):
+                # Этап прерван отменой (например, остановлен процесс Metashape)
+                _finish(job_id, CANCELLED)
+                return
+            # HTTPException несёт код ответа и detail — сохраняем их для клиента
+            _finish(
+                job_id,
+                FAILED,
+                error=str(getattr(exc, "detail", None) or exc),
+                error_status=getattr(exc, "status_code", 500),
+            )
+            return
+        _update(job_id, completed=job["completed"] + 1, state=state)
+    _schedule(job_id)
+
+
+def _start(job_id: str) -> None:
+    with _events_lock:
+        _events.setdefault(job_id, threading.Event())
+    _schedule(job_id)
+
+
+def submit(kind: str, session_id: int, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Ставит задачу в очередь и сразу возвращает её описание."""
+    if kind not in _kinds:
+        raise ValueError(f"Неизвестный вид задачи: {kind}")
+
+    job_id = uuid.uuid4().hex
+    conn = _connect()
+    try:
+        conn.execute(
+            "INSERT INTO jobs (id, kind, session_id, params, status, created, owner)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (job_id, kind, session_id, json.dumps(params or {}), QUEUED, time.time(), _owner()),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+    _start(job_id)
+    return get(job_id)
+
+
+def get(job_id: str) -> Optional[Dict[str, Any]]:
+    conn = _connect()
+    try:
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    finally:
+        conn.close()
+    return None if row is None else _row_to_job(row)
+
+
+def list_jobs(session_id: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Задачи (все или одной сессии), новые первыми."""
+    conn = _connect()
+    try:
+        if session_id is None:
+            rows = conn.execute("SELECT * FROM jobs ORDER BY created DESC").fetchall()
+        else:
+            rows = conn.execute(
+                "SELECT * FROM jobs WHERE session_id = ? ORDER BY created DESC", (session_id,)
+            ).fetchall()
+    finally:
+        conn.close()
+    return [_row_to_job(row) for row in rows]
+
+
+def cancel(job_id: str) -> Optional[Dict[str, Any]]:
+    """
+    Отменяет задачу. Ожидающая задача снимается сразу. У выполняющейся
+    выставляется признак отмены: этап, который умеет прерываться (Metashape
+    останавливает свой процесс, см. cancel_requested), завершается досрочно,
+    остальные — на границе этапов.
+    """
+    while True:
+        job = get(job_id)
+        if job is None or job["status"] in FINISHED:
+            return job
+        if _update(
+            job_id, (QUEUED,), status=CANCELLED, cancel_requested=1, stage=None, finished=time.time()
+        ):
+            _finished(job_id)
+            return get(job_id)
+        if _update(job_id, (RUNNING,), cancel_requested=1):
+            return get(job_id)
+        # Статус сменился между запросами — пробуем снова
+
+
+def wait(job_id: str, timeout: Optional[float] = None) -> Optional[Dict[str, Any]]:
+    """
+    Блокирует до завершения задачи (или таймаута) и возвращает её описание.
+    Задачу может выполнять другой процесс сервера, поэтому кроме события
+    своего процесса периодически проверяется база.
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    job = get(job_id)
+    while job is not None and job["status"] not in FINISHED:
+        remaining = POLL_INTERVAL if deadline is None else min(POLL_INTERVAL, deadline - time.monotonic())
+        if remaining <= 0:
+            break
+        with _events_lock:
+            event = _events.get(job_id)
+        if event is not None:
+            event.wait(remaining)
+        else:
+            # Задачу выполняет другой процесс
+            time.sleep(remaining)
+        job = get(job_id)
+    return job
+
+
+def resume() -> int:
+    """
+    Перезапускает задачи, не завершённые до остановки сервера. Этапы,
+    которые уже выполнились, не повторяются. Возвращает число задач.
+
+    resume() вызывается в каждом воркере uvicorn, поэтому задача забирается
+    атомарно: владелец меняется, только если он всё ещё прежний (мёртвый).
+    Задачи живых процессов не трогаются, и каждая выполняется один раз.
+    """
+    owner = _owner()
+    claimed: List[str] = []
+    conn = _connect()
+    try:
+        rows = conn.execute(
+            "SELECT id, owner FROM jobs WHERE status IN (?, ?) ORDER BY created", (QUEUED, RUNNING)
+        ).fetchall()
+        for row in rows:
+            if _owner_alive(row["owner"]):
+                continue
+            cursor = conn.execute(
+                "UPDATE jobs SET owner = ?, status = ? WHERE id = ? AND owner IS ? AND status IN (?, ?)",
+                (owner, QUEUED, row["id"], row["owner"], QUEUED, RUNNING),
+            )
+            conn.commit()
+            if cursor.rowcount == 1:
+                claimed.append(row["id"])
+    finally:
+        conn.close()
+
+    # Файлы владельцев, завершившихся без незаконченных задач
+    for name in os.listdir(_locks_dir()):
+        if name.startswith("owner-") and name.endswith(".lock"):
+            _owner_alive(name[len("owner-"):-len(".lock")])
+
+    for job_id in claimed:
+        _start(job_id)
+    return len(claimed)
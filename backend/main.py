@@ -1,18 +1,69 @@
-import glob
+import json
+import logging
+import mimetypes
 import os
+import re
 import shutil
-from typing import List, Dict, Any, Optional
+import threading
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import quote, urlencode
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple, Union
 
-from fastapi import FastAPI, UploadFile, File, HTTPException, Query
+import anyio
+from fastapi import FastAPI, UploadFile, File, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 
 from fly import fly_start, DroneConnectionError
 from grabber import grab_images
-from ai import process_image, process_ai_image
+from ai import process_image, process_ai_image, detect_ai_image, render_ai_image, project_photo_detections
+from raster import RAW_SUFFIX, BlockRaster, follow_blocks, read_image_size
+from workers import shutdown_pool
+import blobs
+import blockgrid
+import ingest
+import jobs
+import manifest
+import metashape
+import metashape_worker
+import previews
+import progress
+import pyramid
+import registry
+import results
+import retention
+import uploads
 
 TMP_ROOT = "tmp"
 
+# Режимы отрисовки результата AI: на сервере (картинка с боксами) или на клиенте (данные)
+RENDER_PATTERN = "^(server|client)$"
+# Виды фоновых задач: полный пайплайн Metashape + AI или только AI по готовой ортомозаике
+JOB_KIND_PATTERN = "^(metashape|ai)$"
+# Профили Metashape: preview — быстрый предварительный результат, full — полное качество
+PROFILE_PATTERN = "^(preview|full)$"
+PREVIEW_PROFILE = "preview"
+FULL_PROFILE = "full"
+# Детекции отдельных снимков лежат в ai/photos
+PHOTOS_DIR = "photos"
+# Папки сессии, файлы из которых можно отдавать клиенту
+SESSION_FOLDER_PATTERN = "^(data|metashape|ai)$"
+# Тайлы с версией в адресе не меняются — браузер может кэшировать их без перепроверки
+TILE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Через сколько секунд повторить запрос описания пирамиды, пока она строится
+PYRAMID_RETRY_AFTER = 2
+# Как часто поток прогресса перечитывает состояние и как часто шлёт его без изменений
+# (чтобы было видно, что шаг идёт, а не завис), с
+PROGRESS_POLL_INTERVAL = 0.5
+PROGRESS_KEEPALIVE = 5.0
+
+logger = logging.getLogger(__name__)
+
+# Детекция, которую этап Metashape запустил в фоне, по ID задачи: её потоки,
+# ортомозаики с готовыми детекциями и флаг «этап AI уже начался»
+_background: Dict[str, Dict[str, Any]] = {}
+_background_lock = threading.Lock()
+
 app = FastAPI(title=" backend")
 
 app.add_middleware(
@@ -29,57 +80,99 @@ app.add_middleware(
     expose_headers=["*"],
 )
 
-# ================== ВСПОМОГАТЕЛЬНЫЕ ШТУКИ ДЛЯ СЕССИЙ ==================
 
-def _ensure_tmp_root() -> None:
-    os.makedirs(TMP_ROOT, exist_ok=True)
+@app.on_event("startup")
+def _resume_jobs() -> None:
+    """Задачи, не завершённые до перезапуска сервера, снова ставятся в очередь."""
+    resumed = jobs.resume()
+    if resumed:
+        logger.info("Возобновлено задач из очереди: %d", resumed)
 
 
-def _list_session_ids() -> List[int]:
+@app.on_event("startup")
+def _start_retention() -> None:
+    """Фоновая очистка старых сессий по квоте диска (см. retention.py)."""
     _ensure_tmp_root()
-    ids: List[int] = []
-    for name in os.listdir(TMP_ROOT):
-        if name.startswith("tmp") and name[3:].isdigit():
-            ids.append(int(name[3:]))
-    return sorted(ids)
+    if retention.start(TMP_ROOT):
+        logger.info("Фоновая очистка сессий запущена")
 
 
-def _create_session() -> int:
+@app.on_event("shutdown")
+def _shutdown_workers() -> None:
     """
-    Создаёт новую папку tmp{i} с подпапками data, metashape, ai.
-    Возвращает i.
+    Останавливаем процессы инференса и Metashape вместе с сервером.
+    Прерванная обработка Metashape продолжится с контрольной точки
+    после перезапуска.
     """
-    ids = _list_session_ids()
-    next_id = (max(ids) + 1) if ids else 1
+    retention.stop()
+    shutdown_pool()
+    metashape_worker.stop_all()
 
-    session_dir = os.path.join(TMP_ROOT, f"tmp{next_id}")
-    os.makedirs(session_dir, exist_ok=True)
+# ================== ВСПОМОГАТЕЛЬНЫЕ ШТУКИ ДЛЯ СЕССИЙ ==================
 
-    for sub in ("data", "metashape", "ai"):
-        os.makedirs(os.path.join(session_dir, sub), exist_ok=True)
+def _ensure_tmp_root() -> None:
+    os.makedirs(TMP_ROOT, exist_ok=True)
 
-    return next_id
+
+def _create_session() -> int:
+    """
+    Создаёт новую папку tmp{i} с подпапками data, metashape, ai.
+    Номер выделяет реестр сессий — атомарно, в том числе между процессами.
+    Возвращает i.
+    """
+    _ensure_tmp_root()
+    return registry.create(TMP_ROOT)
 
 
 def _get_current_session_id() -> int:
     """
     Возвращает id последней сессии или кидает 404.
     """
-    ids = _list_session_ids()
-    if not ids:
+    _ensure_tmp_root()
+    session_id = registry.current(TMP_ROOT)
+    if session_id is None:
         raise HTTPException(status_code=404, detail="Сессий ещё нет")
-    return ids[-1]
+    return session_id
 
 
 def _require_session(session_id: int) -> None:
     """
-    Проверяем, что tmp{session_id} существует.
+    Проверяем, что сессия tmp{session_id} есть в реестре.
     """
-    path = os.path.join(TMP_ROOT, f"tmp{session_id}")
-    if not os.path.isdir(path):
+    _ensure_tmp_root()
+    if not registry.exists(TMP_ROOT, session_id):
         raise HTTPException(status_code=404, detail=f"Сессия tmp{session_id} не найдена")
 
 
+def _refresh_session_stats(session_id: int, state: Optional[str] = None) -> None:
+    """
+    Пересчитывает число снимков и размеры папок сессии в реестре.
+    """
+    paths = _get_paths(session_id)
+    fields: Dict[str, Any] = {
+        "image_count": len(_list_images(session_id, "data")),
+        "data_bytes": registry.folder_bytes(paths["data"]),
+        "total_bytes": registry.folder_bytes(paths["base"]),
+    }
+    if state is not None:
+        fields["state"] = state
+    registry.update(TMP_ROOT, session_id, **fields)
+
+
+def _session_info(session: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "session_id": session["id"],
+        "tmp_folder": f"tmp{session['id']}",
+        "state": session["state"],
+        "image_count": session["image_count"],
+        "data_bytes": session["data_bytes"],
+        "total_bytes": session["total_bytes"],
+        "last_job": session["last_job"],
+        "created": session["created"],
+        "updated": session["updated"],
+    }
+
+
 def _get_paths(session_id: int) -> Dict[str, str]:
     """
     Возвращает пути до папок data, metashape, ai для данной сессии.
@@ -93,18 +186,170 @@ def _get_paths(session_id: int) -> Dict[str, str]:
     }
 
 
-def _list_images(folder: str) -> List[str]:
+def _list_images(session_id: int, folder: str) -> List[str]:
     """
-    Список файлов-изображений в папке.
+    Список файлов-изображений в папке сессии по её манифесту (см. manifest.py).
+    Папка пересканируется, только если изменилась с прошлого раза.
     """
-    patterns = ("*.jpg", "*.jpeg", "*.png", "*.tif", "*.tiff", "*.bmp")
-    files: List[str] = []
+    return manifest.list_images(_get_paths(session_id)["base"], folder)
 
 
-    
-    for p in patterns:
-        files.extend(glob.glob(os.path.join(folder, p)))
-    return sorted(files)
+def _ai_output_path(session_id: int, input_path: str, suffix: str = "_ai") -> str:
+    """
+    Путь результата AI в tmp{session_id}/ai для входного изображения.
+    """
+    ai_dir = _get_paths(session_id)["ai"]
+    os.makedirs(ai_dir, exist_ok=True)
+    name, ext = os.path.splitext(os.path.basename(input_path))
+    if ext == ".npy":
+        # Ортомозаика, собранная из блоков экспорта: картинка с боксами — PNG
+        ext = ".png"
+    return os.path.join(ai_dir, f"{name}{suffix}{ext}")
+
+
+def _photo_output_path(session_id: int, photo_path: str) -> str:
+    """Путь результата AI для отдельного снимка из data: tmp{session_id}/ai/photos/<имя>."""
+    return os.path.join(_get_paths(session_id)["ai"], PHOTOS_DIR, os.path.basename(photo_path))
+
+
+def _session_file(session_id: int, folder: str, name: str) -> str:
+    """
+    Путь к существующему файлу в папке сессии; имя очищается от компонентов пути.
+    """
+    _require_session(session_id)
+    path = os.path.join(_get_paths(session_id)[folder], os.path.basename(name))
+    if not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail=f"Файл {name} не найден")
+    return path
+
+
+def _not_modified(request: Request, etag: str, mtime: float) -> bool:
+    """
+    Условный GET: If-None-Match сравнивается с ETag (слабое сравнение),
+    If-Modified-Since учитывается, только если If-None-Match не передан.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or etag in [tag[2:] if tag.startswith("W/") else tag for tag in tags]
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is None:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since).timestamp()
+    except (TypeError, ValueError):
+        return False
+    return int(mtime) <= since
+
+
+def _file_response(
+    request: Request,
+    path: str,
+    media_type: Optional[str] = None,
+    filename: Optional[str] = None,
+    cache_control: str = "no-cache",
+) -> Response:
+    """
+    Отдаёт файл с ETag и Last-Modified: повторный запрос с валидаторами
+    получает 304 без тела. Запросы диапазонов (Range) обслуживает FileResponse.
+    """
+    stat = os.stat(path)
+    etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+        "Cache-Control": cache_control,
+    }
+    if _not_modified(request, etag, stat.st_mtime):
+        return Response(status_code=304, headers=headers)
+
+    if media_type is None:
+        media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    return FileResponse(path, media_type=media_type, filename=filename, headers=headers, stat_result=stat)
+
+
+def _image_response(request: Request, path: str, variant: str = previews.ORIGINAL) -> Response:
+    """
+    Изображение-результат: оригинал или превью (thumb, screen), которое
+    создаётся один раз и дальше отдаётся с диска.
+    """
+    if variant == previews.ORIGINAL:
+        return _file_response(request, path, filename=os.path.basename(path))
+
+    try:
+        preview = previews.build(path, variant)
+    except Exception as exc:  # pylint: disable=broad-except
+        raise HTTPException(
+            status_code=500,
+            detail=f"Не удалось подготовить превью: {str(exc)}",
+        ) from exc
+
+    fmt = os.path.splitext(preview)[1][1:]
+    name = os.path.splitext(os.path.basename(path))[0]
+    return _file_response(
+        request, preview, media_type=previews.media_type(fmt), filename=f"{name}_{variant}.{fmt}"
+    )
+
+
+async def _progress_events(
+    request: Request,
+    snapshot: Callable[[], Tuple[Any, Dict[str, Any], bool]],
+) -> AsyncIterator[str]:
+    """
+    События SSE: состояние отправляется при изменении и не реже раза в
+    PROGRESS_KEEPALIVE секунд. snapshot возвращает ключ изменения, данные
+    и признак того, что поток пора закрыть.
+    """
+    last_key: Any = object()
+    last_sent = 0.0
+    while not await request.is_disconnected():
+        key, payload, finished = await anyio.to_thread.run_sync(snapshot)
+        now = anyio.current_time()
+        if key != last_key or finished or now - last_sent >= PROGRESS_KEEPALIVE:
+            yield f"event: progress\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+            last_key, last_sent = key, now
+        if finished:
+            return
+        await anyio.sleep(PROGRESS_POLL_INTERVAL)
+
+
+def _progress_response(
+    request: Request,
+    snapshot: Callable[[], Tuple[Any, Dict[str, Any], bool]],
+) -> StreamingResponse:
+    return StreamingResponse(
+        _progress_events(request, snapshot),
+        media_type="text/event-stream",
+        # X-Accel-Buffering: nginx не должен копить события в буфере
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def _tracker(session_id: int, stage: str) -> progress.Tracker:
+    """Прогресс этапа сессии; внутри задачи привязан к её ID (см. progress.py)."""
+    return progress.Tracker(_get_paths(session_id)["base"], stage, jobs.current_job_id())
+
+
+def _detect_progress(tracker: Optional[progress.Tracker]) -> Optional[Callable[[int, int], None]]:
+    """Открывает шаг detect и возвращает колбэк тайлов YOLO."""
+    if tracker is None:
+        return None
+    tracker.step("detect")
+    return tracker.tiles
+
+
+def _build_pyramid(image_path: str, tracker: Optional[progress.Tracker] = None) -> None:
+    """
+    Строит пирамиду тайлов для результата. Ошибка сборки не ломает обработку:
+    просмотрщик тогда загрузит изображение целиком.
+    """
+    if tracker is not None:
+        tracker.step("buildPyramid")
+    try:
+        pyramid.build(image_path)
+    except Exception:  # pylint: disable=broad-except
+        logger.exception("Не удалось построить пирамиду тайлов для %s", image_path)
 
 
 # =========================== DATA: ЗАГРУЗКА ===========================
@@ -113,18 +358,20 @@ def _list_images(folder: str) -> List[str]:
 async def _save_uploads_to_data(
     session_id: int,
     files: List[UploadFile],
-) -> List[str]:
+) -> List[Dict[str, Any]]:
     """
     Сохранение загруженных картинок в tmp{session_id}/data.
+    Файлы пишутся потоково и параллельно (см. ingest.py);
+    возвращаются имя, размер, sha256 и формат каждого файла.
     """
     paths = _get_paths(session_id)
     data_dir = paths["data"]
     os.makedirs(data_dir, exist_ok=True)
 
-    saved: List[str] = []
+    items = []
 
     for index, upload in enumerate(files, start=1):
-        if not upload.content_type.startswith("image/"):
+        if not (upload.content_type or "").startswith("image/"):
             raise HTTPException(
                 status_code=400,
                 detail=f"Файл {upload.filename} не является изображением",
@@ -135,23 +382,33 @@ async def _save_uploads_to_data(
         if not ext:
             ext = ".jpg"
         filename = f"{index:04d}{ext}"
-        dest_path = os.path.join(data_dir, filename)
-
-        content = await upload.read()
-        with open(dest_path, "wb") as f:
-            f.write(content)
+        items.append((upload, os.path.join(data_dir, filename)))
 
-        saved.append(filename)
+    try:
+        saved = await ingest.save_uploads(items)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
 
+    await anyio.to_thread.run_sync(_record_uploads, session_id, saved)
     return saved
 
 
+def _record_uploads(session_id: int, saved: List[Dict[str, Any]]) -> None:
+    """
+    Заносит принятые файлы в манифест сессии: хеш и формат уже посчитаны
+    при приёме, размер в пикселях и EXIF/GPS читаются из заголовка один раз.
+    """
+    base = _get_paths(session_id)["base"]
+    for item in saved:
+        manifest.add(base, "data", item["name"], sha256=item["sha256"], fmt=item["format"])
+    _refresh_session_stats(session_id, registry.UPLOADED)
+
+
 # ========================= ВРЕМЕННАЯ ИММИТАЦИЯ РАБОТЫ METASHAPE =========================
 
 
 def _require_data_not_empty(session_id: int) -> None:
-    paths = _get_paths(session_id)
-    images = _list_images(paths["data"])
+    images = _list_images(session_id, "data")
     if not images:
         raise HTTPException(
             status_code=400,
@@ -159,20 +416,42 @@ def _require_data_not_empty(session_id: int) -> None:
         )
 
 
-def process_metashape(session_id: int) -> str:
+def _metashape_outputs(session_id: int, profile: str) -> Tuple[str, str]:
+    """
+    Ортомозаика и проект Metashape для профиля. У быстрого профиля свои файлы,
+    чтобы предварительный результат не мешал полному и наоборот.
+    """
+    metashape_dir = _get_paths(session_id)["metashape"]
+    suffix = "" if profile == FULL_PROFILE else f"_{profile}"
+    return (
+        os.path.join(metashape_dir, f"orthomosaic{suffix}.png"),
+        os.path.join(metashape_dir, f"project{suffix}.psx"),
+    )
+
+
+def process_metashape(
+    session_id: int,
+    tracker: Optional[progress.Tracker] = None,
+    profile: str = FULL_PROFILE,
+    consume: Optional[Callable[[BlockRaster], None]] = None,
+) -> str:
     """
-    Запускает обработку фотографий через Metashape.
+    Запускает обработку фотографий через Metashape в отдельном процессе
+    (см. metashape_worker.py; движок — METASHAPE_ENGINE).
     Использует фотографии из data/ и сохраняет ортомозаику в metashape/.
+    Шаги Metashape и их проценты попадают в tracker.
+
+    При METASHAPE_EXPORT=blocks ортомозаика экспортируется сеткой блоков
+    и собирается в orthomosaic.npy без кодирования PNG; consume получает
+    этот растр, пока экспорт ещё идёт (см. raster.follow_blocks).
     Возвращает путь к созданной ортомозаике.
     """
-    from metashape import process_metashape as run_metashape
-
     paths = _get_paths(session_id)
     data_dir = paths["data"]
     metashape_dir = paths["metashape"]
     os.makedirs(metashape_dir, exist_ok=True)
 
-    images = _list_images(data_dir)
+    images = _list_images(session_id, "data")
     if not images:
         raise HTTPException(
             status_code=400,
@@ -180,21 +459,37 @@ def process_metashape(session_id: int) -> str:
         )
 
     # Путь для сохранения ортомозаики
-    output_path = os.path.join(metashape_dir, "orthomosaic.png")
-    project_path = os.path.join(metashape_dir, "project.psx")
+    output_path, project_path = _metashape_outputs(session_id, profile)
+    # Отмена задачи останавливает процесс Metashape
+    job_id = jobs.current_job_id()
 
-    try:
-        result_path = run_metashape(
+    def run() -> str:
+        return metashape_worker.run(
             photos_folder=data_dir,
             output_path=output_path,
             project_path=project_path,
+            photos=images,
+            progress=tracker.step if tracker is not None else None,
+            profile=profile,
+            cancelled=(lambda: jobs.cancel_requested(job_id)) if job_id is not None else None,
         )
-        return result_path
+
+    try:
+        if blockgrid.export_mode() == blockgrid.BLOCKS:
+            return follow_blocks(
+                blockgrid.grid_dir(output_path), blockgrid.raster_path(output_path), run, consume
+            )
+        return run()
     except ImportError as exc:
         raise HTTPException(
             status_code=503,
             detail=f"Metashape недоступен: {str(exc)}",
         ) from exc
+    except TimeoutError as exc:
+        raise HTTPException(
+            status_code=504,
+            detail=str(exc),
+        ) from exc
     except Exception as exc:  # pylint: disable=broad-except
         raise HTTPException(
             status_code=500,
@@ -202,10 +497,11 @@ def process_metashape(session_id: int) -> str:
         ) from exc
 
 
-def process_metashape_and_ai(session_id: int) -> str:
+def process_metashape_and_ai(session_id: int, render: str = "server") -> str:
     """
     Запускает обработку через Metashape, затем автоматически обрабатывает результат через AI.
-    Возвращает путь к обработанному AI изображению.
+    Возвращает путь к обработанному AI изображению, а при render="client" —
+    путь к ортомозаике (детекции сохраняются рядом с результатом AI, картинка не рисуется).
     """
     # Сначала запускаем Metashape
     metashape_result = process_metashape(session_id)
@@ -216,24 +512,50 @@ def process_metashape_and_ai(session_id: int) -> str:
             status_code=500,
             detail="Metashape не вернул результат",
         )
-    
-    # Теперь обрабатываем результат Metashape через AI
-    paths = _get_paths(session_id)
-    ai_dir = paths["ai"]
-    os.makedirs(ai_dir, exist_ok=True)
-    
-    # Создаём путь для AI результата
-    base_name = os.path.basename(metashape_result)
-    name, ext = os.path.splitext(base_name)
-    ai_output_path = os.path.join(ai_dir, f"{name}_ai{ext}")
+
+    _build_pyramid(metashape_result)
+
+    return process_ai_for_metashape_result(session_id, metashape_result, render)
+
+
+def process_ai_for_metashape_result(
+    session_id: int,
+    metashape_result: str,
+    render: str = "server",
+    tracker: Optional[progress.Tracker] = None,
+    detected: bool = False,
+) -> str:
+    """
+    AI-часть пайплайна: обрабатывает готовую ортомозаику Metashape.
+    detected=True — детекции уже посчитаны во время экспорта блоков,
+    остаётся только нарисовать их. Если модели нет, результатом считается
+    сама ортомозаика.
+    """
+    ai_output_path = _ai_output_path(session_id, metashape_result)
     
     try:
+        if detected:
+            if render == "client":
+                return metashape_result
+            ai_result = render_ai_image(metashape_result, ai_output_path)
+            _build_pyramid(ai_result, tracker)
+            return ai_result
+        if render == "client":
+            detect_ai_image(metashape_result, ai_output_path, on_progress=_detect_progress(tracker))
+            return metashape_result
         # Обрабатываем через AI
-        ai_result = process_ai_image(metashape_result, ai_output_path)
+        ai_result = process_ai_image(metashape_result, ai_output_path, on_progress=_detect_progress(tracker))
+        _build_pyramid(ai_result, tracker)
         return ai_result
     except FileNotFoundError as exc:
         # Если модель AI не найдена, возвращаем оригинальный результат Metashape
-        shutil.copy2(metashape_result, ai_output_path)
+        if render == "client":
+            return metashape_result
+        if metashape_result.endswith(".npy"):
+            render_ai_image(metashape_result, ai_output_path)
+        else:
+            shutil.copy2(metashape_result, ai_output_path)
+        _build_pyramid(ai_output_path, tracker)
         return ai_output_path
     except Exception as exc:  # pylint: disable=broad-except
         raise HTTPException(
@@ -245,9 +567,23 @@ def process_metashape_and_ai(session_id: int) -> str:
 # ============================= AI: ПРОЦЕСС =============================
 
 
+def _metashape_results(session_id: int) -> List[str]:
+    """
+    Ортомозаики в metashape/: изображения из манифеста и растры .npy,
+    собранные из блоков экспорта (кэши .raw.npy сюда не входят).
+    """
+    folder = _get_paths(session_id)["metashape"]
+    rasters = []
+    if os.path.isdir(folder):
+        rasters = [
+            entry.path for entry in os.scandir(folder)
+            if entry.is_file() and entry.name.endswith(".npy") and not entry.name.endswith(RAW_SUFFIX)
+        ]
+    return sorted(_list_images(session_id, "metashape") + rasters)
+
+
 def _require_metashape_not_empty(session_id: int) -> None:
-    paths = _get_paths(session_id)
-    images = _list_images(paths["metashape"])
+    images = _metashape_results(session_id)
     if not images:
         raise HTTPException(
             status_code=400,
@@ -255,17 +591,13 @@ def _require_metashape_not_empty(session_id: int) -> None:
         )
 
 
-def process_ai_for_session(session_id: int) -> str:
+def _ai_input_for_session(session_id: int) -> str:
     """
-    Берём первую картинку из metashape, прогоняем через YOLO (из ai.py),
-    результат сохраняем в tmp{session_id}/ai и возвращаем путь к результату.
+    Первая картинка из metashape — вход AI для сессии. Полная ортомозаика
+    (orthomosaic.png или orthomosaic.npy) по имени идёт раньше предварительной
+    (orthomosaic_preview.*).
     """
-    paths = _get_paths(session_id)
-    metashape_dir = paths["metashape"]
-    ai_dir = paths["ai"]
-    os.makedirs(ai_dir, exist_ok=True)
-
-    images = _list_images(metashape_dir)
+    images = _metashape_results(session_id)
 
     if not images:
         raise HTTPException(
@@ -273,14 +605,29 @@ def process_ai_for_session(session_id: int) -> str:
             detail="В папке metashape нет изображений",
         )
 
-    input_path = images[0]
-    base_name = os.path.basename(input_path)
-    name, ext = os.path.splitext(base_name)
-    output_path = os.path.join(ai_dir, f"{name}_ai{ext}")
+    return images[0]
+
+
+def process_ai_for_session(
+    session_id: int,
+    render: str = "server",
+    tracker: Optional[progress.Tracker] = None,
+) -> str:
+    """
+    Берём первую картинку из metashape, прогоняем через YOLO (из ai.py),
+    результат сохраняем в tmp{session_id}/ai и возвращаем путь к результату.
+    При render="client" картинка не рисуется: возвращается путь к папке детекций.
+    """
+    input_path = _ai_input_for_session(session_id)
+    output_path = _ai_output_path(session_id, input_path)
 
     # Зовём нашу функцию из ai.py
     try:
-        result_path = process_ai_image(input_path, output_path)
+        if render == "client":
+            _build_pyramid(input_path, tracker)
+            return detect_ai_image(input_path, output_path, on_progress=_detect_progress(tracker))
+        result_path = process_ai_image(input_path, output_path, on_progress=_detect_progress(tracker))
+        _build_pyramid(result_path, tracker)
     except FileNotFoundError as exc:
         raise HTTPException(
             status_code=503,
@@ -295,6 +642,448 @@ def process_ai_for_session(session_id: int) -> str:
     return result_path
 
 
+def _overlay_payload(session_id: int, image_path: str, output_path: str) -> Dict[str, Any]:
+    """
+    Ответ для отрисовки на клиенте: ссылка на исходное изображение и детекции.
+    detections равен None, если AI не отработал (например, нет модели).
+    tiles_url указывает на описание пирамиды тайлов, если она построена,
+    preview_url — на уменьшенную копию для показа без тайлов.
+    """
+    folder = os.path.basename(os.path.dirname(image_path))
+    name = os.path.basename(image_path)
+    store_dir = results.store_path(output_path)
+    file_query = {"session_id": session_id, "folder": folder, "name": name}
+
+    detections = None
+    if os.path.isdir(store_dir):
+        boxes, classes, scores, meta = results.query(store_dir)
+        detections = results.to_json(boxes, classes, scores, meta)
+
+    return {
+        "session_id": session_id,
+        "render": "client",
+        "image_url": "/session/file?" + urlencode(file_query),
+        "preview_url": "/session/file?" + urlencode({**file_query, "variant": "screen"}),
+        "tiles_url": _tiles_base_url(session_id, folder, name) + "/info"
+        if pyramid.is_fresh(image_path) else None,
+        "result": os.path.basename(store_dir)[: -len(results.STORE_SUFFIX)],
+        "detections": detections,
+    }
+
+
+def _tiles_base_url(session_id: int, folder: str, name: str) -> str:
+    return f"/tiles/{session_id}/{folder}/{quote(name)}"
+
+
+# ============================= ФОНОВЫЕ ЗАДАЧИ =============================
+
+
+def _start_background(job_id: Optional[str]) -> Dict[str, Any]:
+    background: Dict[str, Any] = {"threads": [], "detected": [], "closed": threading.Event()}
+    if job_id is not None:
+        with _background_lock:
+            _background[job_id] = background
+    return background
+
+
+def _join_background(job_id: Optional[str], wait: bool = True) -> List[str]:
+    """
+    Закрывает фоновую детекцию задачи (новая уже не начнётся) и, если wait,
+    дожидается начатой. Возвращает ортомозаики, для которых детекции готовы.
+    После перезапуска сервера фоновой детекции нет — список пуст.
+    """
+    with _background_lock:
+        background = _background.pop(job_id, None) if job_id is not None else None
+    if background is None:
+        return []
+    background["closed"].set()
+    if wait:
+        for thread in background["threads"]:
+            thread.join()
+    return background["detected"]
+
+
+def _detect_blocks(
+    session_id: int,
+    job_id: Optional[str],
+    tracker: progress.Tracker,
+    background: Dict[str, Any],
+) -> Callable[[BlockRaster], None]:
+    """
+    YOLO по ортомозаике, пока Metashape ещё экспортирует её блоки. Инференс
+    занимает слот этапа ai, как и обычный AI-этап, но слот не ждёт: если он
+    занят, детекцию по собранному растру сделает этап AI. Этап Metashape
+    детекцию не дожидается — это делает этап AI (см. _join_background).
+    """
+    def consume(source: BlockRaster) -> None:
+        background["threads"].append(threading.current_thread())
+        if background["closed"].is_set():
+            return
+        with jobs.stage_slot("ai", job_id, wait=False) as acquired:
+            if not acquired or background["closed"].is_set():
+                return
+            detect_ai_image(
+                source.path,
+                _ai_output_path(session_id, source.path),
+                on_progress=lambda done, total: tracker.tiles(done, total, background=True),
+                source=source,
+            )
+            background["detected"].append(source.path)
+
+    return consume
+
+
+def _detect_photos(
+    session_id: int,
+    tracker: progress.Tracker,
+    closed: Optional[threading.Event] = None,
+) -> None:
+    """
+    YOLO по каждому снимку из data. Детекции снимка сохраняются в
+    ai/photos/<имя>_detections сразу, как готовы (см. GET /ai/photos); уже
+    посчитанные снимки пропускаются. Если closed выставлен, следующий снимок
+    не начинается. Ошибка пишется в лог: AI по ортомозаике тогда отработает
+    обычным путём.
+    """
+    try:
+        photos = _list_images(session_id, "data")
+        for index, photo in enumerate(photos):
+            if closed is not None and closed.is_set():
+                return
+            store_dir = results.store_path(_photo_output_path(session_id, photo))
+            if not os.path.isdir(store_dir) or os.path.getmtime(store_dir) < os.path.getmtime(photo):
+                detect_ai_image(photo, _photo_output_path(session_id, photo))
+            tracker.photos(index + 1, len(photos))
+    except Exception:  # pylint: disable=broad-except
+        logger.exception("Не удалось обработать снимки сессии %s", session_id)
+
+
+def _detect_photos_background(
+    session_id: int,
+    job_id: Optional[str],
+    tracker: progress.Tracker,
+    background: Dict[str, Any],
+) -> None:
+    """
+    Детекция снимков, пока Metashape обрабатывает те же снимки. Занимает слот
+    этапа ai, когда тот освободится, но этап Metashape её не ждёт: оставшиеся
+    снимки досчитает этап AI (см. _metashape_ai_stage).
+    """
+    closed = background["closed"]
+    while not closed.is_set():
+        with jobs.stage_slot("ai", job_id, wait=False) as acquired:
+            if acquired:
+                _detect_photos(session_id, tracker, closed)
+                return
+        closed.wait(jobs.POLL_INTERVAL)
+
+
+def _project_photos(session_id: int, metashape_result: str) -> bool:
+    """
+    Переносит детекции снимков на ортомозаику по камерам, которые Metashape
+    сохранил рядом с ней. Результат ложится туда же, куда легли бы детекции
+    YOLO по самой ортомозаике. False — переносить нечего (нет камер или
+    детекций снимков).
+    """
+    stores = [
+        store_dir
+        for store_dir in (
+            results.store_path(_photo_output_path(session_id, photo))
+            for photo in _list_images(session_id, "data")
+        )
+        if os.path.isdir(store_dir)
+    ]
+    size = read_image_size(metashape_result)
+    if not stores or size is None:
+        return False
+    projected = project_photo_detections(
+        stores,
+        metashape.cameras_path(metashape_result),
+        metashape_result,
+        _ai_output_path(session_id, metashape_result),
+        size,
+    )
+    return projected is not None
+
+
+def _metashape_stage(session_id: int, params: Dict[str, Any], state: Dict[str, Any]) -> Dict[str, Any]:
+    tracker = _tracker(session_id, "metashape")
+    profile = params.get("profile", FULL_PROFILE)
+    job_id = jobs.current_job_id()
+    background = _start_background(job_id)
+    consume: Optional[Callable[[BlockRaster], None]] = None
+    if params.get("per_photo"):
+        # Детекции снимков заменяют YOLO по ортомозаике — блоки экспорта не разбираем
+        photo_detector = threading.Thread(
+            target=_detect_photos_background,
+            args=(session_id, job_id, tracker, background),
+            daemon=True,
+        )
+        background["threads"].append(photo_detector)
+        photo_detector.start()
+    else:
+        consume = _detect_blocks(session_id, job_id, tracker, background)
+    try:
+        metashape_result = process_metashape(session_id, tracker, profile, consume)
+    except Exception:
+        _join_background(job_id, wait=False)
+        raise
+    if not os.path.isfile(metashape_result):
+        raise HTTPException(
+            status_code=500,
+            detail="Metashape не вернул результат",
+        )
+    _build_pyramid(metashape_result, tracker)
+    return {
+        **state,
+        "input_path": metashape_result,
+        "profile": profile,
+    }
+
+
+def _metashape_ai_stage(session_id: int, params: Dict[str, Any], state: Dict[str, Any]) -> Dict[str, Any]:
+    input_path = state["input_path"]
+    tracker = _tracker(session_id, "ai")
+    detected = input_path in _join_background(jobs.current_job_id())
+    if params.get("per_photo") and not detected:
+        # Этап AI уже держит слот: снимки, до которых фоновая детекция
+        # не дошла, досчитываются здесь
+        _detect_photos(session_id, tracker)
+        tracker.step("projectPhotos")
+        detected = _project_photos(session_id, input_path)
+    result_path = process_ai_for_metashape_result(
+        session_id, input_path, params["render"], tracker, detected
+    )
+    return {**state, "result_path": result_path, "detected": detected}
+
+
+def _preview_stage(session_id: int, params: Dict[str, Any], state: Dict[str, Any]) -> Dict[str, Any]:
+    """Первая фаза двухфазной обработки: быстрый профиль Metashape."""
+    preview = _metashape_stage(session_id, {**params, "profile": PREVIEW_PROFILE}, {})
+    return {**state, "preview": preview}
+
+
+def _preview_ai_stage(session_id: int, params: Dict[str, Any], state: Dict[str, Any]) -> Dict[str, Any]:
+    """AI по предварительной ортомозаике; после этого этапа результат уже можно отдавать."""
+    return {**state, "preview": _metashape_ai_stage(session_id, params, state["preview"])}
+
+
+def _discard_preview(session_id: int) -> None:
+    """
+    Удаляет предварительную ортомозаику, всё, что построено по ней, и проект
+    preview (project_preview.psx, папку .files с картами глубины, контрольную точку).
+    """
+    output_path, project_path = _metashape_outputs(session_id, PREVIEW_PROFILE)
+    stems = tuple(
+        os.path.splitext(os.path.basename(path))[0] for path in (output_path, project_path)
+    )
+    paths = _get_paths(session_id)
+    for folder in (paths["metashape"], paths["ai"]):
+        if not os.path.isdir(folder):
+            continue
+        for entry in os.scandir(folder):
+            if not entry.name.startswith(stems):
+                continue
+            if entry.is_dir():
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                os.remove(entry.path)
+
+
+def _full_ai_stage(session_id: int, params: Dict[str, Any], state: Dict[str, Any]) -> Dict[str, Any]:
+    """AI по полной ортомозаике; её результат заменяет предварительный."""
+    state = _metashape_ai_stage(session_id, params, state)
+    return {name: value for name, value in state.items() if name != "preview"}
+
+
+def _ai_stage(session_id: int, params: Dict[str, Any], state: Dict[str, Any]) -> Dict[str, Any]:
+    input_path = _ai_input_for_session(session_id)
+    result_path = process_ai_for_session(session_id, params["render"], _tracker(session_id, "ai"))
+    return {**state, "input_path": input_path, "result_path": result_path}
+
+
+def _job_finished(job: Dict[str, Any]) -> None:
+    """Итог задачи попадает в реестр сессий и в её прогресс."""
+    state = {
+        jobs.DONE: registry.DONE,
+        jobs.FAILED: registry.FAILED,
+        jobs.CANCELLED: registry.CANCELLED,
+    }[job["status"]]
+    # Задачу отменили или она упала между этапами — фоновая детекция больше не нужна
+    _join_background(job["id"], wait=False)
+    if job["kind"] == "metashape_two_phase" and job["status"] == jobs.DONE:
+        # Предварительный результат больше не отдаётся — полный его заменил
+        _discard_preview(job["session_id"])
+    _refresh_session_stats(job["session_id"], state)
+    progress.finish(_get_paths(job["session_id"])["base"], job["id"], job["status"], job["error"])
+
+
+# Metashape и AI — отдельные этапы со своими лимитами одновременных запусков
+jobs.register(
+    "metashape",
+    [("metashape", _metashape_stage), ("ai", _metashape_ai_stage)],
+    on_finish=_job_finished,
+)
+# Двухфазная обработка: быстрый профиль с AI (результат доступен сразу),
+# затем полное качество, которое заменяет предварительный результат
+jobs.register(
+    "metashape_two_phase",
+    [
+        ("metashape", _preview_stage),
+        ("ai", _preview_ai_stage),
+        ("metashape", _metashape_stage),
+        ("ai", _full_ai_stage),
+    ],
+    on_finish=_job_finished,
+)
+jobs.register("ai", [("ai", _ai_stage)], on_finish=_job_finished)
+
+
+def _submit_job(
+    kind: str,
+    session_id: int,
+    render: str,
+    profile: str = FULL_PROFILE,
+    two_phase: bool = False,
+    per_photo: bool = False,
+) -> Dict[str, Any]:
+    params: Dict[str, Any] = {"render": render}
+    if kind == "metashape":
+        if two_phase:
+            kind = "metashape_two_phase"
+            profile = FULL_PROFILE
+        params["profile"] = profile
+        params["per_photo"] = per_photo
+    job = jobs.submit(kind, session_id, params)
+    registry.update(TMP_ROOT, session_id, state=registry.PROCESSING, last_job=job["id"])
+    return _job_status(job)
+
+
+def _preview_available(job: Dict[str, Any]) -> bool:
+    """Предварительный результат двухфазной задачи готов, а полный ещё нет."""
+    return job["status"] in (jobs.QUEUED, jobs.RUNNING) and "result_path" in job["state"].get("preview", {})
+
+
+def _job_status(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Описание задачи для клиента."""
+    return {
+        "job_id": job["id"],
+        "kind": job["kind"],
+        "session_id": job["session_id"],
+        "status": job["status"],
+        "stage": job["stage"],
+        "stages": job["stages"],
+        "completed_stages": job["completed"],
+        "cancel_requested": job["cancel_requested"],
+        "error": job["error"],
+        "created": job["created"],
+        "started": job["started"],
+        "finished": job["finished"],
+        "profile": job["state"].get("profile"),
+        "result_url": f"/jobs/{job['id']}/result" if job["status"] == jobs.DONE else None,
+        "preview_url": f"/jobs/{job['id']}/result" if _preview_available(job) else None,
+    }
+
+
+def _job_result(
+    job: Dict[str, Any],
+    request: Request,
+    variant: str = previews.ORIGINAL,
+) -> Union[Response, Dict[str, Any]]:
+    """
+    Результат завершённой задачи в том же виде, что и у синхронных эндпоинтов:
+    картинка с боксами (оригинал или превью variant) или, при render=client,
+    данные для оверлея. Пока двухфазная задача считает полное качество,
+    отдаётся предварительный результат (профиль — в заголовке X-Result-Profile
+    или в поле profile).
+    """
+    if job["status"] == jobs.FAILED:
+        raise HTTPException(status_code=job["error_status"] or 500, detail=job["error"])
+    if job["status"] == jobs.CANCELLED:
+        raise HTTPException(status_code=409, detail="Задача отменена")
+
+    session_id = job["session_id"]
+    state = job["state"]
+    if _preview_available(job):
+        state = state["preview"]
+    elif job["status"] != jobs.DONE:
+        raise HTTPException(status_code=409, detail="Задача ещё не завершена")
+
+    profile = state.get("profile")
+    if job["params"].get("render") == "client":
+        input_path = state["input_path"]
+        payload = _overlay_payload(session_id, input_path, _ai_output_path(session_id, input_path))
+        return {**payload, "profile": profile}
+
+    result_path = state["result_path"]
+    if not os.path.isfile(result_path):
+        raise HTTPException(
+            status_code=500,
+            detail="Обработка не вернула результат",
+        )
+
+    response = _image_response(request, result_path, variant)
+    if profile is not None:
+        response.headers["X-Result-Profile"] = profile
+    return response
+
+
+def _run_job(
+    kind: str,
+    session_id: int,
+    render: str,
+    background: bool,
+    request: Request,
+    variant: str = previews.ORIGINAL,
+    profile: str = FULL_PROFILE,
+    two_phase: bool = False,
+    per_photo: bool = False,
+) -> Union[Response, Dict[str, Any]]:
+    """
+    Запуск пайплайна через очередь задач. В фоновом режиме сразу отвечает 202
+    с ID задачи, иначе ждёт завершения и отдаёт результат.
+    """
+    status = _submit_job(kind, session_id, render, profile, two_phase, per_photo)
+    if background:
+        return JSONResponse(status_code=202, content=status)
+    return _job_result(jobs.wait(status["job_id"]), request, variant)
+
+
+def _find_detection_store(session_id: int, result: Optional[str] = None) -> str:
+    """
+    Папка структурированных детекций в tmp{session_id}/ai.
+    result — имя файла результата без расширения; если не задано, берём самый свежий.
+    """
+    ai_dir = _get_paths(session_id)["ai"]
+    if result is not None:
+        store_dir = os.path.join(ai_dir, os.path.basename(result) + results.STORE_SUFFIX)
+        if not os.path.isdir(store_dir):
+            raise HTTPException(status_code=404, detail=f"Детекции для {result} не найдены")
+        return store_dir
+
+    stores = [
+        os.path.join(ai_dir, name)
+        for name in os.listdir(ai_dir)
+        if name.endswith(results.STORE_SUFFIX) and os.path.isdir(os.path.join(ai_dir, name))
+    ] if os.path.isdir(ai_dir) else []
+    if not stores:
+        raise HTTPException(status_code=404, detail="В сессии ещё нет результатов AI")
+    return max(stores, key=os.path.getmtime)
+
+
+def _parse_bbox(bbox: Optional[str]) -> Optional[tuple]:
+    if bbox is None:
+        return None
+    try:
+        x1, y1, x2, y2 = (float(v) for v in bbox.split(","))
+    except ValueError as exc:
+        raise HTTPException(
+            status_code=400,
+            detail="bbox задаётся как x1,y1,x2,y2",
+        ) from exc
+    return x1, y1, x2, y2
+
+
 # =============================== ENDPOINTЫ ===============================
 
 
@@ -304,7 +1093,7 @@ def create_session() -> Dict[str, Any]:
     Создать новую tmp{i}.
     """
     session_id = _create_session()
-    return {"session_id": session_id, "tmp_folder": f"tmp{session_id}"}
+    return _session_info(registry.get(TMP_ROOT, session_id))
 
 
 @app.get("/session/current")
@@ -313,7 +1102,96 @@ def get_current_session() -> Dict[str, Any]:
     Получить id последней созданной tmp{i}.
     """
     session_id = _get_current_session_id()
-    return {"session_id": session_id, "tmp_folder": f"tmp{session_id}"}
+    return _session_info(registry.get(TMP_ROOT, session_id))
+
+
+@app.get("/session/{session_id:int}")
+def get_session(session_id: int) -> Dict[str, Any]:
+    """
+    Метаданные сессии из реестра: состояние, число снимков, размеры, время.
+    """
+    _require_session(session_id)
+    return _session_info(registry.get(TMP_ROOT, session_id))
+
+
+@app.get("/session/{session_id:int}/images")
+def get_session_images(
+    session_id: int,
+    folder: str = Query(default="data", pattern=SESSION_FOLDER_PATTERN, description="Папка сессии: data, metashape или ai"),
+) -> Dict[str, Any]:
+    """
+    Манифест снимков сессии: имя, размер, sha256, размер в пикселях, EXIF и GPS.
+    """
+    _require_session(session_id)
+    return {
+        "session_id": session_id,
+        "folder": folder,
+        "images": manifest.entries(_get_paths(session_id)["base"], folder),
+    }
+
+
+@app.get("/session/{session_id:int}/progress")
+def get_session_progress(session_id: int) -> Dict[str, Any]:
+    """
+    Прогресс последней обработки сессии: этап, шаг Metashape или тайлы YOLO,
+    процент, время с начала и длительность каждого шага.
+    """
+    _require_session(session_id)
+    return {"session_id": session_id, "progress": progress.read(_get_paths(session_id)["base"])}
+
+
+@app.get("/session/{session_id:int}/progress/stream")
+def stream_session_progress(session_id: int, request: Request) -> StreamingResponse:
+    """
+    Поток Server-Sent Events с прогрессом обработки сессии. Не закрывается
+    после завершения: следующая обработка сессии попадёт в тот же поток.
+    """
+    _require_session(session_id)
+    base = _get_paths(session_id)["base"]
+
+    def snapshot() -> Tuple[Any, Dict[str, Any], bool]:
+        state = progress.read(base)
+        payload = {"session_id": session_id, "progress": state}
+        return (state or {}).get("updated"), payload, False
+
+    return _progress_response(request, snapshot)
+
+
+@app.get("/sessions")
+def list_sessions(
+    limit: int = Query(default=100, ge=1, le=1000, description="Сколько последних сессий вернуть"),
+) -> Dict[str, Any]:
+    _ensure_tmp_root()
+    return {"sessions": [_session_info(s) for s in registry.list_sessions(TMP_ROOT, limit)]}
+
+
+@app.get("/retention")
+def get_retention() -> Dict[str, Any]:
+    """
+    Настройки очистки сессий, отчёт о последнем проходе и заполненность
+    хранилища снимков по содержимому.
+    """
+    config = retention.settings()
+    return {
+        "enabled": retention.is_enabled(),
+        "quota_bytes": config["quota_bytes"],
+        "max_age_sec": config["max_age_sec"],
+        "interval_sec": config["interval_sec"],
+        "last_run": retention.last_report(),
+        "blobs": blobs.stats(),
+    }
+
+
+@app.post("/retention/run")
+async def run_retention() -> Dict[str, Any]:
+    """
+    Внеочередной проход очистки. Выполняется в потоке, не блокируя сервер.
+    """
+    _ensure_tmp_root()
+    report = await anyio.to_thread.run_sync(retention.run_once, TMP_ROOT)
+    if report is None:
+        raise HTTPException(status_code=409, detail="Очистка уже выполняется")
+    return report
 
 
 @app.post("/data/upload")
@@ -339,16 +1217,155 @@ async def upload_data(
     else:
         _require_session(session_id)
 
-    saved_filenames = await _save_uploads_to_data(session_id, files)
+    saved = await _save_uploads_to_data(session_id, files)
     paths = _get_paths(session_id)
 
     return {
         "session_id": session_id,
         "data_dir": paths["data"],
-        "saved_files": saved_filenames,
+        "saved_files": [item["name"] for item in saved],
+        "files": saved,
+    }
+
+
+# ====================== DATA: ДОКАЧИВАЕМАЯ ЗАГРУЗКА ======================
+
+
+def _upload_status(upload: Dict[str, Any]) -> Dict[str, Any]:
+    """Состояние загрузки для клиента: что уже получено и каких частей не хватает."""
+    return {
+        "upload_id": upload["id"],
+        "session_id": upload["session_id"],
+        "name": upload["name"],
+        "size": upload["size"],
+        "part_size": upload["part_size"],
+        "received": upload["received"],
+        "ranges": upload["ranges"],
+        "missing_parts": upload["missing_parts"],
+        "complete": upload["complete"],
+        "status": upload["status"],
+        "sha256": upload["sha256"],
+        "deduplicated": upload.get("deduplicated", False),
     }
 
 
+def _require_upload(upload_id: str) -> Dict[str, Any]:
+    upload = uploads.get(upload_id)
+    if upload is None:
+        raise HTTPException(status_code=404, detail=f"Загрузка {upload_id} не найдена")
+    return upload
+
+
+@app.post("/uploads")
+def create_upload(
+    filename: str = Query(..., description="Имя файла"),
+    size: int = Query(..., gt=0, description="Размер файла в байтах"),
+    session_id: Optional[int] = Query(
+        default=None,
+        description="ID сессии (если не передан — создаётся новая)",
+    ),
+    sha256: Optional[str] = Query(default=None, description="Ожидаемый sha256, проверяется при завершении"),
+    part_size: Optional[int] = Query(default=None, gt=0, description="Размер части для PUT по номерам"),
+) -> Dict[str, Any]:
+    """
+    Создаёт докачиваемую загрузку одного файла в tmp{session_id}/data.
+    Дальше части отправляются PUT по смещению или номеру части в любом порядке,
+    GET показывает, что уже дошло, finalize кладёт файл на место.
+    Если файл с таким sha256 уже загружался, загрузка сразу завершена.
+    """
+    _, ext = os.path.splitext(filename)
+    if ext.lower() not in (".jpg", ".jpeg", ".png", ".tif", ".tiff", ".bmp"):
+        raise HTTPException(
+            status_code=400,
+            detail=f"Файл {filename} не является изображением",
+        )
+
+    if session_id is None:
+        session_id = _create_session()
+    else:
+        _require_session(session_id)
+
+    dest_path = os.path.join(_get_paths(session_id)["data"], os.path.basename(filename))
+    try:
+        upload = uploads.create(session_id, dest_path, size, sha256, part_size)
+    except FileExistsError as exc:
+        raise HTTPException(status_code=409, detail=str(exc)) from exc
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+
+    if upload["status"] == uploads.COMPLETED:
+        _record_uploads(session_id, [{"name": upload["name"], "sha256": upload["sha256"], "format": None}])
+    return _upload_status(upload)
+
+
+@app.get("/uploads/{upload_id}")
+def get_upload(upload_id: str) -> Dict[str, Any]:
+    return _upload_status(_require_upload(upload_id))
+
+
+async def _write_upload(upload_id: str, offset: int, request: Request) -> Dict[str, Any]:
+    try:
+        upload = await uploads.write(upload_id, offset, request.stream())
+    except KeyError as exc:
+        raise HTTPException(status_code=404, detail=f"Загрузка {upload_id} не найдена") from exc
+    except FileExistsError as exc:
+        raise HTTPException(status_code=409, detail=str(exc)) from exc
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+    return _upload_status(upload)
+
+
+@app.put("/uploads/{upload_id}")
+async def put_upload_chunk(
+    upload_id: str,
+    request: Request,
+    offset: int = Query(..., ge=0, description="Смещение куска в файле"),
+) -> Dict[str, Any]:
+    """Тело запроса — сырые байты, записываются в файл с указанного смещения."""
+    return await _write_upload(upload_id, offset, request)
+
+
+@app.put("/uploads/{upload_id}/parts/{number}")
+async def put_upload_part(upload_id: str, number: int, request: Request) -> Dict[str, Any]:
+    """Часть с номером number (с нуля) размером part_size."""
+    upload = _require_upload(upload_id)
+    try:
+        offset = uploads.part_offset(upload, number)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+    return await _write_upload(upload_id, offset, request)
+
+
+@app.post("/uploads/{upload_id}/finalize")
+def finalize_upload(upload_id: str) -> Dict[str, Any]:
+    """
+    Проверяет полноту, заголовок и контрольную сумму и переименовывает
+    файл в data/. Повторный вызов для завершённой загрузки безопасен.
+    """
+    _require_upload(upload_id)
+    try:
+        upload = uploads.finalize(upload_id)
+    except FileExistsError as exc:
+        raise HTTPException(status_code=409, detail=str(exc)) from exc
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+
+    manifest.add(
+        _get_paths(upload["session_id"])["base"], "data", upload["name"],
+        sha256=upload["sha256"], fmt=upload.get("format"),
+    )
+    _refresh_session_stats(upload["session_id"], registry.UPLOADED)
+    return _upload_status(upload)
+
+
+@app.delete("/uploads/{upload_id}")
+def abort_upload(upload_id: str) -> Dict[str, Any]:
+    """Отменяет загрузку и удаляет недокачанный файл."""
+    _require_upload(upload_id)
+    uploads.abort(upload_id)
+    return {"upload_id": upload_id, "status": "aborted"}
+
+
 @app.post("/start/fly")
 def start_fly() -> Dict[str, Any]:
     """
@@ -378,75 +1395,326 @@ def start_fly() -> Dict[str, Any]:
     }
 
 
-@app.get("/metashape/run")
+@app.get("/metashape/run", response_model=None)
 def run_metashape_endpoint(
+    request: Request,
     session_id: int = Query(..., description="ID сессии tmp{i}"),
-) -> FileResponse:
+    render: str = Query(default="server", pattern=RENDER_PATTERN, description="server — картинка с боксами, client — данные для оверлея"),
+    background: bool = Query(default=False, description="Не ждать завершения: вернуть ID задачи"),
+    variant: str = Query(default=previews.ORIGINAL, pattern=previews.VARIANT_PATTERN, description="original — исходный файл, screen или thumb — уменьшенное превью"),
+    profile: str = Query(default=FULL_PROFILE, pattern=PROFILE_PATTERN, description="Профиль Metashape: preview — быстро и грубо, full — полное качество"),
+    two_phase: bool = Query(default=False, description="Сначала preview с AI (доступен сразу), затем full, который его заменяет"),
+    per_photo: bool = Query(default=False, description="YOLO по каждому снимку параллельно Metashape, затем перенос детекций на ортомозаику"),
+) -> Union[Response, Dict[str, Any]]:
     """
     Запуск обработки Metashape с автоматической AI обработкой:
     - проверяем, что есть сессия и картинки в data;
-    - запускаем Metashape;
-    - автоматически обрабатываем результат через AI;
-    - возвращаем результат AI обработки.
+    - ставим задачу в очередь (Metashape, затем AI);
+    - при background=true сразу возвращаем ID задачи (202), иначе ждём
+      и возвращаем результат AI обработки.
     """
     _require_session(session_id)
     _require_data_not_empty(session_id)
 
-    result_path = process_metashape_and_ai(session_id)
+    return _run_job("metashape", session_id, render, background, request, variant, profile, two_phase, per_photo)
 
-    if not os.path.isfile(result_path):
-        raise HTTPException(
-            status_code=500,
-            detail="Обработка не вернула результат",
-        )
-
-    return FileResponse(
-        result_path,
-        media_type="image/jpeg",
-        filename=os.path.basename(result_path),
-    )
 
-
-@app.get("/ai/run")
+@app.get("/ai/run", response_model=None)
 def run_ai_endpoint(
+    request: Request,
     session_id: int = Query(..., description="ID сессии tmp{i}"),
-) -> FileResponse:
+    render: str = Query(default="server", pattern=RENDER_PATTERN, description="server — картинка с боксами, client — данные для оверлея"),
+    background: bool = Query(default=False, description="Не ждать завершения: вернуть ID задачи"),
+    variant: str = Query(default=previews.ORIGINAL, pattern=previews.VARIANT_PATTERN, description="original — исходный файл, screen или thumb — уменьшенное превью"),
+) -> Union[Response, Dict[str, Any]]:
     """
     Кнопка AI-процесса:
     - проверяем, что есть результат Metashape;
-    - прогоняем через YOLO из ai.py;
-    - возвращаем картинку из папки ai как FileResponse.
+    - прогоняем через YOLO из ai.py (через очередь задач);
+    - возвращаем картинку из папки ai как FileResponse
+      или, при render=client, ссылку на ортомозаику и детекции;
+      при background=true — ID задачи (202).
     """
     _require_session(session_id)
     _require_metashape_not_empty(session_id)
 
-    result_path = process_ai_for_session(session_id)
+    return _run_job("ai", session_id, render, background, request, variant)
 
-    if not os.path.isfile(result_path):
-        raise HTTPException(
-            status_code=500,
-            detail="AI не вернул результирующее изображение",
+
+@app.get("/session/file")
+def get_session_file(
+    request: Request,
+    session_id: int = Query(..., description="ID сессии tmp{i}"),
+    folder: str = Query(..., pattern=SESSION_FOLDER_PATTERN, description="Папка сессии"),
+    name: str = Query(..., description="Имя файла"),
+    variant: str = Query(default=previews.ORIGINAL, pattern=previews.VARIANT_PATTERN, description="original — исходный файл, screen или thumb — уменьшенное превью"),
+) -> Response:
+    """
+    Отдаёт файл сессии — исходное изображение для отрисовки оверлеев на клиенте
+    или его превью (variant=screen, thumb). Поддерживаются ETag/304 и Range.
+    """
+    path = _session_file(session_id, folder, name)
+    return _image_response(request, path, variant)
+
+
+# ============================ ПИРАМИДА ТАЙЛОВ ============================
+
+
+def _pyramid_source(session_id: int, folder: str, name: str) -> str:
+    """Исходное изображение пирамиды; папка в пути проверяется так же, как в /session/file."""
+    if not re.match(SESSION_FOLDER_PATTERN, folder):
+        raise HTTPException(status_code=404, detail=f"Папка {folder} не найдена")
+    return _session_file(session_id, folder, name)
+
+
+@app.get("/tiles/{session_id}/{folder}/{name}/info", response_model=None)
+def get_tiles_info(session_id: int, folder: str, name: str) -> Union[Dict[str, Any], JSONResponse]:
+    """
+    Описание пирамиды тайлов DeepZoom для изображения сессии.
+    Если пирамиды ещё нет (или она устарела), её сборка запускается в фоне,
+    а ответ — 202 со статусом building: запрос стоит повторить позже.
+    tiles_url — шаблон адреса тайла с подстановками {level}, {col}, {row}.
+    """
+    path = _pyramid_source(session_id, folder, name)
+
+    if not pyramid.is_fresh(path):
+        pyramid.start_build(path)
+        return JSONResponse(
+            status_code=202,
+            content={"status": "building"},
+            headers={"Retry-After": str(PYRAMID_RETRY_AFTER)},
         )
+    info = pyramid.load_info(path)
+
+    base_url = _tiles_base_url(session_id, folder, os.path.basename(path))
+    return {
+        **info,
+        "dzi_url": f"{base_url}/{pyramid.DZI_NAME}",
+        "tiles_url": (
+            f"{base_url}/{pyramid.FILES_DIR}/{{level}}/{{col}}_{{row}}.{info['format']}"
+            f"?v={info['version']}"
+        ),
+    }
+
+
+@app.get("/tiles/{session_id}/{folder}/{name}/image.dzi")
+def get_tiles_dzi(request: Request, session_id: int, folder: str, name: str) -> Response:
+    """Дескриптор DeepZoom для совместимых просмотрщиков (OpenSeadragon и т.п.)."""
+    path = _pyramid_source(session_id, folder, name)
+    if not pyramid.is_fresh(path):
+        raise HTTPException(status_code=404, detail="Пирамида тайлов не построена")
+    return _file_response(
+        request, os.path.join(pyramid.pyramid_path(path), pyramid.DZI_NAME), media_type="application/xml"
+    )
+
+
+@app.get("/tiles/{session_id}/{folder}/{name}/image_files/{level}/{tile}")
+def get_tile(
+    request: Request,
+    session_id: int,
+    folder: str,
+    name: str,
+    level: int,
+    tile: str,
+    v: Optional[str] = Query(default=None, description="Версия пирамиды из info"),
+) -> Response:
+    """
+    Один тайл пирамиды. С параметром v, совпадающим с текущей версией, тайл
+    кэшируется браузером навсегда; без него — перепроверяется по ETag.
+    """
+    match = re.fullmatch(r"(\d+)_(\d+)\.(jpg|png)", tile)
+    if not match:
+        raise HTTPException(status_code=404, detail=f"Тайл {tile} не найден")
+    path = _pyramid_source(session_id, folder, name)
+
+    col, row, fmt = int(match.group(1)), int(match.group(2)), match.group(3)
+    tile_path = pyramid.tile_path(path, level, col, row, fmt)
+    if not pyramid.is_fresh(path) or not os.path.isfile(tile_path):
+        raise HTTPException(status_code=404, detail=f"Тайл {tile} не найден")
+
+    immutable = v is not None and v == pyramid.load_info(path)["version"]
+    return _file_response(
+        request,
+        tile_path,
+        media_type="image/jpeg" if fmt == "jpg" else "image/png",
+        cache_control=TILE_CACHE_CONTROL if immutable else "no-cache",
+    )
+
 
-    return FileResponse(
-        result_path,
-        media_type="image/jpeg",
-        filename=os.path.basename(result_path),
+@app.get("/ai/detections")
+def get_detections_endpoint(
+    session_id: int = Query(..., description="ID сессии tmp{i}"),
+    result: Optional[str] = Query(default=None, description="Имя результата без расширения (по умолчанию — последний)"),
+    class_name: Optional[List[str]] = Query(default=None, description="Фильтр по именам классов"),
+    min_score: Optional[float] = Query(default=None, ge=0, le=1, description="Минимальная уверенность"),
+    bbox: Optional[str] = Query(default=None, description="Область x1,y1,x2,y2 в пикселях"),
+    limit: Optional[int] = Query(default=None, ge=1, description="Максимум детекций в ответе"),
+    format: str = Query(default="json", pattern="^(json|geojson)$", description="json или geojson"),
+) -> Dict[str, Any]:
+    """
+    Детекции сессии с фильтрацией по классу, уверенности и области.
+    Читаются только нужные столбцы хранилища, а не весь набор.
+    """
+    _require_session(session_id)
+    store_dir = _find_detection_store(session_id, result)
+
+    boxes, classes, scores, meta = results.query(
+        store_dir,
+        class_names=class_name,
+        min_score=min_score,
+        bbox=_parse_bbox(bbox),
+        limit=limit,
     )
 
+    if format == "geojson":
+        return results.to_geojson(boxes, classes, scores, meta)
+    return results.to_json(boxes, classes, scores, meta)
+
+
+@app.get("/ai/photos")
+def get_photo_detections(
+    session_id: int = Query(..., description="ID сессии tmp{i}"),
+    min_score: Optional[float] = Query(default=None, ge=0, le=1, description="Минимальная уверенность"),
+) -> Dict[str, Any]:
+    """
+    Детекции отдельных снимков из data (задача с per_photo=true). Доступны
+    по мере готовности, ещё до окончания Metashape; у необработанных снимков
+    detections равен null. Боксы — в пикселях снимка.
+    """
+    _require_session(session_id)
+    photos = []
+    done = 0
+    for photo in _list_images(session_id, "data"):
+        name = os.path.basename(photo)
+        store_dir = results.store_path(_photo_output_path(session_id, photo))
+        detections = None
+        if os.path.isdir(store_dir):
+            boxes, classes, scores, meta = results.query(store_dir, min_score=min_score)
+            detections = results.to_json(boxes, classes, scores, meta)
+            done += 1
+        photos.append({
+            "name": name,
+            "image_url": "/session/file?" + urlencode({"session_id": session_id, "folder": "data", "name": name}),
+            "detections": detections,
+        })
+    return {"session_id": session_id, "done": done, "total": len(photos), "photos": photos}
+
+
+@app.post("/jobs", status_code=202)
+def submit_job(
+    session_id: int = Query(..., description="ID сессии tmp{i}"),
+    kind: str = Query(default="metashape", pattern=JOB_KIND_PATTERN, description="metashape — Metashape + AI, ai — только AI"),
+    render: str = Query(default="server", pattern=RENDER_PATTERN, description="server — картинка с боксами, client — данные для оверлея"),
+    profile: str = Query(default=FULL_PROFILE, pattern=PROFILE_PATTERN, description="Профиль Metashape: preview — быстро и грубо, full — полное качество"),
+    two_phase: bool = Query(default=False, description="Сначала preview с AI (доступен сразу), затем full, который его заменяет"),
+    per_photo: bool = Query(default=False, description="YOLO по каждому снимку параллельно Metashape, затем перенос детекций на ортомозаику"),
+) -> Dict[str, Any]:
+    """
+    Ставит обработку сессии в очередь и сразу возвращает ID задачи.
+    Статус — GET /jobs/{job_id}, результат — GET /jobs/{job_id}/result.
+    При two_phase=true предварительный результат доступен по preview_url
+    из статуса, пока считается полный. При per_photo=true детекции отдельных
+    снимков появляются в GET /ai/photos, пока Metashape ещё работает.
+    """
+    _require_session(session_id)
+    if kind == "metashape":
+        _require_data_not_empty(session_id)
+    else:
+        _require_metashape_not_empty(session_id)
+
+    return _submit_job(kind, session_id, render, profile, two_phase, per_photo)
+
+
+@app.get("/jobs")
+def list_jobs(
+    session_id: Optional[int] = Query(default=None, description="Только задачи этой сессии"),
+) -> Dict[str, Any]:
+    return {"jobs": [_job_status(job) for job in jobs.list_jobs(session_id)]}
+
+
+def _require_job(job_id: str) -> Dict[str, Any]:
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Задача {job_id} не найдена")
+    return job
+
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str) -> Dict[str, Any]:
+    """Статус задачи: queued (ждёт слот этапа), running, done, failed или cancelled."""
+    return _job_status(_require_job(job_id))
+
 
-@app.post("/data/upload-and-process-metashape")
+def _job_progress(job_id: str) -> Dict[str, Any]:
+    job = _require_job(job_id)
+    state = progress.read(_get_paths(job["session_id"])["base"])
+    return {
+        **_job_status(job),
+        "progress": state if state is not None and state.get("job_id") == job_id else None,
+    }
+
+
+@app.get("/jobs/{job_id}/progress")
+def get_job_progress(job_id: str) -> Dict[str, Any]:
+    """Статус задачи вместе с прогрессом: шаг, процент, тайлы YOLO и время шагов."""
+    return _job_progress(job_id)
+
+
+@app.get("/jobs/{job_id}/progress/stream")
+def stream_job_progress(job_id: str, request: Request) -> StreamingResponse:
+    """
+    Поток Server-Sent Events с прогрессом задачи; закрывается после её завершения.
+    """
+    _require_job(job_id)
+
+    def snapshot() -> Tuple[Any, Dict[str, Any], bool]:
+        payload = _job_progress(job_id)
+        state = payload["progress"] or {}
+        key = (payload["status"], payload["stage"], state.get("updated"))
+        return key, payload, payload["status"] in jobs.FINISHED
+
+    return _progress_response(request, snapshot)
+
+
+@app.get("/jobs/{job_id}/result", response_model=None)
+def get_job_result(
+    job_id: str,
+    request: Request,
+    variant: str = Query(default=previews.ORIGINAL, pattern=previews.VARIANT_PATTERN, description="original — исходный файл, screen или thumb — уменьшенное превью"),
+) -> Union[Response, Dict[str, Any]]:
+    """Результат завершённой задачи; 409, если она ещё выполняется или отменена."""
+    return _job_result(_require_job(job_id), request, variant)
+
+
+@app.delete("/jobs/{job_id}")
+def cancel_job(job_id: str) -> Dict[str, Any]:
+    """
+    Отмена задачи. Ожидающая задача снимается сразу. У выполняющейся
+    останавливается процесс Metashape, AI-этап доходит до конца.
+    """
+    _require_job(job_id)
+    return _job_status(jobs.cancel(job_id))
+
+
+@app.post("/data/upload-and-process-metashape", response_model=None)
 async def upload_and_process_metashape(
+    request: Request,
     files: List[UploadFile] = File(..., description="Список изображений для обработки Metashape"),
     session_id: Optional[int] = Query(
         default=None,
         description="ID сессии (если не передан — создаётся новая)",
     ),
-) -> FileResponse:
+    render: str = Query(default="server", pattern=RENDER_PATTERN, description="server — картинка с боксами, client — данные для оверлея"),
+    background: bool = Query(default=False, description="Не ждать завершения: вернуть ID задачи"),
+    variant: str = Query(default=previews.ORIGINAL, pattern=previews.VARIANT_PATTERN, description="original — исходный файл, screen или thumb — уменьшенное превью"),
+    profile: str = Query(default=FULL_PROFILE, pattern=PROFILE_PATTERN, description="Профиль Metashape: preview — быстро и грубо, full — полное качество"),
+    two_phase: bool = Query(default=False, description="Сначала preview с AI (доступен сразу), затем full, который его заменяет"),
+    per_photo: bool = Query(default=False, description="YOLO по каждому снимку параллельно Metashape, затем перенос детекций на ортомозаику"),
+) -> Union[Response, Dict[str, Any]]:
     """
     Загружает папку с фотографиями, запускает обработку Metashape,
     затем автоматически обрабатывает результат через AI.
-    Возвращает результат AI обработки.
+    Возвращает результат AI обработки или, при background=true, ID задачи (202).
     """
     if not files:
         raise HTTPException(
@@ -462,30 +1730,78 @@ async def upload_and_process_metashape(
     # Сохраняем файлы в data
     await _save_uploads_to_data(session_id, files)
 
-    # Запускаем Metashape, затем автоматически обрабатываем через AI
-    result_path = process_metashape_and_ai(session_id)
+    # Metashape, затем AI — через очередь задач; ожидание не блокирует цикл событий
+    if background:
+        return _run_job("metashape", session_id, render, background, request, variant, profile, two_phase, per_photo)
+    return await anyio.to_thread.run_sync(
+        _run_job, "metashape", session_id, render, False, request, variant, profile, two_phase, per_photo
+    )
+
+
+def _detect_uploaded(input_path: str, output_path: str, render: str, tracker: progress.Tracker) -> str:
+    """Детекция по загруженному фото; при render=client картинка не рисуется."""
+    try:
+        if render == "client":
+            return detect_ai_image(input_path, output_path, on_progress=_detect_progress(tracker))
+        return process_ai_image(input_path, output_path, on_progress=_detect_progress(tracker))
+    except FileNotFoundError:
+        # Модель не найдена: клиент покажет изображение без оверлеев,
+        # а при render=server результатом считается оригинал
+        if render == "client":
+            return input_path
+        shutil.copy2(input_path, output_path)
+        return output_path
+    except Exception as exc:  # pylint: disable=broad-except
+        raise HTTPException(
+            status_code=500,
+            detail=f"Ошибка обработки AI: {str(exc)}",
+        ) from exc
+
+
+def _process_uploaded_ai(
+    session_id: int,
+    input_path: str,
+    output_path: str,
+    render: str,
+    request: Request,
+    variant: str = previews.ORIGINAL,
+) -> Union[Response, Dict[str, Any]]:
+    """
+    AI по одному загруженному фото. Занимает слот этапа AI,
+    поэтому делит лимит одновременных запусков с очередью задач.
+    """
+    with jobs.stage_slot("ai"):
+        tracker = _tracker(session_id, "ai")
+        try:
+            result_path = _detect_uploaded(input_path, output_path, render, tracker)
+        except HTTPException as exc:
+            tracker.finish(jobs.FAILED, exc.detail)
+            raise
+        tracker.finish(jobs.DONE)
+
+    if render == "client":
+        return _overlay_payload(session_id, input_path, output_path)
 
     if not os.path.isfile(result_path):
         raise HTTPException(
             status_code=500,
-            detail="Обработка не вернула результат",
+            detail="AI не вернул результирующее изображение",
         )
 
-    return FileResponse(
-        result_path,
-        media_type="image/jpeg",
-        filename=os.path.basename(result_path),
-    )
+    return _image_response(request, result_path, variant)
 
 
-@app.post("/data/upload-and-process-ai")
+@app.post("/data/upload-and-process-ai", response_model=None)
 async def upload_and_process_ai(
+    request: Request,
     file: UploadFile = File(..., description="Одно изображение для обработки AI"),
     session_id: Optional[int] = Query(
         default=None,
         description="ID сессии (если не передан — создаётся новая)",
     ),
-) -> FileResponse:
+    render: str = Query(default="server", pattern=RENDER_PATTERN, description="server — картинка с боксами, client — данные для оверлея"),
+    variant: str = Query(default=previews.ORIGINAL, pattern=previews.VARIANT_PATTERN, description="original — исходный файл, screen или thumb — уменьшенное превью"),
+) -> Union[Response, Dict[str, Any]]:
     """
     Загружает одно фото и автоматически обрабатывает его через AI (без Metashape).
     Возвращает результат обработки AI.
@@ -512,37 +1828,13 @@ async def upload_and_process_ai(
     filename = f"uploaded_ai{ext}"
     input_path = os.path.join(ai_dir, filename)
 
-    content = await file.read()
-    with open(input_path, "wb") as f:
-        f.write(content)
-
-    # Обрабатываем через AI
-    base_name = os.path.basename(input_path)
-    name, ext = os.path.splitext(base_name)
-    output_path = os.path.join(ai_dir, f"{name}_processed{ext}")
-
     try:
-        result_path = process_ai_image(input_path, output_path)
-    except FileNotFoundError as exc:
-        # Fallback: если модель не найдена, возвращаем оригинальное изображение
-        # Копируем оригинал как результат
-        shutil.copy2(input_path, output_path)
-        result_path = output_path
-        # Можно также вернуть предупреждение, но для простоты просто возвращаем оригинал
-    except Exception as exc:  # pylint: disable=broad-except
-        raise HTTPException(
-            status_code=500,
-            detail=f"Ошибка обработки AI: {str(exc)}",
-        ) from exc
-
-    if not os.path.isfile(result_path):
-        raise HTTPException(
-            status_code=500,
-            detail="AI не вернул результирующее изображение",
-        )
-
-    return FileResponse(
-        result_path,
-        media_type="image/jpeg",
-        filename=os.path.basename(result_path),
-    )
\ No newline at end of file
+        await ingest.stream_to_file(file, input_path)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+
+    # Обрабатываем через AI в потоке: ожидание слота и инференс не блокируют цикл событий
+    output_path = _ai_output_path(session_id, input_path, suffix="_processed")
+    return await anyio.to_thread.run_sync(
+        _process_uploaded_ai, session_id, input_path, output_path, render, request, variant
+    )
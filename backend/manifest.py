@@ -0,0 +1,232 @@
+import json
+import os
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional
+
+import detection_cache
+import ingest
+
+MANIFEST_NAME = "manifest.sqlite"
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".tif", ".tiff", ".bmp")
+# Папки, для файлов которых считается sha256: входные снимки (дедупликация,
+# хранилище blobs.py). Результаты Metashape и AI — многогигабайтные и
+# пересоздаются, их хеш не нужен.
+HASHED_FOLDERS = ("data",)
+
+# Теги EXIF и GPS IFD
+EXIF_IFD = 0x8769
+GPS_IFD = 0x8825
+TAG_MAKE = 0x010F
+TAG_MODEL = 0x0110
+TAG_DATETIME_ORIGINAL = 0x9003
+TAG_FOCAL_LENGTH = 0x920A
+GPS_LAT_REF, GPS_LAT, GPS_LON_REF, GPS_LON, GPS_ALT_REF, GPS_ALT = 1, 2, 3, 4, 5, 6
+
+_schema_lock = threading.Lock()
+_schema_ready: Dict[str, bool] = {}
+
+
+def _connect(session_dir: str) -> sqlite3.Connection:
+    path = os.path.join(session_dir, MANIFEST_NAME)
+    conn = sqlite3.connect(path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    with _schema_lock:
+        if not _schema_ready.get(path):
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS images ("
+                " folder TEXT NOT NULL,"
+                " name TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " mtime REAL NOT NULL,"
+                " sha256 TEXT,"
+                " format TEXT,"
+                " width INTEGER,"
+                " height INTEGER,"
+                " exif TEXT,"
+                " latitude REAL,"
+                " longitude REAL,"
+                " altitude REAL,"
+                " PRIMARY KEY (folder, name))"
+            )
+            conn.commit()
+            _schema_ready[path] = True
+    return conn
+
+
+def is_image(name: str) -> bool:
+    return os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+
+
+def _rational(value: Any) -> float:
+    if isinstance(value, tuple):
+        return value[0] / value[1] if value[1] else 0.0
+    return float(value)
+
+
+def _degrees(value: Any, ref: Optional[str], negative: str) -> Optional[float]:
+    """Координата EXIF (градусы, минуты, секунды) в десятичные градусы."""
+    try:
+        degrees, minutes, seconds = (_rational(v) for v in value)
+    except (TypeError, ValueError, ZeroDivisionError):
+        return None
+    result = degrees + minutes / 60 + seconds / 3600
+    return -result if ref == negative else result
+
+
+def read_metadata(path: str) -> Dict[str, Any]:
+    """
+    Размер в пикселях и EXIF/GPS из заголовка файла, без декодирования пикселей.
+    Без Pillow возвращаются пустые значения.
+    """
+    metadata: Dict[str, Any] = {
+        "width": None, "height": None, "exif": None,
+        "latitude": None, "longitude": None, "altitude": None,
+    }
+    try:
+        from PIL import Image
+    except ImportError:
+        return metadata
+
+    try:
+        with Image.open(path) as img:
+            metadata["width"], metadata["height"] = img.size
+            exif = img.getexif()
+            details = exif.get_ifd(EXIF_IFD)
+            gps = exif.get_ifd(GPS_IFD)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return metadata
+
+    fields = {
+        "make": exif.get(TAG_MAKE),
+        "model": exif.get(TAG_MODEL),
+        "datetime": details.get(TAG_DATETIME_ORIGINAL),
+        "focal_length": _rational(details[TAG_FOCAL_LENGTH]) if TAG_FOCAL_LENGTH in details else None,
+    }
+    fields = {k: (v.strip("\x00 ") if isinstance(v, str) else v) for k, v in fields.items() if v is not None}
+    metadata["exif"] = fields or None
+
+    if GPS_LAT in gps and GPS_LON in gps:
+        metadata["latitude"] = _degrees(gps[GPS_LAT], gps.get(GPS_LAT_REF), "S")
+        metadata["longitude"] = _degrees(gps[GPS_LON], gps.get(GPS_LON_REF), "W")
+    if GPS_ALT in gps:
+        altitude = _rational(gps[GPS_ALT])
+        metadata["altitude"] = -altitude if gps.get(GPS_ALT_REF) in (1, b"\x01") else altitude
+    return metadata
+
+
+def add(
+    session_dir: str,
+    folder: str,
+    name: str,
+    sha256: Optional[str] = None,
+    fmt: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    Записывает файл в манифест. Хеш и формат, посчитанные при приёме
+    файла, передаются сюда, чтобы не читать файл повторно. Если хеш не
+    передан, он считается только для папок HASHED_FOLDERS.
+    """
+    path = os.path.join(session_dir, folder, name)
+    stat = os.stat(path)
+    if sha256 is None and folder in HASHED_FOLDERS:
+        sha256 = detection_cache.file_hash(path)
+    if fmt is None:
+        with open(path, "rb") as f:
+            fmt = ingest.image_type(f.read(ingest.HEADER_SIZE))
+    metadata = read_metadata(path)
+
+    conn = _connect(session_dir)
+    try:
+        conn.execute(
+            "INSERT OR REPLACE INTO images (folder, name, size, mtime, sha256, format, width, height,"
+            " exif, latitude, longitude, altitude) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                folder, name, stat.st_size, stat.st_mtime, sha256, fmt,
+                metadata["width"], metadata["height"],
+                json.dumps(metadata["exif"], ensure_ascii=False) if metadata["exif"] else None,
+                metadata["latitude"], metadata["longitude"], metadata["altitude"],
+            ),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    return {"folder": folder, "name": name, "size": stat.st_size, "sha256": sha256, "format": fmt, **metadata}
+
+
+def sync(session_dir: str, folder: str) -> None:
+    """
+    Сверяет манифест с папкой: файл перечитывается, если его размер или mtime
+    не совпадают с записью. Так подхватываются файлы, положенные в папку
+    в обход приёма (например, Metashape или съёмкой с дрона) и перезаписанные
+    на месте. Неизменившиеся файлы повторно не читаются.
+    """
+    folder_path = os.path.join(session_dir, folder)
+    if not os.path.isdir(folder_path):
+        return
+
+    conn = _connect(session_dir)
+    try:
+        known = {
+            r["name"]: (r["size"], r["mtime"])
+            for r in conn.execute("SELECT name, size, mtime FROM images WHERE folder = ?", (folder,))
+        }
+    finally:
+        conn.close()
+
+    on_disk = {}
+    for entry in os.scandir(folder_path):
+        if entry.is_file() and is_image(entry.name):
+            stat = entry.stat()
+            on_disk[entry.name] = (stat.st_size, stat.st_mtime)
+
+    for name, marker in on_disk.items():
+        if known.get(name) != marker:
+            add(session_dir, folder, name)
+
+    removed = [(folder, name) for name in known if name not in on_disk]
+    if not removed:
+        return
+    conn = _connect(session_dir)
+    try:
+        conn.executemany("DELETE FROM images WHERE folder = ? AND name = ?", removed)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def entries(session_dir: str, folder: str) -> List[Dict[str, Any]]:
+    """Записи манифеста для папки сессии, отсортированные по имени."""
+    sync(session_dir, folder)
+    conn = _connect(session_dir)
+    try:
+        rows = conn.execute(
+            "SELECT * FROM images WHERE folder = ? ORDER BY name", (folder,)
+        ).fetchall()
+    finally:
+        conn.close()
+
+    result = []
+    for row in rows:
+        entry = dict(row)
+        entry["exif"] = json.loads(entry["exif"]) if entry["exif"] else None
+        result.append(entry)
+    return result
+
+
+def list_images(session_dir: str, folder: str) -> List[str]:
+    """Пути к изображениям папки сессии по манифесту."""
+    return [os.path.join(session_dir, folder, e["name"]) for e in entries(session_dir, folder)]
+
+
+def hashes(session_dir: str) -> List[str]:
+    """sha256 всех файлов манифеста, без сверки с диском."""
+    if not os.path.isfile(os.path.join(session_dir, MANIFEST_NAME)):
+        return []
+    conn = _connect(session_dir)
+    try:
+        rows = conn.execute("SELECT DISTINCT sha256 FROM images WHERE sha256 IS NOT NULL").fetchall()
+    finally:
+        conn.close()
+    return [row["sha256"] for row in rows]
@@ -1,32 +1,324 @@
+import hashlib
+import json
+import logging
 import os
-import sys
-from typing import Optional
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import blockgrid
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_SUFFIX = ".checkpoint.json"
+CAMERAS_SUFFIX = ".cameras.json"
+# Сетка точек снимка (N x N), по которой камера переносится на ортомозаику
+CAMERA_SAMPLES = 5
+PHOTO_EXTENSIONS = (".jpg", ".jpeg", ".tif", ".tiff", ".png")
+
+PREVIEW = "preview"
+FULL = "full"
+# Сколько фотографий берёт быстрый профиль (равномерно по набору)
+DEFAULT_PREVIEW_MAX_PHOTOS = 50
+
+Stages = Tuple[Tuple[str, Dict[str, Any]], ...]
+
+# Шаги пайплайна по порядку и их параметры. Перечисления Metashape
+# записаны именами и подставляются при запуске, чтобы параметры
+# можно было сохранить в контрольную точку.
+FULL_STAGES: Stages = (
+    ("addPhotos", {}),
+    ("matchPhotos", {
+        "keypoint_limit": 40000,
+        "tiepoint_limit": 10000,
+        "generic_preselection": True,
+        "reference_preselection": True,
+    }),
+    ("alignCameras", {}),
+    ("buildDepthMaps", {"downscale": 2, "filter_mode": "MildFiltering"}),
+    ("buildModel", {}),
+    ("buildDem", {"source_data": "DepthMapsData"}),
+    ("buildOrthomosaic", {"surface_data": "ElevationData"}),
+    ("exportRaster", {"source_data": "OrthomosaicData"}),
+)
+# Быстрый предварительный результат: сопоставление на уменьшенных снимках
+# с меньшими лимитами точек, грубые карты глубины и DEM без построения модели
+PREVIEW_STAGES: Stages = (
+    ("addPhotos", {}),
+    ("matchPhotos", {
+        "downscale": 4,
+        "keypoint_limit": 10000,
+        "tiepoint_limit": 2000,
+        "generic_preselection": True,
+        "reference_preselection": True,
+    }),
+    ("alignCameras", {}),
+    ("buildDepthMaps", {"downscale": 8, "filter_mode": "AggressiveFiltering"}),
+    ("buildDem", {"source_data": "DepthMapsData"}),
+    ("buildOrthomosaic", {"surface_data": "ElevationData"}),
+    ("exportRaster", {"source_data": "OrthomosaicData"}),
+)
+PROFILES: Dict[str, Stages] = {PREVIEW: PREVIEW_STAGES, FULL: FULL_STAGES}
+# Параметры со значениями-перечислениями Metashape
+ENUM_PARAMS = ("filter_mode", "source_data", "surface_data")
+# Повторный запуск шага поверх старых результатов
+RERUN_PARAMS: Dict[str, Dict[str, Any]] = {
+    "matchPhotos": {"reset_matches": True},
+    "alignCameras": {"reset_alignment": True},
+}
+
+
+def checkpoint_path(project_path: str) -> str:
+    """Контрольная точка лежит рядом с проектом: project.psx -> project.checkpoint.json."""
+    return os.path.splitext(project_path)[0] + CHECKPOINT_SUFFIX
+
+
+def cameras_path(output_path: str) -> str:
+    """Камеры ортомозаики: orthomosaic.png -> orthomosaic.cameras.json."""
+    return os.path.splitext(output_path)[0] + CAMERAS_SUFFIX
+
+
+def write_cameras(output_path: str, cameras: List[Dict[str, Any]]) -> None:
+    """
+    Сохраняет для каждого выровненного снимка соответствия точек:
+    points — [u, v, x, y], где (u, v) — пиксель снимка, (x, y) — пиксель ортомозаики.
+    """
+    path = cameras_path(output_path)
+    tmp_path = path + ".part"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"cameras": cameras}, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def find_photos(folder: str) -> List[str]:
+    """Находит фотографии в папке."""
+    if not os.path.isdir(folder):
+        return []
+    return [
+        entry.path
+        for entry in os.scandir(folder)
+        if (entry.is_file() and os.path.splitext(entry.name)[1].lower() in PHOTO_EXTENSIONS)
+    ]
+
+
+def _preview_max_photos() -> int:
+    return max(1, int(os.getenv("METASHAPE_PREVIEW_MAX_PHOTOS", DEFAULT_PREVIEW_MAX_PHOTOS)))
+
+
+def select_photos(photos: List[str], profile: str) -> List[str]:
+    """
+    Фотографии для профиля. Быстрый профиль берёт не больше
+    METASHAPE_PREVIEW_MAX_PHOTOS снимков, равномерно по порядку съёмки,
+    чтобы покрыть всю площадь.
+    """
+    photos = sorted(photos)
+    if profile != PREVIEW or len(photos) <= _preview_max_photos():
+        return photos
+    limit = _preview_max_photos()
+    step = len(photos) / limit
+    return [photos[int(i * step)] for i in range(limit)]
+
+
+def stages_for(profile: str) -> Stages:
+    if profile not in PROFILES:
+        raise ValueError(f"Неизвестный профиль обработки: {profile}")
+    return PROFILES[profile]
+
+
+def _photos_hash(photos: List[str]) -> str:
+    """Отпечаток набора фотографий по именам, размерам и времени изменения (без чтения файлов)."""
+    digest = hashlib.sha256()
+    for path in sorted(photos):
+        stat = os.stat(path)
+        digest.update(f"{os.path.basename(path)}\0{stat.st_size}\0{stat.st_mtime}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _fingerprints(photos: List[str], output_path: str, stages: Stages) -> List[str]:
+    """
+    Отпечаток каждого шага: параметры шага и отпечаток предыдущего. Так смена
+    набора фотографий или параметров шага сбрасывает его и все следующие шаги.
+    """
+    fingerprints = []
+    previous = _photos_hash(photos)
+    for name, params in stages:
+        payload = {"previous": previous, "stage": name, "params": params}
+        if name == "exportRaster":
+            payload["output"] = os.path.abspath(output_path)
+            payload["export"] = blockgrid.export_mode()
+            if payload["export"] == blockgrid.BLOCKS:
+                payload["block_px"] = blockgrid.block_px()
+        previous = hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+        fingerprints.append(previous)
+    return fingerprints
+
+
+def _read_checkpoint(path: str) -> List[Dict[str, Any]]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)["stages"]
+    except (FileNotFoundError, ValueError, KeyError):
+        return []
+
+
+def _write_checkpoint(path: str, stages: List[Dict[str, Any]]) -> None:
+    tmp_path = path + ".part"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"stages": stages}, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _exported(output_path: str) -> str:
+    """
+    Результат экспорта: файл ортомозаики или, в режиме METASHAPE_EXPORT=blocks,
+    папка сетки блоков (см. blockgrid.py).
+    """
+    if blockgrid.export_mode() == blockgrid.BLOCKS:
+        return blockgrid.grid_dir(output_path)
+    return output_path
+
+
+def _is_exported(output_path: str) -> bool:
+    if blockgrid.export_mode() == blockgrid.BLOCKS:
+        return blockgrid.is_done(blockgrid.grid_dir(output_path))
+    return os.path.isfile(output_path)
+
+
+def _export_blocks(Metashape: Any, chunk: Any, output_path: str, kwargs: Dict[str, Any]) -> None:
+    """
+    Экспорт ортомозаики сеткой блоков METASHAPE_BLOCK_PX. Каждый блок
+    выгружается отдельным exportRaster по своей области и сразу переименовывается
+    в итоговое имя, поэтому читатель может брать его, не дожидаясь остальных.
+    Встроенный split_in_blocks не используется: имена и порядок его блоков
+    не описаны в API, а читателю нужна известная заранее геометрия.
+    """
+    ortho = chunk.orthomosaic
+    directory = blockgrid.grid_dir(output_path)
+    grid = blockgrid.start(directory, ortho.width, ortho.height, blockgrid.block_px())
+    report = kwargs.pop("progress", None)
+    blocks = list(blockgrid.iter_blocks(grid))
+    for index, (row, col, x1, y1, x2, y2) in enumerate(blocks):
+        region = Metashape.BBox(
+            Metashape.Vector([ortho.left + x1 * ortho.resolution, ortho.top - y2 * ortho.resolution]),
+            Metashape.Vector([ortho.left + x2 * ortho.resolution, ortho.top - y1 * ortho.resolution]),
+        )
+        path = blockgrid.block_path(directory, row, col)
+        part = blockgrid.part_path(path)
+        chunk.exportRaster(part, region=region, resolution=ortho.resolution, **kwargs)
+        os.replace(part, path)
+        if report is not None:
+            report(100.0 * (index + 1) / len(blocks))
+    blockgrid.finish(directory)
+
+
+def _camera_points(Metashape: Any, chunk: Any, camera: Any, surface: Any) -> List[List[float]]:
+    """
+    Лучи из сетки CAMERA_SAMPLES x CAMERA_SAMPLES точек снимка пересекаются
+    с поверхностью и переводятся в пиксели ортомозаики. Точки, чей луч
+    не попал в поверхность, пропускаются.
+    """
+    ortho = chunk.orthomosaic
+    width, height = camera.sensor.width, camera.sensor.height
+    points = []
+    for i in range(CAMERA_SAMPLES):
+        for j in range(CAMERA_SAMPLES):
+            u = width * i / (CAMERA_SAMPLES - 1)
+            v = height * j / (CAMERA_SAMPLES - 1)
+            hit = surface.pickPoint(camera.center, camera.unproject(Metashape.Vector([u, v])))
+            if hit is None:
+                continue
+            world = chunk.crs.project(chunk.transform.matrix.mul(hit))
+            points.append([
+                u,
+                v,
+                (world.x - ortho.left) / ortho.resolution,
+                (ortho.top - world.y) / ortho.resolution,
+            ])
+    return points
+
+
+def _export_cameras(Metashape: Any, chunk: Any, output_path: str) -> None:
+    """
+    Выравнивание камер в виде, пригодном без Metashape: по этим точкам сервер
+    переносит детекции отдельных снимков на ортомозаику (см. projection.py).
+    Поверхность — модель, а в быстром профиле без модели — связующие точки.
+    """
+    surface = chunk.model or getattr(chunk, "tie_points", None) or chunk.point_cloud
+    cameras = []
+    for camera in chunk.cameras:
+        if camera.transform is None:
+            continue
+        cameras.append({
+            "photo": os.path.basename(camera.photo.path),
+            "width": camera.sensor.width,
+            "height": camera.sensor.height,
+            "points": _camera_points(Metashape, chunk, camera, surface),
+        })
+    write_cameras(output_path, cameras)
+
+
+def resume_point(
+    project_path: str,
+    output_path: str,
+    photos: List[str],
+    profile: str = FULL,
+) -> Tuple[int, List[Dict[str, Any]]]:
+    """
+    С какого шага продолжать: номер первого шага, который не выполнен или чей
+    отпечаток не совпадает, и записи выполненных шагов до него. Без проекта
+    на диске начинаем с нуля, без файла ортомозаики (или незаконченной сетки
+    блоков) повторяем экспорт.
+    """
+    stages = stages_for(profile)
+    if not os.path.isfile(project_path):
+        return 0, []
+    done = _read_checkpoint(checkpoint_path(project_path))
+    fingerprints = _fingerprints(photos, output_path, stages)
+    start = 0
+    while (
+        start < len(stages)
+        and start < len(done)
+        and done[start].get("stage") == stages[start][0]
+        and done[start].get("fingerprint") == fingerprints[start]
+    ):
+        start += 1
+    if start == len(stages) and not _is_exported(output_path):
+        start -= 1
+    return start, done[:start]
 
 
 def process_metashape(
     photos_folder: str,
     output_path: str,
     project_path: Optional[str] = None,
+    photos: Optional[List[str]] = None,
+    progress: Optional[Callable[[str, float], None]] = None,
+    resume: bool = True,
+    profile: str = FULL,
 ) -> str:
     """
     Обрабатывает фотографии через Metashape и создаёт ортомозаику.
+
+    После каждого шага проект сохраняется, а шаг с отпечатком входных данных
+    записывается в контрольную точку рядом с проектом. После экспорта рядом
+    с ортомозаикой сохраняются камеры (cameras_path). Повторный запуск
+    (после падения, таймаута или перезапуска сервера) открывает сохранённый
+    проект и продолжает с первого невыполненного или изменившегося шага.
     
     Args:
         photos_folder: Папка с входными фотографиями
         output_path: Путь для сохранения ортомозаики (например, mosaic.png)
         project_path: Путь к файлу проекта Metashape (опционально)
+        photos: Готовый список фотографий (например, из манифеста сессии);
+            если не задан, папка photos_folder сканируется
+        progress: Колбэк (шаг, процент 0..100), например matchPhotos, 37.5
+        resume: Продолжать с контрольной точки; False — обработать заново
+        profile: Профиль параметров: full — полное качество, preview —
+            быстрый предварительный результат по части снимков
     
     Returns:
-        Путь к созданной ортомозаике
+        Путь к созданной ортомозаике, а при METASHAPE_EXPORT=blocks —
+        к папке с сеткой её блоков
     """
-    try:
-        import Metashape
-    except ImportError:
-        raise ImportError(
-            "Модуль Metashape не установлен. "
-            "Установите Agisoft Metashape и его Python API."
-        )
-
     # Создаём папку для вывода, если её нет
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
 
@@ -35,66 +327,88 @@ def process_metashape(
         project_dir = os.path.dirname(output_path)
         project_path = os.path.join(project_dir, "metashape_project.psx")
 
-    def find_files(folder: str, types: list) -> list:
-        """Находит файлы указанных типов в папке."""
-        if not os.path.isdir(folder):
-            return []
-        return [
-            entry.path
-            for entry in os.scandir(folder)
-            if (entry.is_file() and os.path.splitext(entry.name)[1].lower() in types)
-        ]
-
-    # Создаём проект и чанк
-    doc = Metashape.Document()
-    doc.save(path=project_path)
-    chunk = doc.addChunk()
-
-    # Импортируем фотографии
-    photos = find_files(photos_folder, [".jpg", ".jpeg", ".tif", ".tiff", ".png"])
+    stages = stages_for(profile)
+    if photos is None:
+        photos = find_photos(photos_folder)
     if not photos:
         raise ValueError(f"В папке {photos_folder} не найдено фотографий")
+    photos = select_photos(photos, profile)
 
-    chunk.addPhotos(photos)
-    doc.save()
+    checkpoint = checkpoint_path(project_path)
+    start, done = resume_point(project_path, output_path, photos, profile) if resume else (0, [])
+    if start == len(stages) and os.path.isfile(cameras_path(output_path)):
+        logger.info("Metashape: все шаги уже выполнены, ортомозаика %s актуальна", output_path)
+        return _exported(output_path)
 
-    # Сопоставление фотографий
-    chunk.matchPhotos(
-        keypoint_limit=40000,
-        tiepoint_limit=10000,
-        generic_preselection=True,
-        reference_preselection=True,
-    )
-    doc.save()
+    try:
+        import Metashape
+    except ImportError:
+        raise ImportError(
+            "Модуль Metashape не установлен. "
+            "Установите Agisoft Metashape и его Python API."
+        )
 
-    # Выравнивание камер
-    chunk.alignCameras()
-    doc.save()
+    def step_progress(step: str) -> Optional[Callable[[float], None]]:
+        """Колбэк прогресса Metashape для шага step."""
+        if progress is None:
+            return None
+        progress(step, 0.0)
+        return lambda percent: progress(step, percent)
 
-    # Построение карт глубины
-    chunk.buildDepthMaps(downscale=2, filter_mode=Metashape.MildFiltering)
-    doc.save()
+    doc = Metashape.Document()
+    if start == 0:
+        # Создаём проект и чанк
+        doc.save(path=project_path)
+        chunk = doc.addChunk()
+    else:
+        # Продолжаем сохранённый проект; блокировка могла остаться от упавшего процесса
+        doc.open(project_path, ignore_lock=True)
+        chunk = doc.chunk
+        if start < len(stages):
+            logger.info("Metashape: продолжаем %s с шага %s", project_path, stages[start][0])
+        else:
+            logger.info("Metashape: шаги %s выполнены, сохраняем только камеры", project_path)
 
-    # Построение модели
-    chunk.buildModel()
-    doc.save()
+    fingerprints = _fingerprints(photos, output_path, stages)
+    _write_checkpoint(checkpoint, done)
 
-    # Построение DEM
-    chunk.buildDem(source_data=Metashape.DepthMapsData)
-    doc.save()
+    for index in range(start, len(stages)):
+        name, params = stages[index]
+        kwargs = {
+            key: getattr(Metashape, value) if key in ENUM_PARAMS else value
+            for key, value in params.items()
+        }
+        if start > 0:
+            # В открытом проекте могут остаться результаты прошлого запуска
+            kwargs.update(RERUN_PARAMS.get(name, {}))
+        kwargs["progress"] = step_progress(name)
 
-    # Построение ортомозаики
-    chunk.buildOrthomosaic(surface_data=Metashape.ElevationData)
-    doc.save()
+        started = time.time()
+        if name == "addPhotos":
+            chunk.addPhotos(photos, **kwargs)
+        elif name == "exportRaster" and blockgrid.export_mode() == blockgrid.BLOCKS:
+            _export_blocks(Metashape, chunk, output_path, kwargs)
+        elif name == "exportRaster":
+            chunk.exportRaster(output_path, **kwargs)
+        else:
+            getattr(chunk, name)(**kwargs)
+        doc.save()
 
-    # Экспорт ортомозаики
-    chunk.exportRaster(output_path, source_data=Metashape.OrthomosaicData)
-    doc.save()
+        done.append({
+            "stage": name,
+            "fingerprint": fingerprints[index],
+            "finished": time.time(),
+            "elapsed": time.time() - started,
+        })
+        _write_checkpoint(checkpoint, done)
+
+    # Камеры пишутся и тогда, когда все шаги уже были выполнены, а файла камер нет
+    _export_cameras(Metashape, chunk, output_path)
 
     # Закрываем Metashape (опционально, можно закомментировать для отладки)
     # Metashape.app.quit()
 
-    return output_path
+    return _exported(output_path)
 
 
 def proccess_metashape():
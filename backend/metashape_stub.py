@@ -0,0 +1,181 @@
+import json
+import math
+import os
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import cv2
+import numpy as np
+
+import blockgrid
+import metashape
+
+# Наибольшая сторона снимка в синтетической ортомозаике, пиксели
+DEFAULT_CELL_PX = 1024
+# Сколько длится каждый шаг заглушки, с (для нагрузочных прогонов)
+DEFAULT_STEP_SEC = 0.0
+ENGINE = "stub"
+
+
+def _cell_px() -> int:
+    return max(1, int(os.getenv("METASHAPE_STUB_CELL_PX", DEFAULT_CELL_PX)))
+
+
+def _step_sec() -> float:
+    return max(0.0, float(os.getenv("METASHAPE_STUB_STEP_SEC", DEFAULT_STEP_SEC)))
+
+
+def _fit(image: np.ndarray, cell: int) -> np.ndarray:
+    scale = min(1.0, cell / max(image.shape[:2]))
+    if scale == 1.0:
+        return image
+    size = (max(1, round(image.shape[1] * scale)), max(1, round(image.shape[0] * scale)))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+
+def _compose(
+    photos: List[str],
+    report: Callable[[float], None],
+) -> Dict[str, Any]:
+    """
+    Синтетическая ортомозаика: снимки, уменьшенные до METASHAPE_STUB_CELL_PX,
+    выложены сеткой по порядку съёмки. Возвращает картинку и раскладку —
+    где в мозаике лежит каждый снимок и с каким масштабом.
+    """
+    cell = _cell_px()
+    columns = math.ceil(math.sqrt(len(photos)))
+    rows = math.ceil(len(photos) / columns)
+    mosaic = np.zeros((rows * cell, columns * cell, 3), dtype=np.uint8)
+    cameras = []
+    for index, path in enumerate(photos):
+        image = cv2.imread(path, cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError(f"Не удалось прочитать снимок: {path}")
+        fitted = _fit(image, cell)
+        x, y = (index % columns) * cell, (index // columns) * cell
+        mosaic[y:y + fitted.shape[0], x:x + fitted.shape[1]] = fitted
+        cameras.append({
+            "photo": os.path.basename(path),
+            "x": x,
+            "y": y,
+            "width": fitted.shape[1],
+            "height": fitted.shape[0],
+            "scale": fitted.shape[1] / image.shape[1],
+        })
+        report(100.0 * (index + 1) / len(photos))
+    return {"image": mosaic, "cameras": cameras}
+
+
+def _write_image(path: str, image: np.ndarray) -> None:
+    ok, encoded = cv2.imencode(os.path.splitext(path)[1] or ".png", image)
+    if not ok:
+        raise ValueError(f"Не удалось закодировать ортомозаику: {path}")
+    tmp_path = path + ".part"
+    with open(tmp_path, "wb") as f:
+        f.write(encoded.tobytes())
+    os.replace(tmp_path, path)
+
+
+def _camera_points(camera: Dict[str, Any]) -> List[List[float]]:
+    """Углы снимка и их место в сетке: заглушка переносит снимок масштабом и сдвигом."""
+    width = camera["width"] / camera["scale"]
+    height = camera["height"] / camera["scale"]
+    x, y = camera["x"], camera["y"]
+    return [
+        [0.0, 0.0, x, y],
+        [width, 0.0, x + camera["width"], y],
+        [width, height, x + camera["width"], y + camera["height"]],
+        [0.0, height, x, y + camera["height"]],
+    ]
+
+
+def _write_blocks(output_path: str, image: np.ndarray, report: Callable[[float], None]) -> str:
+    """Экспорт сеткой блоков, как у настоящего движка; шаг растягивается на все блоки."""
+    directory = blockgrid.grid_dir(output_path)
+    grid = blockgrid.start(directory, image.shape[1], image.shape[0], blockgrid.block_px())
+    blocks = list(blockgrid.iter_blocks(grid))
+    for index, (row, col, x1, y1, x2, y2) in enumerate(blocks):
+        time.sleep(_step_sec() / len(blocks))
+        path = blockgrid.block_path(directory, row, col)
+        _write_image(path, image[y1:y2, x1:x2])
+        report(100.0 * (index + 1) / len(blocks))
+    blockgrid.finish(directory)
+    return directory
+
+
+def process_metashape(
+    photos_folder: str,
+    output_path: str,
+    project_path: Optional[str] = None,
+    photos: Optional[List[str]] = None,
+    progress: Optional[Callable[[str, float], None]] = None,
+    resume: bool = True,
+    profile: str = metashape.FULL,
+) -> str:
+    """
+    Заглушка движка Metashape с тем же интерфейсом, что и metashape.process_metashape.
+    Проходит те же шаги профиля с прогрессом, но вместо фотограмметрии
+    выкладывает снимки сеткой. Вместо проекта Metashape пишет в project_path
+    раскладку снимков (JSON), а камеры (metashape.cameras_path) — по этой
+    раскладке. Не требует лицензии Metashape и подходит для
+    проверки всего пайплайна загрузка → Metashape → AI. resume не используется:
+    заглушка всегда считает заново. При METASHAPE_EXPORT=blocks пишет сетку
+    блоков и возвращает её папку.
+    """
+    stages = metashape.stages_for(profile)
+    if photos is None:
+        photos = metashape.find_photos(photos_folder)
+    if not photos:
+        raise ValueError(f"В папке {photos_folder} не найдено фотографий")
+    photos = metashape.select_photos(photos, profile)
+
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    if project_path is None:
+        project_path = os.path.join(os.path.dirname(output_path), "metashape_project.psx")
+
+    def report(step: str) -> Callable[[float], None]:
+        if progress is None:
+            return lambda percent: None
+        progress(step, 0.0)
+        return lambda percent: progress(step, percent)
+
+    blocks = blockgrid.export_mode() == blockgrid.BLOCKS
+    composed: Dict[str, Any] = {}
+    result = output_path
+    for name, _ in stages:
+        step_report = report(name)
+        if name == "exportRaster" and blocks:
+            result = _write_blocks(output_path, composed["image"], step_report)
+            continue
+        time.sleep(_step_sec())
+        if name == "buildOrthomosaic":
+            composed = _compose(photos, step_report)
+        elif name == "exportRaster":
+            _write_image(output_path, composed["image"])
+        step_report(100.0)
+
+    layout = {
+        "engine": ENGINE,
+        "profile": profile,
+        "orthomosaic": os.path.basename(blockgrid.raster_path(output_path) if blocks else output_path),
+        "width": composed["image"].shape[1],
+        "height": composed["image"].shape[0],
+        "cameras": composed["cameras"],
+    }
+    with open(project_path, "w", encoding="utf-8") as f:
+        json.dump(layout, f, ensure_ascii=False, indent=2)
+    metashape.write_cameras(output_path, [
+        {
+            "photo": camera["photo"],
+            "width": round(camera["width"] / camera["scale"]),
+            "height": round(camera["height"] / camera["scale"]),
+            "points": _camera_points(camera),
+        }
+        for camera in composed["cameras"]
+    ])
+    # Контрольная точка настоящего Metashape к этому «проекту» не относится
+    try:
+        os.remove(metashape.checkpoint_path(project_path))
+    except FileNotFoundError:
+        pass
+    return result
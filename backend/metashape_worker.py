@@ -0,0 +1,276 @@
+import json
+import logging
+import os
+import queue
+import signal
+import subprocess
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+ENGINES = ("metashape", "stub")
+DEFAULT_ENGINE = "metashape"
+# Предельное время одного запуска, минуты (0 — без ограничения)
+DEFAULT_TIMEOUT_MIN = 0.0
+# Предел адресного пространства процесса, ГБ (0 — без ограничения)
+DEFAULT_MEMORY_LIMIT_GB = 0.0
+# Понижение приоритета процесса, чтобы Metashape не отнимал процессор у API
+DEFAULT_NICE = 10
+LOG_NAME = "metashape.log"
+# Как часто проверяется таймаут, с
+POLL_INTERVAL = 1.0
+# Сколько ждать завершения после SIGTERM, прежде чем убить процесс, с
+TERMINATE_GRACE = 5.0
+# Прогресс шага передаётся, только если изменился хотя бы на столько процентов
+PROGRESS_STEP = 0.5
+# Ошибки, которые пробрасываются в процесс API с тем же типом
+ERROR_TYPES = {
+    "ImportError": ImportError,
+    "ModuleNotFoundError": ImportError,
+    "ValueError": ValueError,
+    "FileNotFoundError": FileNotFoundError,
+    "MemoryError": MemoryError,
+}
+
+_running: Dict[int, subprocess.Popen] = {}
+_running_lock = threading.Lock()
+
+
+class CancelledError(RuntimeError):
+    """Запуск остановлен по запросу отмены."""
+
+
+def engine() -> str:
+    """Движок из METASHAPE_ENGINE: metashape — настоящий, stub — заглушка без лицензии."""
+    name = os.getenv("METASHAPE_ENGINE", DEFAULT_ENGINE).lower()
+    if name not in ENGINES:
+        raise ValueError(f"Неизвестный движок Metashape: {name}")
+    return name
+
+
+def _timeout() -> Optional[float]:
+    minutes = max(0.0, float(os.getenv("METASHAPE_TIMEOUT_MIN", DEFAULT_TIMEOUT_MIN)))
+    return minutes * 60 or None
+
+
+def _limits() -> Dict[str, int]:
+    memory_gb = max(0.0, float(os.getenv("METASHAPE_MEMORY_LIMIT_GB", DEFAULT_MEMORY_LIMIT_GB)))
+    return {
+        "memory_bytes": int(memory_gb * 1024 ** 3),
+        "nice": int(os.getenv("METASHAPE_NICE", DEFAULT_NICE)),
+    }
+
+
+def _python() -> str:
+    """Интерпретатор для процесса: METASHAPE_PYTHON (например, Python из поставки Metashape) или текущий."""
+    return os.getenv("METASHAPE_PYTHON") or sys.executable
+
+
+def _terminate(proc: subprocess.Popen) -> None:
+    """Останавливает процесс вместе с его дочерними: сначала SIGTERM, потом SIGKILL."""
+    if proc.poll() is not None:
+        return
+    if os.name == "posix":
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)
+            proc.wait(TERMINATE_GRACE)
+        except subprocess.TimeoutExpired:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    else:
+        proc.kill()
+    proc.wait()
+
+
+def _read_events(proc: subprocess.Popen, events: "queue.Queue[Optional[bytes]]") -> None:
+    for line in proc.stdout:
+        events.put(line)
+    events.put(None)
+
+
+def _log_tail(path: str, limit: int = 2000) -> str:
+    try:
+        with open(path, "rb") as f:
+            f.seek(max(0, os.path.getsize(path) - limit))
+            return f.read().decode("utf-8", "replace").strip()
+    except OSError:
+        return ""
+
+
+def run(
+    photos_folder: str,
+    output_path: str,
+    project_path: Optional[str] = None,
+    photos: Optional[List[str]] = None,
+    progress: Optional[Callable[[str, float], None]] = None,
+    resume: bool = True,
+    profile: str = "full",
+    cancelled: Optional[Callable[[], bool]] = None,
+) -> str:
+    """
+    То же, что metashape.process_metashape, но в отдельном процессе с лимитами
+    (METASHAPE_MEMORY_LIMIT_GB, METASHAPE_NICE) и таймаутом (METASHAPE_TIMEOUT_MIN).
+    Задание передаётся процессу JSON-ом в stdin, прогресс и итог приходят из его
+    stdout по одному JSON в строке. Падение, зависание или нехватка памяти
+    в Metashape не затрагивают сервер. Вывод движка пишется в metashape.log
+    рядом с ортомозаикой. Если cancelled (проверяется раз в POLL_INTERVAL)
+    вернёт True, процесс останавливается и поднимается CancelledError.
+    """
+    request = {
+        "engine": engine(),
+        "limits": _limits(),
+        "photos_folder": photos_folder,
+        "output_path": output_path,
+        "project_path": project_path,
+        "photos": photos,
+        "resume": resume,
+        "profile": profile,
+    }
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    log_path = os.path.join(os.path.dirname(output_path), LOG_NAME)
+    timeout = _timeout()
+
+    with open(log_path, "ab") as log:
+        proc = subprocess.Popen(
+            [_python(), os.path.abspath(__file__)],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=log,
+            # Своя группа процессов: при таймауте убиваются и дочерние процессы Metashape
+            start_new_session=os.name == "posix",
+        )
+    with _running_lock:
+        _running[proc.pid] = proc
+
+    try:
+        try:
+            proc.stdin.write(json.dumps(request).encode("utf-8"))
+            proc.stdin.close()
+        except BrokenPipeError:
+            # Процесс умер, не успев прочитать задание (например, не запустился интерпретатор)
+            code = proc.wait()
+            details = _log_tail(log_path)
+            raise RuntimeError(
+                f"Процесс Metashape завершился с кодом {code} до получения задания"
+                + (f": {details}" if details else "")
+            ) from None
+
+        events: "queue.Queue[Optional[bytes]]" = queue.Queue()
+        threading.Thread(target=_read_events, args=(proc, events), daemon=True).start()
+        deadline = time.monotonic() + timeout if timeout else None
+        next_cancel_check = time.monotonic()
+        outcome: Optional[Dict[str, Any]] = None
+        while True:
+            if cancelled is not None and time.monotonic() >= next_cancel_check:
+                next_cancel_check = time.monotonic() + POLL_INTERVAL
+                if cancelled():
+                    logger.info("Обработка Metashape (pid %d) отменена, останавливаем", proc.pid)
+                    _terminate(proc)
+                    raise CancelledError("Обработка Metashape отменена")
+            # Таймаут проверяется на каждой итерации: прогресс может идти чаще POLL_INTERVAL
+            if deadline is not None and time.monotonic() >= deadline:
+                logger.warning("Metashape (pid %d) превысил METASHAPE_TIMEOUT_MIN, останавливаем", proc.pid)
+                _terminate(proc)
+                raise TimeoutError(
+                    f"Metashape не уложился в {timeout / 60:g} мин и был остановлен"
+                )
+            try:
+                line = events.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            if line is None:
+                break
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue
+            if message["event"] == "progress":
+                if progress is not None:
+                    progress(message["step"], message["percent"])
+            else:
+                outcome = message
+
+        code = proc.wait()
+    finally:
+        _terminate(proc)
+        with _running_lock:
+            _running.pop(proc.pid, None)
+
+    if outcome is not None and outcome["event"] == "done":
+        return outcome["result"]
+    if outcome is not None and outcome["event"] == "error":
+        raise ERROR_TYPES.get(outcome["type"], RuntimeError)(outcome["message"])
+    details = _log_tail(log_path)
+    raise RuntimeError(
+        f"Процесс Metashape завершился с кодом {code}" + (f": {details}" if details else "")
+    )
+
+
+def stop_all() -> None:
+    """Останавливает все запущенные процессы (при остановке сервера)."""
+    with _running_lock:
+        running = list(_running.values())
+    for proc in running:
+        _terminate(proc)
+
+
+# ============================ ПРОЦЕСС-ИСПОЛНИТЕЛЬ ============================
+
+
+def _apply_limits(limits: Dict[str, int]) -> None:
+    if limits["nice"] and hasattr(os, "nice"):
+        os.nice(limits["nice"])
+    if limits["memory_bytes"] > 0:
+        try:
+            import resource
+        except ImportError:
+            return
+        resource.setrlimit(resource.RLIMIT_AS, (limits["memory_bytes"], limits["memory_bytes"]))
+
+
+def _engine_fn(name: str) -> Callable[..., str]:
+    if name == "stub":
+        from metashape_stub import process_metashape
+    else:
+        from metashape import process_metashape
+    return process_metashape
+
+
+def main() -> int:
+    request = json.load(sys.stdin)
+    # Канал событий — исходный stdout; всё, что печатают Metashape и библиотеки, уходит в лог
+    events = os.fdopen(os.dup(sys.stdout.fileno()), "w", encoding="utf-8")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    def emit(message: Dict[str, Any]) -> None:
+        events.write(json.dumps(message, ensure_ascii=False) + "\n")
+        events.flush()
+
+    reported: Dict[str, float] = {}
+
+    def progress(step: str, percent: float) -> None:
+        last = reported.get(step)
+        if last is not None and abs(percent - last) < PROGRESS_STEP and percent < 100:
+            return
+        reported[step] = percent
+        emit({"event": "progress", "step": step, "percent": percent})
+
+    try:
+        _apply_limits(request.pop("limits"))
+        process = _engine_fn(request.pop("engine"))
+        result = process(progress=progress, **request)
+    except Exception as exc:  # pylint: disable=broad-except
+        logging.getLogger("metashape").exception("Ошибка обработки Metashape")
+        emit({"event": "error", "type": type(exc).__name__, "message": str(exc)})
+        return 1
+    emit({"event": "done", "result": result})
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -0,0 +1,136 @@
+import os
+import threading
+from typing import Dict, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from raster import BAND_ROWS, RawRaster, ensure_raw, read_image_size, resolve_streaming
+
+PREVIEWS_SUFFIX = ".previews"
+ORIGINAL = "original"
+# Варианты превью и наибольшая сторона по умолчанию, пиксели
+DEFAULT_SIZES: Dict[str, int] = {"thumb": 256, "screen": 2048}
+VARIANT_PATTERN = "^(original|thumb|screen)$"
+DEFAULT_FORMAT = "webp"
+FORMATS = {"webp": "image/webp", "jpg": "image/jpeg"}
+DEFAULT_QUALITY = 80
+
+_locks_guard = threading.Lock()
+_locks: Dict[str, threading.Lock] = {}
+
+
+def variant_size(variant: str) -> int:
+    return max(1, int(os.getenv(f"PREVIEW_{variant.upper()}_PX", DEFAULT_SIZES[variant])))
+
+
+def preview_format() -> str:
+    fmt = os.getenv("PREVIEW_FORMAT", DEFAULT_FORMAT).lower()
+    if fmt not in FORMATS:
+        raise ValueError(f"Неизвестный формат превью: {fmt}")
+    return fmt
+
+
+def _quality() -> int:
+    return min(100, max(1, int(os.getenv("PREVIEW_QUALITY", DEFAULT_QUALITY))))
+
+
+def media_type(fmt: str) -> str:
+    return FORMATS[fmt]
+
+
+def preview_path(image_path: str, variant: str, fmt: Optional[str] = None) -> str:
+    """Превью лежат рядом с исходником в папке <имя>.previews."""
+    return os.path.join(image_path + PREVIEWS_SUFFIX, f"{variant}.{fmt or preview_format()}")
+
+
+def _is_fresh(path: str, image_path: str) -> bool:
+    return os.path.isfile(path) and os.path.getmtime(path) >= os.path.getmtime(image_path)
+
+
+def _lock_for(path: str) -> threading.Lock:
+    with _locks_guard:
+        return _locks.setdefault(path, threading.Lock())
+
+
+def _target_size(width: int, height: int, max_side: int) -> Tuple[int, int]:
+    scale = min(1.0, max_side / max(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def _reduced_flag(image_path: str, max_side: int) -> int:
+    """
+    Флаг cv2.imread с уменьшением при декодировании (для JPEG — без распаковки
+    полного разрешения). Берём наибольшее уменьшение, после которого
+    сторона ещё не меньше нужной.
+    """
+    size = read_image_size(image_path)
+    if size is not None:
+        longest = max(size)
+        for factor, flag in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)):
+            if longest // factor >= max_side:
+                return flag
+    return cv2.IMREAD_COLOR
+
+
+def _render_in_memory(image_path: str, max_side: int) -> np.ndarray:
+    image = cv2.imread(image_path, _reduced_flag(image_path, max_side))
+    if image is None:
+        raise ValueError(f"Не удалось прочитать изображение: {image_path}")
+    width, height = _target_size(image.shape[1], image.shape[0], max_side)
+    if (width, height) == (image.shape[1], image.shape[0]):
+        return image
+    return cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+
+
+def _render_streaming(image_path: str, max_side: int) -> np.ndarray:
+    """Большие растры уменьшаются полосами строк из несжатой копии."""
+    source = RawRaster(ensure_raw(image_path))
+    width, height = _target_size(source.width, source.height, max_side)
+    scale = height / source.height
+    out = np.empty((height, width, 3), dtype=np.uint8)
+    for y in range(0, source.height, BAND_ROWS):
+        y2 = min(y + BAND_ROWS, source.height)
+        out_y1, out_y2 = round(y * scale), round(y2 * scale)
+        if out_y2 > out_y1:
+            band = source.read_window(0, y, source.width, y2)
+            out[out_y1:out_y2] = cv2.resize(band, (width, out_y2 - out_y1), interpolation=cv2.INTER_AREA)
+    return out
+
+
+def build(image_path: str, variant: str) -> str:
+    """
+    Возвращает путь к превью, создавая его один раз на артефакт
+    (пересоздаётся, если исходник новее). Изображение не увеличивается.
+    """
+    if variant not in DEFAULT_SIZES:
+        raise ValueError(f"Неизвестный вариант превью: {variant}")
+    fmt = preview_format()
+    path = preview_path(image_path, variant, fmt)
+    if _is_fresh(path, image_path):
+        return path
+
+    with _lock_for(path):
+        if _is_fresh(path, image_path):
+            return path
+
+        max_side = variant_size(variant)
+        if resolve_streaming(image_path):
+            image = _render_streaming(image_path, max_side)
+        else:
+            image = _render_in_memory(image_path, max_side)
+
+        if fmt == "webp":
+            params = [cv2.IMWRITE_WEBP_QUALITY, _quality()]
+        else:
+            params = [cv2.IMWRITE_JPEG_QUALITY, _quality()]
+        ok, encoded = cv2.imencode(f".{fmt}", image, params)
+        if not ok:
+            raise ValueError(f"Не удалось закодировать превью {variant}")
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".part"
+        with open(tmp_path, "wb") as f:
+            f.write(encoded.tobytes())
+        os.replace(tmp_path, path)
+    return path
@@ -0,0 +1,153 @@
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+
+PROGRESS_NAME = "progress.json"
+# Как часто промежуточный прогресс пишется на диск, с (смена шага пишется сразу)
+DEFAULT_WRITE_INTERVAL = 0.5
+
+RUNNING = "running"
+
+
+def _write_interval() -> float:
+    return max(0.0, float(os.getenv("PROGRESS_INTERVAL_SEC", DEFAULT_WRITE_INTERVAL)))
+
+
+def progress_path(session_dir: str) -> str:
+    return os.path.join(session_dir, PROGRESS_NAME)
+
+
+def read(session_dir: str) -> Optional[Dict[str, Any]]:
+    """
+    Последний записанный прогресс сессии. Для идущего шага elapsed
+    досчитывается на момент чтения, поэтому видно, сколько он уже длится.
+    """
+    try:
+        with open(progress_path(session_dir), "r", encoding="utf-8") as f:
+            state = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+    if state["status"] == RUNNING:
+        now = time.time()
+        state["elapsed"] = now - state["started"]
+        for step in state["steps"]:
+            if step["finished"] is None:
+                step["elapsed"] = now - step["started"]
+    return state
+
+
+def _save(session_dir: str, state: Dict[str, Any]) -> None:
+    path = progress_path(session_dir)
+    tmp_path = f"{path}.{threading.get_ident()}.part"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+class Tracker:
+    """
+    Прогресс пайплайна сессии: этап (metashape, ai), шаг внутри этапа
+    (matchPhotos, alignCameras, ..., detect), процент шага, тайлы YOLO и время
+    каждого шага. Состояние лежит в tmp{N}/progress.json и читается любым
+    процессом сервера. Трекер той же задачи продолжает её историю шагов.
+    """
+
+    def __init__(self, session_dir: str, stage: str, job_id: Optional[str] = None) -> None:
+        self.session_dir = session_dir
+        self._lock = threading.Lock()
+        self._written = 0.0
+        now = time.time()
+
+        previous = read(session_dir)
+        if job_id is not None and previous is not None and previous.get("job_id") == job_id:
+            self.state = previous
+        else:
+            self.state = {"job_id": job_id, "started": now, "steps": []}
+        self.state.update({
+            "status": RUNNING,
+            "stage": stage,
+            "step": None,
+            "percent": None,
+            "tiles_done": None,
+            "tiles_total": None,
+            "photos_done": None,
+            "photos_total": None,
+            "updated": now,
+        })
+        self._flush(force=True)
+
+    def _flush(self, force: bool = False) -> None:
+        now = time.time()
+        if not force and now - self._written < _write_interval():
+            return
+        self.state["updated"] = now
+        self.state["elapsed"] = now - self.state["started"]
+        _save(self.session_dir, self.state)
+        self._written = now
+
+    def _close_step(self, now: float) -> None:
+        for step in self.state["steps"]:
+            if step["finished"] is None:
+                step["finished"] = now
+                step["elapsed"] = now - step["started"]
+
+    def step(self, name: str, percent: float = 0.0) -> None:
+        """Колбэк вида (шаг, процент 0..100), например для Metashape."""
+        with self._lock:
+            if name != self.state["step"]:
+                now = time.time()
+                self._close_step(now)
+                self.state["steps"].append({
+                    "stage": self.state["stage"],
+                    "name": name,
+                    "started": now,
+                    "finished": None,
+                    "elapsed": 0.0,
+                })
+                self.state.update({"step": name, "percent": percent, "tiles_done": None, "tiles_total": None})
+                self._flush(force=True)
+                return
+            self.state["percent"] = percent
+            self._flush()
+
+    def tiles(self, done: int, total: int, background: bool = False) -> None:
+        """
+        Колбэк тайлового прохода YOLO: сколько тайлов прочитано из скольких.
+        background=True — проход идёт параллельно другому шагу (экспорту
+        блоков), и процент этого шага не трогается.
+        """
+        with self._lock:
+            self.state.update({"tiles_done": done, "tiles_total": total})
+            if not background:
+                self.state["percent"] = 100.0 * done / total if total else 100.0
+            self._flush(force=done == total)
+
+    def photos(self, done: int, total: int) -> None:
+        """Детекция по отдельным снимкам, идущая параллельно Metashape: сколько снимков готово."""
+        with self._lock:
+            self.state.update({"photos_done": done, "photos_total": total})
+            self._flush(force=done == total)
+
+    def finish(self, status: str, error: Optional[str] = None) -> None:
+        with self._lock:
+            now = time.time()
+            self._close_step(now)
+            self.state.update({"status": status, "step": None, "error": error})
+            self._flush(force=True)
+
+
+def finish(session_dir: str, job_id: str, status: str, error: Optional[str] = None) -> None:
+    """Отмечает завершение задачи, если прогресс сессии относится к ней."""
+    state = read(session_dir)
+    if state is None or state.get("job_id") != job_id or state["status"] != RUNNING:
+        return
+    now = time.time()
+    for step in state["steps"]:
+        if step["finished"] is None:
+            step["finished"] = now
+            step["elapsed"] = now - step["started"]
+    state.update({"status": status, "step": None, "error": error, "updated": now, "elapsed": now - state["started"]})
+    _save(session_dir, state)
@@ -0,0 +1,50 @@
+import json
+from typing import Dict
+
+import cv2
+import numpy as np
+
+# Меньше четырёх соответствий не задают гомографию
+MIN_POINTS = 4
+
+
+def load(path: str) -> Dict[str, np.ndarray]:
+    """
+    Гомографии снимок → ортомозаика по файлу камер (см. metashape.cameras_path),
+    по имени снимка. Гомография подбирается по всем соответствиям методом
+    наименьших квадратов: для съёмки сверху над не слишком рельефной местностью
+    это хорошее приближение. Снимки без выравнивания пропускаются.
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            cameras = json.load(f)["cameras"]
+    except (FileNotFoundError, ValueError, KeyError):
+        return {}
+
+    homographies: Dict[str, np.ndarray] = {}
+    for camera in cameras:
+        points = np.asarray(camera["points"], dtype=np.float64).reshape(-1, 4)
+        if len(points) < MIN_POINTS:
+            continue
+        matrix, _ = cv2.findHomography(points[:, :2], points[:, 2:])
+        if matrix is not None:
+            homographies[camera["photo"]] = matrix
+    return homographies
+
+
+def project_boxes(boxes: np.ndarray, matrix: np.ndarray) -> np.ndarray:
+    """Переносит боксы снимка на ортомозаику: охватывающий прямоугольник четырёх углов бокса."""
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    if len(boxes) == 0:
+        return np.zeros((0, 4), dtype=np.float32)
+    corners = np.stack(
+        [boxes[:, [0, 1]], boxes[:, [2, 1]], boxes[:, [2, 3]], boxes[:, [0, 3]]],
+        axis=1,
+    )
+    projected = cv2.perspectiveTransform(corners.reshape(-1, 1, 2), matrix).reshape(-1, 4, 2)
+    return np.concatenate([projected.min(axis=1), projected.max(axis=1)], axis=1).astype(np.float32)
+
+
+def footprint(width: int, height: int, matrix: np.ndarray) -> np.ndarray:
+    """Прямоугольник ортомозаики, который покрывает снимок."""
+    return project_boxes(np.array([[0, 0, width, height]]), matrix)[0]
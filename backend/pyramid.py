@@ -0,0 +1,281 @@
+import json
+import logging
+import math
+import os
+import shutil
+import tempfile
+import threading
+from typing import Any, Dict, Optional, Set, Union
+
+import cv2
+import numpy as np
+
+from raster import BAND_ROWS, RawRaster, ensure_raw, resolve_streaming
+
+# Пирамида в формате DeepZoom: уровень 0 — 1x1 пиксель, последний — исходный размер
+DEFAULT_TILE_SIZE = 256
+DEFAULT_TILE_FORMAT = "jpg"
+TILE_FORMATS = ("jpg", "png")
+DEFAULT_JPEG_QUALITY = 85
+
+PYRAMID_SUFFIX = ".pyramid"
+DZI_NAME = "image.dzi"
+FILES_DIR = "image_files"
+INFO_NAME = "info.json"
+
+logger = logging.getLogger(__name__)
+
+_locks_guard = threading.Lock()
+_locks: Dict[str, threading.Lock] = {}
+# Пирамиды, которые сейчас строятся в фоне (см. start_build)
+_building: Set[str] = set()
+
+
+def _tile_size() -> int:
+    return int(os.getenv("PYRAMID_TILE_SIZE", DEFAULT_TILE_SIZE))
+
+
+def _tile_format() -> str:
+    fmt = os.getenv("PYRAMID_FORMAT", DEFAULT_TILE_FORMAT).lower()
+    if fmt not in TILE_FORMATS:
+        raise ValueError(
+            f"Неизвестный формат тайлов: {fmt}. Допустимые значения: {', '.join(TILE_FORMATS)}"
+        )
+    return fmt
+
+
+def _jpeg_quality() -> int:
+    return int(os.getenv("PYRAMID_QUALITY", DEFAULT_JPEG_QUALITY))
+
+
+def pyramid_path(image_path: str) -> str:
+    """Папка пирамиды тайлов для изображения."""
+    return image_path + PYRAMID_SUFFIX
+
+
+def is_fresh(image_path: str) -> bool:
+    """Пирамида построена и не старше исходного изображения."""
+    info_path = os.path.join(pyramid_path(image_path), INFO_NAME)
+    return os.path.isfile(info_path) and os.path.getmtime(info_path) >= os.path.getmtime(image_path)
+
+
+def max_level(width: int, height: int) -> int:
+    """Номер уровня с исходным разрешением."""
+    return int(math.ceil(math.log2(max(width, height, 1))))
+
+
+def load_info(image_path: str) -> Dict[str, Any]:
+    with open(os.path.join(pyramid_path(image_path), INFO_NAME), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def tile_path(image_path: str, level: int, col: int, row: int, fmt: str) -> str:
+    return os.path.join(pyramid_path(image_path), FILES_DIR, str(level), f"{col}_{row}.{fmt}")
+
+
+def dzi_xml(info: Dict[str, Any]) -> str:
+    """Дескриптор DeepZoom (.dzi) для совместимых просмотрщиков."""
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" '
+        'Format="{format}" Overlap="{overlap}" TileSize="{tile_size}">'
+        '<Size Width="{width}" Height="{height}"/></Image>\n'
+    ).format(**info)
+
+
+def _lock_for(path: str) -> threading.Lock:
+    with _locks_guard:
+        return _locks.setdefault(path, threading.Lock())
+
+
+def build(image_path: str) -> Dict[str, Any]:
+    """
+    Строит пирамиду тайлов DeepZoom один раз и кэширует её на диске рядом с изображением.
+    Пирамида собирается в своей временной папке и подменяется атомарно,
+    поэтому сервер тайлов никогда не видит её частично. Одновременные сборки
+    одной пирамиды в процессе ждут друг друга; сборки из разных процессов
+    не мешают друг другу, подменяет пирамиду та, что закончила первой.
+    Возвращает описание пирамиды (размеры, размер тайла, формат, версия).
+    """
+    if is_fresh(image_path):
+        return load_info(image_path)
+
+    with _lock_for(image_path):
+        if is_fresh(image_path):
+            return load_info(image_path)
+        return _build(image_path)
+
+
+def start_build(image_path: str) -> None:
+    """Строит пирамиду в фоновом потоке, если она ещё не строится. Ошибка пишется в лог."""
+    with _locks_guard:
+        if image_path in _building:
+            return
+        _building.add(image_path)
+
+    def run() -> None:
+        try:
+            build(image_path)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Не удалось построить пирамиду тайлов для %s", image_path)
+        finally:
+            with _locks_guard:
+                _building.discard(image_path)
+
+    threading.Thread(target=run, name="pyramid", daemon=True).start()
+
+
+def _build(image_path: str) -> Dict[str, Any]:
+    target = pyramid_path(image_path)
+    folder, name = os.path.split(target)
+    staging = tempfile.mkdtemp(prefix=f"{name}.", suffix=".part", dir=folder or ".")
+
+    tile_size = _tile_size()
+    fmt = _tile_format()
+    try:
+        if image_path.lower().endswith(".npy"):
+            # Растр, собранный из блоков экспорта: pyvips его не читает
+            width, height = _build_with_cv2(image_path, staging, tile_size, fmt)
+        else:
+            try:
+                width, height = _build_with_vips(image_path, staging, tile_size, fmt)
+            except ImportError:
+                width, height = _build_with_cv2(image_path, staging, tile_size, fmt)
+
+        info = {
+            "width": width,
+            "height": height,
+            "tile_size": tile_size,
+            "overlap": 0,
+            "format": fmt,
+            "max_level": max_level(width, height),
+            # Версия меняется при каждой пересборке — клиент добавляет её к адресам тайлов
+            "version": f"{os.path.getmtime(image_path):.0f}-{os.path.getsize(image_path)}",
+        }
+        with open(os.path.join(staging, DZI_NAME), "w", encoding="utf-8") as f:
+            f.write(dzi_xml(info))
+        with open(os.path.join(staging, INFO_NAME), "w", encoding="utf-8") as f:
+            json.dump(info, f)
+
+        previous = staging[:-len(".part")] + ".old"
+        if os.path.isdir(target):
+            try:
+                os.rename(target, previous)
+            except FileNotFoundError:
+                # Старую пирамиду уже убрала сборка из другого процесса
+                pass
+        try:
+            os.rename(staging, target)
+        except OSError:
+            # Другой процесс успел положить свою свежую пирамиду — она не хуже нашей
+            if not is_fresh(image_path):
+                raise
+        shutil.rmtree(previous, ignore_errors=True)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    return info
+
+
+def _build_with_vips(image_path: str, target: str, tile_size: int, fmt: str) -> tuple:
+    """Быстрый путь через pyvips.dzsave (опционально): потоковая сборка всех уровней."""
+    import pyvips
+
+    img = pyvips.Image.new_from_file(image_path, access="sequential")
+    suffix = f".jpg[Q={_jpeg_quality()}]" if fmt == "jpg" else ".png"
+    img.dzsave(
+        os.path.join(target, os.path.splitext(DZI_NAME)[0]),
+        layout="dz",
+        tile_size=tile_size,
+        overlap=0,
+        suffix=suffix,
+    )
+    return img.width, img.height
+
+
+class _ArraySource:
+    """Изображение в памяти с тем же интерфейсом чтения окон, что и RawRaster."""
+
+    def __init__(self, image: np.ndarray) -> None:
+        self.image = image
+
+    @property
+    def height(self) -> int:
+        return self.image.shape[0]
+
+    @property
+    def width(self) -> int:
+        return self.image.shape[1]
+
+    def read_window(self, x1: int, y1: int, x2: int, y2: int) -> np.ndarray:
+        return self.image[y1:y2, x1:x2]
+
+
+Source = Union[RawRaster, _ArraySource]
+
+
+def _open_source(image_path: str) -> Source:
+    """Большие изображения читаются окнами из несжатой копии, остальные — целиком."""
+    if resolve_streaming(image_path):
+        return RawRaster(ensure_raw(image_path))
+
+    image = cv2.imread(image_path)
+    if image is None:
+        raise ValueError(f"Не удалось прочитать изображение: {image_path}")
+    return _ArraySource(image)
+
+
+def _build_with_cv2(image_path: str, target: str, tile_size: int, fmt: str) -> tuple:
+    """
+    Запасной вариант без pyvips: уровни строятся сверху вниз, каждый следующий —
+    уменьшением предыдущего вдвое. Промежуточные уровни лежат во временных .npy
+    и читаются окнами, так что в памяти держится только полоса строк.
+    """
+    source: Source = _open_source(image_path)
+    width, height = source.width, source.height
+    params = [cv2.IMWRITE_JPEG_QUALITY, _jpeg_quality()] if fmt == "jpg" else []
+
+    level = max_level(width, height)
+    level_path: Optional[str] = None
+    while True:
+        _write_level(source, os.path.join(target, FILES_DIR, str(level)), tile_size, fmt, params)
+        if level == 0:
+            break
+
+        next_path = os.path.join(target, f"level_{level - 1}.npy")
+        _downsample(source, next_path)
+        source = RawRaster(next_path)
+        if level_path is not None:
+            os.remove(level_path)
+        level_path = next_path
+        level -= 1
+
+    if level_path is not None:
+        os.remove(level_path)
+    return width, height
+
+
+def _write_level(source: Source, level_dir: str, tile_size: int, fmt: str, params: list) -> None:
+    os.makedirs(level_dir, exist_ok=True)
+    for row, y in enumerate(range(0, source.height, tile_size)):
+        y2 = min(y + tile_size, source.height)
+        for col, x in enumerate(range(0, source.width, tile_size)):
+            x2 = min(x + tile_size, source.width)
+            tile = source.read_window(x, y, x2, y2)
+            cv2.imwrite(os.path.join(level_dir, f"{col}_{row}.{fmt}"), tile, params)
+
+
+def _downsample(source: Source, path: str) -> None:
+    """Уменьшает уровень вдвое (с округлением вверх) полосами строк в новый .npy."""
+    width = (source.width + 1) // 2
+    height = (source.height + 1) // 2
+    out = np.lib.format.open_memmap(path, mode="w+", dtype=np.uint8, shape=(height, width, 3))
+    # Полосы чётной высоты: нечётной может быть только последняя
+    for y in range(0, source.height, BAND_ROWS):
+        y2 = min(y + BAND_ROWS, source.height)
+        band = source.read_window(0, y, source.width, y2)
+        out[y // 2:(y2 + 1) // 2] = cv2.resize(
+            band, (width, (y2 - y + 1) // 2), interpolation=cv2.INTER_AREA
+        )
+    out.flush()
+    del out
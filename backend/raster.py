@@ -0,0 +1,479 @@
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from typing import Any, Callable, Dict, Iterator, Optional, Set, Tuple
+
+import cv2
+import numpy as np
+
+import blockgrid
+
+logger = logging.getLogger(__name__)
+
+# Изображения больше этого числа пикселей обрабатываются потоково (режим "auto")
+DEFAULT_STREAMING_MIN_PIXELS = 100_000_000
+# Бюджет памяти на буферы тайлов при потоковой обработке, МБ
+DEFAULT_MEMORY_BUDGET_MB = 1024
+# Во сколько раз тайл в модели (float32, промежуточные тензоры) тяжелее исходного uint8
+TILE_MEMORY_FACTOR = 16
+# Высота полосы строк при конвертации и копировании растра
+BAND_ROWS = 512
+
+RAW_SUFFIX = ".raw.npy"
+# Как часто читатель сетки блоков проверяет, не появился ли нужный блок, с
+BLOCK_POLL_INTERVAL = 0.2
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# Уровень zlib для PNG, который пишется полосами (как у cv2.imwrite по умолчанию — быстрый)
+PNG_COMPRESSION_LEVEL = 1
+# Маркеры JPEG SOFn (кроме DHT, JPG и DAC), в которых записан размер кадра
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def resolve_streaming(image_path: str, streaming: Optional[bool] = None) -> bool:
+    """
+    Решает, нужно ли обрабатывать изображение потоково.
+    Переменная окружения AI_STREAMING: "1" — всегда, "0" — никогда, "auto" — по размеру.
+    """
+    if streaming is not None:
+        return streaming
+    if image_path.lower().endswith(".npy"):
+        return True
+
+    mode = os.getenv("AI_STREAMING", "auto").lower()
+    if mode in ("1", "true", "yes"):
+        return True
+    if mode in ("0", "false", "no"):
+        return False
+
+    min_pixels = int(os.getenv("AI_STREAMING_MIN_PIXELS", DEFAULT_STREAMING_MIN_PIXELS))
+    size = read_image_size(image_path)
+    if size is None:
+        return False
+    width, height = size
+    return width * height >= min_pixels
+
+
+def read_image_size(image_path: str) -> Optional[Tuple[int, int]]:
+    """
+    Читает размер (ширина, высота) из заголовка файла без декодирования пикселей.
+    Возвращает None, если размер определить не удалось.
+    """
+    if image_path.lower().endswith(".npy"):
+        raster = RawRaster(image_path)
+        return raster.width, raster.height
+
+    size = _parse_header_size(image_path)
+    if size is not None:
+        return size
+
+    try:
+        import pyvips
+    except ImportError:
+        pyvips = None
+    if pyvips is not None:
+        try:
+            # pyvips читает только заголовок, пока пиксели не запрошены
+            img = pyvips.Image.new_from_file(image_path, access="sequential")
+            return img.width, img.height
+        except pyvips.Error:
+            pass
+
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    # Глобальную защиту PIL от «бомб» не трогаем: её меняют и другие потоки.
+    # Огромные PNG и JPEG уже разобраны выше, остальное без pyvips не читается.
+    try:
+        with Image.open(image_path) as img:
+            return img.size
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+
+def _parse_header_size(image_path: str) -> Optional[Tuple[int, int]]:
+    """Размер PNG или JPEG из заголовка файла; None для других форматов."""
+    try:
+        with open(image_path, "rb") as fh:
+            head = fh.read(24)
+            if head.startswith(PNG_SIGNATURE) and head[12:16] == b"IHDR":
+                return struct.unpack(">II", head[16:24])
+            if not head.startswith(b"\xff\xd8"):
+                return None
+            fh.seek(2)
+            while True:
+                marker = fh.read(2)
+                if len(marker) < 2 or marker[0] != 0xFF:
+                    return None
+                if marker[1] == 0xFF:
+                    # Байты-заполнители перед маркером
+                    fh.seek(-1, os.SEEK_CUR)
+                    continue
+                if marker[1] == 0x01 or 0xD0 <= marker[1] <= 0xD7:
+                    continue
+                length_bytes = fh.read(2)
+                if len(length_bytes) < 2:
+                    return None
+                (length,) = struct.unpack(">H", length_bytes)
+                if marker[1] in JPEG_SOF_MARKERS:
+                    frame = fh.read(5)
+                    if len(frame) < 5:
+                        return None
+                    height, width = struct.unpack(">HH", frame[1:5])
+                    return width, height
+                fh.seek(length - 2, os.SEEK_CUR)
+    except OSError:
+        return None
+
+
+def resolve_memory_budget(budget_mb: Optional[int] = None) -> int:
+    """Бюджет памяти в байтах из аргумента, AI_MEMORY_BUDGET_MB или по умолчанию."""
+    if budget_mb is None:
+        budget_mb = int(os.getenv("AI_MEMORY_BUDGET_MB", DEFAULT_MEMORY_BUDGET_MB))
+    return max(1, budget_mb) * 1024 * 1024
+
+
+def batch_size_for_budget(tile_size: int, batch_size: int, budget_bytes: int) -> int:
+    """Ограничивает размер батча так, чтобы буферы тайлов укладывались в бюджет."""
+    tile_bytes = tile_size * tile_size * 3 * TILE_MEMORY_FACTOR
+    return max(1, min(batch_size, budget_bytes // tile_bytes))
+
+
+def iter_windows(
+    height: int,
+    width: int,
+    tile_size: int,
+    overlap: float,
+) -> Iterator[Tuple[int, int, int, int]]:
+    """
+    Геометрия сетки тайлов: (x1, y1, x2, y2) для каждого тайла.
+    Слишком узкие краевые тайлы пропускаются.
+    """
+    step = max(1, int(tile_size * (1 - overlap)))
+
+    for y in range(0, height, step):
+        for x in range(0, width, step):
+            x2 = min(x + tile_size, width)
+            y2 = min(y + tile_size, height)
+
+            if y2 - y < tile_size // 4 or x2 - x < tile_size // 4:
+                continue
+
+            yield x, y, x2, y2
+
+
+def raw_cache_path(image_path: str) -> str:
+    """Путь к несжатой копии изображения для чтения окнами."""
+    return image_path + RAW_SUFFIX
+
+
+def ensure_raw(image_path: str) -> str:
+    """
+    Возвращает путь к несжатому растру .npy для изображения.
+    Конвертация выполняется один раз; копия пересоздаётся, если исходник новее.
+    """
+    if image_path.lower().endswith(".npy"):
+        return image_path
+
+    raw_path = raw_cache_path(image_path)
+    if os.path.isfile(raw_path) and os.path.getmtime(raw_path) >= os.path.getmtime(image_path):
+        return raw_path
+
+    tmp_path = raw_path + ".part"
+    try:
+        _convert_with_vips(image_path, tmp_path)
+    except ImportError:
+        _convert_with_cv2(image_path, tmp_path)
+    os.replace(tmp_path, raw_path)
+    return raw_path
+
+
+def _convert_with_vips(image_path: str, raw_path: str) -> None:
+    """
+    Построчная конвертация через pyvips (опционально): пиковая память —
+    одна полоса строк, а не всё изображение.
+    """
+    import pyvips
+
+    img = pyvips.Image.new_from_file(image_path, access="sequential")
+    if img.hasalpha():
+        img = img.flatten(background=[0, 0, 0])
+    if img.bands == 1:
+        img = img.bandjoin([img, img])
+    img = img.cast("uchar")
+
+    out = np.lib.format.open_memmap(
+        raw_path, mode="w+", dtype=np.uint8, shape=(img.height, img.width, 3)
+    )
+    for y in range(0, img.height, BAND_ROWS):
+        rows = min(BAND_ROWS, img.height - y)
+        band = np.ndarray(
+            buffer=img.crop(0, y, img.width, rows).write_to_memory(),
+            dtype=np.uint8,
+            shape=(rows, img.width, img.bands),
+        )
+        # vips отдаёт RGB, остальной код работает в BGR, как cv2
+        out[y:y + rows] = band[:, :, 2::-1]
+    out.flush()
+    del out
+
+
+def _convert_with_cv2(image_path: str, raw_path: str) -> None:
+    """
+    Запасной вариант без pyvips: однократное полное декодирование через cv2.
+    Изображение, которое целиком не укладывается в AI_MEMORY_BUDGET_MB,
+    так не конвертируется — нужен pyvips (см. requirements.txt).
+    """
+    size = read_image_size(image_path)
+    if size is not None:
+        width, height = size
+        decoded_bytes = width * height * 3
+        budget = resolve_memory_budget()
+        if decoded_bytes > budget:
+            raise MemoryError(
+                f"Изображение {width}x{height} требует {decoded_bytes // 2 ** 20} МБ "
+                f"для декодирования целиком при бюджете {budget // 2 ** 20} МБ "
+                "(AI_MEMORY_BUDGET_MB). Установите pyvips для построчной конвертации."
+            )
+
+    image = cv2.imread(image_path)
+    if image is None:
+        raise ValueError(f"Не удалось прочитать изображение: {image_path}")
+
+    out = np.lib.format.open_memmap(
+        raw_path, mode="w+", dtype=np.uint8, shape=image.shape
+    )
+    for y in range(0, image.shape[0], BAND_ROWS):
+        out[y:y + BAND_ROWS] = image[y:y + BAND_ROWS]
+    out.flush()
+    del out
+
+
+def _png_chunk(f: Any, kind: bytes, data: bytes) -> None:
+    f.write(struct.pack(">I", len(data)))
+    f.write(kind)
+    f.write(data)
+    f.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(kind))))
+
+
+def write_png_bands(output_path: str, width: int, height: int, bands: Iterator[np.ndarray]) -> None:
+    """
+    Пишет PNG из полос строк BGR (сверху вниз, height строк всего), сжимая их
+    по мере поступления: в памяти одна полоса, а не всё изображение, как при
+    cv2.imwrite. Строки кодируются фильтром Sub, сжатие — PNG_COMPRESSION_LEVEL.
+    """
+    compressor = zlib.compressobj(PNG_COMPRESSION_LEVEL)
+    with open(output_path, "wb") as f:
+        f.write(PNG_SIGNATURE)
+        # 8 бит на канал, RGB, без чересстрочности
+        _png_chunk(f, b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        for band in bands:
+            rgb = band[:, :, 2::-1].reshape(band.shape[0], width * 3)
+            rows = np.empty((band.shape[0], width * 3 + 1), dtype=np.uint8)
+            rows[:, 0] = 1  # фильтр Sub: разность с тем же каналом соседнего пикселя
+            rows[:, 1:4] = rgb[:, :3]
+            np.subtract(rgb[:, 3:], rgb[:, :-3], out=rows[:, 4:])
+            data = compressor.compress(rows.tobytes())
+            if data:
+                _png_chunk(f, b"IDAT", data)
+        _png_chunk(f, b"IDAT", compressor.flush())
+        _png_chunk(f, b"IEND", b"")
+
+
+class RawRaster:
+    """
+    Несжатый растр .npy, читаемый окнами. Каждое окно отображается в память
+    отдельно и сразу освобождается, поэтому резидентная память не растёт
+    с размером изображения.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path, "rb") as f:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            self.offset = f.tell()
+        if fortran_order or len(shape) != 3:
+            raise ValueError(f"Неподдерживаемый формат растра: {path}")
+        self.shape: Tuple[int, int, int] = shape
+        self.dtype = dtype
+
+    @property
+    def height(self) -> int:
+        return self.shape[0]
+
+    @property
+    def width(self) -> int:
+        return self.shape[1]
+
+    def _rows(self, y1: int, y2: int) -> np.memmap:
+        row_bytes = self.shape[1] * self.shape[2] * self.dtype.itemsize
+        return np.memmap(
+            self.path,
+            dtype=self.dtype,
+            mode="r",
+            offset=self.offset + y1 * row_bytes,
+            shape=(y2 - y1, self.shape[1], self.shape[2]),
+        )
+
+    def read_window(self, x1: int, y1: int, x2: int, y2: int) -> np.ndarray:
+        """Копирует окно растра в обычный массив."""
+        rows = self._rows(y1, y2)
+        window = np.array(rows[:, x1:x2])
+        del rows
+        return window
+
+    def iter_tiles(
+        self,
+        tile_size: int,
+        overlap: float,
+    ) -> Iterator[Tuple[np.ndarray, int, int]]:
+        """Лениво отдаёт тайлы (tile, x, y), читая каждый с диска по требованию."""
+        for x1, y1, x2, y2 in iter_windows(self.height, self.width, tile_size, overlap):
+            yield self.read_window(x1, y1, x2, y2), x1, y1
+
+    def copy_to(self, path: str) -> np.memmap:
+        """Создаёт записываемую копию растра на диске полосами строк."""
+        out = np.lib.format.open_memmap(path, mode="w+", dtype=self.dtype, shape=self.shape)
+        for y in range(0, self.height, BAND_ROWS):
+            y2 = min(y + BAND_ROWS, self.height)
+            out[y:y2] = self.read_window(0, y, self.width, y2)
+        out.flush()
+        return out
+
+
+class BlockRaster:
+    """
+    Ортомозаика, которую Metashape экспортирует сеткой блоков (см. blockgrid.py).
+    Блоки по мере появления декодируются в несжатый растр .npy, окна читаются
+    из него. Чтение окна ждёт, пока запишутся все покрывающие его блоки,
+    поэтому тайлы YOLO идут вслед за экспортом, а не после него.
+
+    Сетка принимается, только если её начали писать после since, либо если
+    экспорт уже закончился (finished() вернул True) и сетка готова: так
+    сетка прошлого запуска не читается вместо новой.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        path: str,
+        since: float = 0.0,
+        finished: Callable[[], bool] = lambda: True,
+    ) -> None:
+        self.directory = directory
+        self.path = path
+        self._finished = finished
+        self._loaded: Set[Tuple[int, int]] = set()
+
+        self.grid = self._wait_grid(since)
+        shape = (self.grid["height"], self.grid["width"], 3)
+        self.image: np.memmap = np.lib.format.open_memmap(path, mode="w+", dtype=np.uint8, shape=shape)
+
+    def _wait_grid(self, since: float) -> Dict[str, Any]:
+        while True:
+            finished = self._finished()
+            grid = blockgrid.read_grid(self.directory)
+            if grid is not None and (grid["created"] >= since or (finished and blockgrid.is_done(self.directory))):
+                return grid
+            if finished:
+                raise ValueError(f"Экспорт не создал сетку блоков: {self.directory}")
+            time.sleep(BLOCK_POLL_INTERVAL)
+
+    @property
+    def height(self) -> int:
+        return self.grid["height"]
+
+    @property
+    def width(self) -> int:
+        return self.grid["width"]
+
+    def _wait_block(self, row: int, col: int) -> str:
+        path = blockgrid.block_path(self.directory, row, col)
+        while not os.path.isfile(path):
+            # Метку ставят после последнего блока, поэтому проверяем её до таймера
+            finished = self._finished()
+            if blockgrid.is_done(self.directory) or finished:
+                if os.path.isfile(path):
+                    break
+                raise ValueError(f"Экспорт закончился без блока {row}:{col}: {self.directory}")
+            time.sleep(BLOCK_POLL_INTERVAL)
+        return path
+
+    def _load(self, row: int, col: int, x1: int, y1: int, x2: int, y2: int) -> None:
+        if (row, col) in self._loaded:
+            return
+        path = self._wait_block(row, col)
+        block = cv2.imread(path, cv2.IMREAD_COLOR)
+        if block is None:
+            raise ValueError(f"Не удалось прочитать блок ортомозаики: {path}")
+        # Блок по области может отличаться от сетки на пиксель из-за округления
+        height = min(block.shape[0], y2 - y1)
+        width = min(block.shape[1], x2 - x1)
+        self.image[y1:y1 + height, x1:x1 + width] = block[:height, :width]
+        self._loaded.add((row, col))
+
+    def read_window(self, x1: int, y1: int, x2: int, y2: int) -> np.ndarray:
+        """Копирует окно растра в обычный массив, дождавшись покрывающих его блоков."""
+        for row, col, bx1, by1, bx2, by2 in blockgrid.iter_blocks(self.grid):
+            if bx1 < x2 and x1 < bx2 and by1 < y2 and y1 < by2:
+                self._load(row, col, bx1, by1, bx2, by2)
+        return np.array(self.image[y1:y2, x1:x2])
+
+    def assemble(self) -> str:
+        """Дочитывает оставшиеся блоки и возвращает путь к собранному растру."""
+        for block in blockgrid.iter_blocks(self.grid):
+            self._load(*block)
+        self.image.flush()
+        return self.path
+
+
+def follow_blocks(
+    directory: str,
+    path: str,
+    produce: Callable[[], Any],
+    consume: Optional[Callable[[BlockRaster], None]] = None,
+) -> str:
+    """
+    Выполняет produce() — экспорт ортомозаики сеткой блоков в directory —
+    и параллельно отдаёт consume растр, который заполняется по мере записи
+    блоков. Ошибка consume не прерывает экспорт: она пишется в лог. После
+    экспорта растр дособирается целиком. Возвращает путь к растру .npy.
+
+    consume не ждётся: он может ещё читать растр, когда функция вернётся
+    (блоки, которые он дочитывает, уже собраны). Дождаться его — забота вызывающего.
+    """
+    since = time.time()
+    done = threading.Event()
+    ready = threading.Event()
+    opened: Dict[str, BlockRaster] = {}
+
+    def follow() -> None:
+        try:
+            try:
+                opened["raster"] = BlockRaster(directory, path, since, done.is_set)
+            finally:
+                ready.set()
+            consume(opened["raster"])
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Не удалось обработать блоки %s во время экспорта", directory)
+
+    if consume is not None:
+        threading.Thread(target=follow, name="block-follower", daemon=True).start()
+    try:
+        produce()
+    finally:
+        done.set()
+        if consume is not None:
+            # Растр открывается один раз: второй open_memmap пересоздал бы файл
+            ready.wait()
+
+    raster = opened.get("raster") or BlockRaster(directory, path, since, done.is_set)
+    return raster.assemble()
@@ -0,0 +1,188 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+DEFAULT_DB_NAME = "sessions.sqlite"
+SESSION_DIR_RE = re.compile(r"^tmp(\d+)$")
+SUBDIRS = ("data", "metashape", "ai")
+
+# Состояния сессии
+CREATED = "created"
+UPLOADED = "uploaded"
+PROCESSING = "processing"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+# Поля, которые можно обновлять через update()
+FIELDS = ("state", "image_count", "data_bytes", "total_bytes", "last_job")
+
+_schema_lock = threading.Lock()
+_schema_ready: Dict[str, bool] = {}
+
+
+def _db_path(root: str) -> str:
+    return os.getenv("SESSIONS_DB", os.path.join(root, DEFAULT_DB_NAME))
+
+
+def _connect(root: str) -> sqlite3.Connection:
+    path = _db_path(root)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    with _schema_lock:
+        if not _schema_ready.get(path):
+            conn.execute("PRAGMA journal_mode=WAL")
+            # AUTOINCREMENT: номера не переиспользуются даже после удаления сессий
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " state TEXT NOT NULL,"
+                " image_count INTEGER NOT NULL DEFAULT 0,"
+                " data_bytes INTEGER NOT NULL DEFAULT 0,"
+                " total_bytes INTEGER NOT NULL DEFAULT 0,"
+                " last_job TEXT,"
+                " created REAL NOT NULL,"
+                " updated REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS registry_meta (key TEXT PRIMARY KEY, value TEXT)"
+            )
+            _migrate(conn, root)
+            _schema_ready[path] = True
+    return conn
+
+
+def _migrate(conn: sqlite3.Connection, root: str) -> None:
+    """
+    Однократный перенос сессий, созданных до появления реестра: папки tmp{N}
+    регистрируются со своими номерами, новые номера продолжаются после них.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        done = conn.execute(
+            "SELECT value FROM registry_meta WHERE key = 'migrated'"
+        ).fetchone()
+        if done is None:
+            for name in os.listdir(root) if os.path.isdir(root) else []:
+                match = SESSION_DIR_RE.match(name)
+                if not match or not os.path.isdir(os.path.join(root, name)):
+                    continue
+                created = os.path.getmtime(os.path.join(root, name))
+                conn.execute(
+                    "INSERT OR IGNORE INTO sessions (id, state, created, updated) VALUES (?, ?, ?, ?)",
+                    (int(match.group(1)), CREATED, created, created),
+                )
+            conn.execute("INSERT INTO registry_meta (key, value) VALUES ('migrated', '1')")
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+
+def session_dir(root: str, session_id: int) -> str:
+    return os.path.join(root, f"tmp{session_id}")
+
+
+def create(root: str) -> int:
+    """
+    Атомарно выделяет номер новой сессии и создаёт её папки.
+    Номер выдаёт SQLite, поэтому он уникален и между процессами uvicorn.
+    """
+    now = time.time()
+    conn = _connect(root)
+    try:
+        cursor = conn.execute(
+            "INSERT INTO sessions (state, created, updated) VALUES (?, ?, ?)",
+            (CREATED, now, now),
+        )
+        conn.commit()
+        session_id = cursor.lastrowid
+    finally:
+        conn.close()
+
+    base = session_dir(root, session_id)
+    for sub in SUBDIRS:
+        os.makedirs(os.path.join(base, sub), exist_ok=True)
+    return session_id
+
+
+def get(root: str, session_id: int) -> Optional[Dict[str, Any]]:
+    conn = _connect(root)
+    try:
+        row = conn.execute("SELECT * FROM sessions WHERE id = ?", (session_id,)).fetchone()
+    finally:
+        conn.close()
+    return None if row is None else dict(row)
+
+
+def exists(root: str, session_id: int) -> bool:
+    return get(root, session_id) is not None
+
+
+def current(root: str) -> Optional[int]:
+    """Номер последней созданной сессии или None."""
+    conn = _connect(root)
+    try:
+        row = conn.execute("SELECT MAX(id) FROM sessions").fetchone()
+    finally:
+        conn.close()
+    return row[0]
+
+
+def list_sessions(root: str, limit: Optional[int] = 100) -> List[Dict[str, Any]]:
+    """Сессии, новые первыми; limit=None — все."""
+    conn = _connect(root)
+    try:
+        rows = conn.execute(
+            "SELECT * FROM sessions ORDER BY id DESC LIMIT ?", (-1 if limit is None else limit,)
+        ).fetchall()
+    finally:
+        conn.close()
+    return [dict(row) for row in rows]
+
+
+def update(root: str, session_id: int, **fields: Any) -> None:
+    """Обновляет метаданные сессии (состояние, число снимков, размеры, последнюю задачу)."""
+    unknown = set(fields) - set(FIELDS)
+    if unknown:
+        raise ValueError(f"Неизвестные поля сессии: {', '.join(sorted(unknown))}")
+    fields["updated"] = time.time()
+    columns = ", ".join(f"{name} = ?" for name in fields)
+    conn = _connect(root)
+    try:
+        conn.execute(f"UPDATE sessions SET {columns} WHERE id = ?", (*fields.values(), session_id))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def delete(root: str, session_id: int) -> None:
+    """Удаляет запись о сессии (папку удаляет вызывающий)."""
+    conn = _connect(root)
+    try:
+        conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def folder_bytes(path: str) -> int:
+    """Суммарный размер файлов в папке; жёсткие ссылки на один файл считаются один раз."""
+    total = 0
+    seen = set()
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                stat = os.stat(os.path.join(dirpath, name))
+            except OSError:
+                continue
+            if stat.st_nlink > 1:
+                if (stat.st_dev, stat.st_ino) in seen:
+                    continue
+                seen.add((stat.st_dev, stat.st_ino))
+            total += stat.st_size
+    return total
@@ -0,0 +1,201 @@
+import json
+import os
+import shutil
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+STORE_SUFFIX = "_detections"
+WORLD_FILE_EXTENSIONS = (".pgw", ".jgw", ".tfw", ".wld")
+
+
+def store_path(output_path: str) -> str:
+    """Папка структурированных результатов для файла результата AI."""
+    root, _ = os.path.splitext(output_path)
+    return root + STORE_SUFFIX
+
+
+def save(
+    store_dir: str,
+    boxes: np.ndarray,
+    classes: np.ndarray,
+    scores: np.ndarray,
+    names: Dict[int, str],
+    image_path: str,
+    image_size: Tuple[int, int],
+    stats: Optional[Dict[str, int]] = None,
+) -> str:
+    """
+    Сохраняет детекции по столбцам (boxes.npy, classes.npy, scores.npy) и meta.json.
+    Столбцы читаются через memmap, поэтому выборка не загружает весь набор.
+    Папка заменяется атомарно: читатели видят либо старую, либо новую версию.
+    """
+    staging = store_dir + ".part"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+    np.save(os.path.join(staging, "boxes.npy"), boxes)
+    np.save(os.path.join(staging, "classes.npy"), np.asarray(classes, dtype=np.int32).reshape(-1))
+    np.save(os.path.join(staging, "scores.npy"), np.asarray(scores, dtype=np.float32).reshape(-1))
+
+    width, height = image_size
+    meta = {
+        "count": int(len(boxes)),
+        "names": {str(k): v for k, v in names.items()},
+        "image": {
+            "path": os.path.basename(image_path),
+            "width": int(width),
+            "height": int(height),
+            "world_file": read_world_file(image_path),
+        },
+        "stats": stats or {},
+        "created": time.time(),
+    }
+    with open(os.path.join(staging, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+
+    previous = store_dir + ".old"
+    shutil.rmtree(previous, ignore_errors=True)
+    if os.path.isdir(store_dir):
+        os.rename(store_dir, previous)
+    os.rename(staging, store_dir)
+    shutil.rmtree(previous, ignore_errors=True)
+    return store_dir
+
+
+def read_world_file(image_path: str) -> Optional[List[float]]:
+    """
+    Коэффициенты world-файла (A, D, B, E, C, F), если Metashape сохранил его рядом
+    с растром. Пиксель (x, y) переходит в X = A*x + B*y + C, Y = D*x + E*y + F.
+    """
+    root, _ = os.path.splitext(image_path)
+    for ext in WORLD_FILE_EXTENSIONS:
+        path = root + ext
+        if os.path.isfile(path):
+            with open(path, encoding="utf-8") as f:
+                values = [float(line) for line in f.read().split()]
+            if len(values) == 6:
+                return values
+    return None
+
+
+def load_meta(store_dir: str) -> Dict[str, Any]:
+    with open(os.path.join(store_dir, "meta.json"), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _column(store_dir: str, name: str) -> np.ndarray:
+    return np.load(os.path.join(store_dir, f"{name}.npy"), mmap_mode="r")
+
+
+def query(
+    store_dir: str,
+    class_names: Optional[Sequence[str]] = None,
+    min_score: Optional[float] = None,
+    bbox: Optional[Tuple[float, float, float, float]] = None,
+    limit: Optional[int] = None,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, Dict[str, Any]]:
+    """
+    Выбирает детекции по классам, минимальной уверенности и области (x1, y1, x2, y2).
+    Столбцы отображаются в память, в оперативную память копируются только
+    подходящие строки. Возвращает боксы, классы, уверенности и метаданные.
+    """
+    meta = load_meta(store_dir)
+    count = meta["count"]
+    mask = np.ones(count, dtype=bool)
+
+    if class_names:
+        wanted = [int(k) for k, v in meta["names"].items() if v in class_names]
+        mask &= np.isin(_column(store_dir, "classes"), wanted)
+
+    if min_score is not None:
+        mask &= _column(store_dir, "scores") >= min_score
+
+    if bbox is not None:
+        x1, y1, x2, y2 = bbox
+        boxes = _column(store_dir, "boxes")
+        mask &= (boxes[:, 0] < x2) & (boxes[:, 2] > x1) & (boxes[:, 1] < y2) & (boxes[:, 3] > y1)
+
+    index = np.flatnonzero(mask)
+    if limit is not None:
+        index = index[:limit]
+
+    return (
+        np.asarray(_column(store_dir, "boxes")[index]),
+        np.asarray(_column(store_dir, "classes")[index]),
+        np.asarray(_column(store_dir, "scores")[index]),
+        meta,
+    )
+
+
+def to_json(
+    boxes: np.ndarray,
+    classes: np.ndarray,
+    scores: np.ndarray,
+    meta: Dict[str, Any],
+) -> Dict[str, Any]:
+    """Детекции в JSON: список объектов с классом, уверенностью и боксом в пикселях."""
+    names = meta["names"]
+    return {
+        "image": meta["image"],
+        "names": names,
+        "total": meta["count"],
+        "count": int(len(boxes)),
+        "detections": [
+            {
+                "class_id": int(cls),
+                "class_name": names.get(str(int(cls)), str(int(cls))),
+                "score": round(float(score), 4),
+                "box": [round(float(v), 1) for v in box],
+            }
+            for box, cls, score in zip(boxes, classes, scores)
+        ],
+    }
+
+
+def to_geojson(
+    boxes: np.ndarray,
+    classes: np.ndarray,
+    scores: np.ndarray,
+    meta: Dict[str, Any],
+) -> Dict[str, Any]:
+    """
+    Детекции в GeoJSON. Если рядом с растром есть world-файл, координаты переводятся
+    в систему координат ортомозаики, иначе остаются пиксельными.
+    """
+    names = meta["names"]
+    world = meta["image"].get("world_file")
+
+    def point(x: float, y: float) -> List[float]:
+        if world is None:
+            return [float(x), float(y)]
+        a, d, b, e, c, f = world
+        return [a * x + b * y + c, d * x + e * y + f]
+
+    features = []
+    for box, cls, score in zip(boxes, classes, scores):
+        x1, y1, x2, y2 = (float(v) for v in box)
+        ring = [point(x1, y1), point(x2, y1), point(x2, y2), point(x1, y2), point(x1, y1)]
+        features.append(
+            {
+                "type": "Feature",
+                "geometry": {"type": "Polygon", "coordinates": [ring]},
+                "properties": {
+                    "class_id": int(cls),
+                    "class_name": names.get(str(int(cls)), str(int(cls))),
+                    "score": round(float(score), 4),
+                    "pixel_box": [round(v, 1) for v in (x1, y1, x2, y2)],
+                },
+            }
+        )
+
+    return {
+        "type": "FeatureCollection",
+        "properties": {
+            "image": meta["image"],
+            "coordinates": "pixels" if world is None else "world_file",
+        },
+        "features": features,
+    }
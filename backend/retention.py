@@ -0,0 +1,297 @@
+import logging
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import blobs
+import blockgrid
+import jobs
+import manifest
+import metashape
+import pyramid
+import raster
+import registry
+
+try:
+    import fcntl
+except ImportError:  # Windows: проходы исключают друг друга только в пределах процесса
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Квота на папку сессий, ГБ (0 — без квоты)
+DEFAULT_QUOTA_GB = 0.0
+# Сессии старше стольких дней удаляются целиком (0 — без ограничения)
+DEFAULT_MAX_AGE_DAYS = 0.0
+# Период фоновой проверки, минуты
+DEFAULT_INTERVAL_MIN = 10.0
+# Сессии, менявшиеся недавно (идёт загрузка или просмотр), не трогаем, минуты
+DEFAULT_GRACE_MIN = 60.0
+
+# Что удаляется раньше: сначала то, что можно пересоздать или что не нужно
+# для просмотра результата, и только потом сессия целиком.
+INTERMEDIATES = "intermediates"  # проект Metashape с картами глубины, несжатые .raw.npy
+PYRAMIDS = "pyramids"            # пирамиды тайлов (просмотрщик откатится к целому файлу)
+SESSION = "session"
+BLOBS = "blobs"                  # содержимое хранилища снимков без ссылок из сессий
+# Файл блокировки в папке сессий: один проход очистки на все воркеры uvicorn
+LOCK_NAME = "retention.lock"
+
+_run_lock = threading.Lock()
+_stop = threading.Event()
+_thread: Optional[threading.Thread] = None
+_last_report: Optional[Dict[str, Any]] = None
+
+
+def _env_float(name: str, default: float) -> float:
+    return max(0.0, float(os.getenv(name, default)))
+
+
+def settings() -> Dict[str, float]:
+    return {
+        "quota_bytes": int(_env_float("RETENTION_QUOTA_GB", DEFAULT_QUOTA_GB) * 1024 ** 3),
+        "max_age_sec": _env_float("RETENTION_MAX_AGE_DAYS", DEFAULT_MAX_AGE_DAYS) * 86400,
+        "interval_sec": max(1.0, _env_float("RETENTION_INTERVAL_MIN", DEFAULT_INTERVAL_MIN) * 60),
+        "grace_sec": _env_float("RETENTION_GRACE_MIN", DEFAULT_GRACE_MIN) * 60,
+    }
+
+
+def is_enabled() -> bool:
+    config = settings()
+    return config["quota_bytes"] > 0 or config["max_age_sec"] > 0
+
+
+def _freed_bytes(path: str) -> int:
+    """
+    Сколько места освободит удаление. Файлы с другими жёсткими ссылками
+    (снимки из хранилища blobs.py) не считаются: их место освобождается,
+    только когда хранилище удалит ставшее ненужным содержимое.
+    """
+    paths = [path]
+    if os.path.isdir(path):
+        paths = [os.path.join(dirpath, name) for dirpath, _, names in os.walk(path) for name in names]
+    total = 0
+    for file_path in paths:
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            continue
+        if stat.st_nlink <= 1:
+            total += stat.st_size
+    return total
+
+
+def _remove(path: str) -> int:
+    """Удаляет файл или папку и возвращает освобождённый объём."""
+    size = _freed_bytes(path)
+    try:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    except FileNotFoundError:
+        return 0
+    return size
+
+
+def _intermediates(base: str) -> List[str]:
+    """
+    Проекты Metashape (.psx, папка .files с картами глубины, контрольная точка),
+    сетки блоков экспорта (уже собранные в .npy) и кэши .raw.npy.
+    """
+    found = []
+    metashape_dir = os.path.join(base, "metashape")
+    if os.path.isdir(metashape_dir):
+        for entry in os.scandir(metashape_dir):
+            if entry.name.endswith((".psx", ".files", metashape.CHECKPOINT_SUFFIX, blockgrid.GRID_SUFFIX)):
+                found.append(entry.path)
+    for sub in registry.SUBDIRS:
+        folder = os.path.join(base, sub)
+        if os.path.isdir(folder):
+            found.extend(
+                entry.path for entry in os.scandir(folder)
+                if entry.is_file() and entry.name.endswith(raster.RAW_SUFFIX)
+            )
+    return found
+
+
+def _pyramids(base: str) -> List[str]:
+    found = []
+    for sub in ("metashape", "ai"):
+        folder = os.path.join(base, sub)
+        if os.path.isdir(folder):
+            found.extend(
+                entry.path for entry in os.scandir(folder)
+                if entry.is_dir() and entry.name.endswith(pyramid.PYRAMID_SUFFIX)
+            )
+    return found
+
+
+TIERS: Tuple[Tuple[str, Callable[[str], List[str]]], ...] = (
+    (INTERMEDIATES, _intermediates),
+    (PYRAMIDS, _pyramids),
+)
+
+
+def _busy_sessions() -> set:
+    """Сессии с задачами в очереди или в работе."""
+    return {
+        job["session_id"] for job in jobs.list_jobs()
+        if job["status"] in (jobs.QUEUED, jobs.RUNNING)
+    }
+
+
+def _candidates(root: str, grace_sec: float) -> List[Dict[str, Any]]:
+    """
+    Сессии, которые можно чистить, в порядке LRU (давно не менявшиеся первыми).
+    Последняя сессия, обрабатываемые и недавно менявшиеся не трогаются.
+    """
+    sessions = registry.list_sessions(root, limit=None)
+    if not sessions:
+        return []
+    newest = sessions[0]["id"]
+    busy = _busy_sessions()
+    cutoff = time.time() - grace_sec
+    eligible = [
+        s for s in sessions
+        if s["id"] != newest
+        and s["id"] not in busy
+        and s["state"] != registry.PROCESSING
+        and s["updated"] < cutoff
+    ]
+    return sorted(eligible, key=lambda s: s["updated"])
+
+
+def _delete_session(root: str, session_id: int) -> int:
+    """Удаляет сессию и снимки хранилища, на которые ссылалась только она."""
+    base = registry.session_dir(root, session_id)
+    hashes = manifest.hashes(base)
+    freed = _remove(base)
+    registry.delete(root, session_id)
+    return freed + blobs.release(hashes)
+
+
+@contextmanager
+def _sweep_lock(root: str) -> Iterator[bool]:
+    """
+    Занимает право на проход очистки без ожидания: в этом процессе — через
+    _run_lock, между воркерами uvicorn — через flock файла LOCK_NAME, как
+    слоты этапов в jobs.py. Блок получает False, если проход уже идёт.
+    """
+    if not _run_lock.acquire(blocking=False):
+        yield False
+        return
+    try:
+        if fcntl is None:
+            yield True
+            return
+        os.makedirs(root, exist_ok=True)
+        with open(os.path.join(root, LOCK_NAME), "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            # Закрытие файла снимает блокировку
+            yield True
+    finally:
+        _run_lock.release()
+
+
+def run_once(root: str) -> Optional[Dict[str, Any]]:
+    """
+    Один проход очистки. Сначала из хранилища снимков удаляется содержимое,
+    на которое не ссылается ни одна сессия, затем сессии старше RETENTION_MAX_AGE_DAYS.
+    Затем, пока папка сессий больше квоты, у самых давних сессий удаляются
+    промежуточные файлы, потом пирамиды тайлов, и только потом сессии целиком.
+    Возвращает отчёт или None, если проход уже идёт в другом потоке или процессе.
+    """
+    global _last_report
+    with _sweep_lock(root) as acquired:
+        if not acquired:
+            return None
+        config = settings()
+        started = time.time()
+        usage = registry.folder_bytes(root)
+        report: Dict[str, Any] = {
+            "started": started,
+            "quota_bytes": config["quota_bytes"],
+            "usage_before": usage,
+            "reclaimed_bytes": 0,
+            "removed": [],
+        }
+
+        def record(session_id: Optional[int], kind: str, freed: int) -> None:
+            nonlocal usage
+            usage -= freed
+            report["reclaimed_bytes"] += freed
+            report["removed"].append({"session_id": session_id, "kind": kind, "bytes": freed})
+
+        if blobs.is_enabled():
+            collected = blobs.gc()
+            if collected["freed_bytes"]:
+                record(None, BLOBS, collected["freed_bytes"])
+
+        candidates = _candidates(root, config["grace_sec"])
+
+        if config["max_age_sec"] > 0:
+            expired = started - config["max_age_sec"]
+            for session in [s for s in candidates if s["created"] < expired]:
+                record(session["id"], SESSION, _delete_session(root, session["id"]))
+                candidates.remove(session)
+
+        if config["quota_bytes"] > 0:
+            for kind, collect in TIERS:
+                for session in candidates:
+                    if usage <= config["quota_bytes"]:
+                        break
+                    base = registry.session_dir(root, session["id"])
+                    freed = sum(_remove(path) for path in collect(base))
+                    if freed:
+                        record(session["id"], kind, freed)
+                        registry.update(root, session["id"], total_bytes=registry.folder_bytes(base))
+            for session in candidates:
+                if usage <= config["quota_bytes"]:
+                    break
+                record(session["id"], SESSION, _delete_session(root, session["id"]))
+
+        report["usage_after"] = usage
+        report["finished"] = time.time()
+        if report["removed"]:
+            logger.info(
+                "Очистка сессий: освобождено %d байт, удалено %d объектов",
+                report["reclaimed_bytes"], len(report["removed"]),
+            )
+        _last_report = report
+        return report
+
+
+def last_report() -> Optional[Dict[str, Any]]:
+    return _last_report
+
+
+def _loop(root: str) -> None:
+    while not _stop.is_set():
+        try:
+            run_once(root)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Ошибка фоновой очистки сессий")
+        _stop.wait(settings()["interval_sec"])
+
+
+def start(root: str) -> bool:
+    """Запускает фоновую очистку, если задана квота или максимальный возраст."""
+    global _thread
+    if not is_enabled() or (_thread is not None and _thread.is_alive()):
+        return False
+    _stop.clear()
+    _thread = threading.Thread(target=_loop, args=(root,), name="retention", daemon=True)
+    _thread.start()
+    return True
+
+
+def stop() -> None:
+    _stop.set()
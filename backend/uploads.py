@@ -0,0 +1,286 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+import anyio
+
+import blobs
+import ingest
+
+DEFAULT_DB_PATH = os.path.join("tmp", "uploads.sqlite")
+# Размер части по умолчанию для загрузки по номерам частей, МБ
+DEFAULT_PART_MB = 8
+
+UPLOADING = "uploading"
+COMPLETED = "completed"
+
+_schema_lock = threading.Lock()
+_schema_ready = False
+
+Range = Tuple[int, int]
+
+
+def _db_path() -> str:
+    path = os.getenv("UPLOADS_DB", DEFAULT_DB_PATH)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    return path
+
+
+def _connect() -> sqlite3.Connection:
+    global _schema_ready
+    conn = sqlite3.connect(_db_path(), timeout=30)
+    conn.row_factory = sqlite3.Row
+    with _schema_lock:
+        if not _schema_ready:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS uploads ("
+                " id TEXT PRIMARY KEY,"
+                " session_id INTEGER NOT NULL,"
+                " path TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " part_size INTEGER NOT NULL,"
+                " sha256 TEXT,"
+                " ranges TEXT NOT NULL DEFAULT '[]',"
+                " status TEXT NOT NULL,"
+                " created REAL NOT NULL,"
+                " updated REAL NOT NULL)"
+            )
+            conn.commit()
+            _schema_ready = True
+    return conn
+
+
+def default_part_size() -> int:
+    return max(1, int(os.getenv("UPLOAD_PART_MB", DEFAULT_PART_MB))) * 1024 * 1024
+
+
+def part_path(path: str) -> str:
+    return path + ingest.PART_SUFFIX
+
+
+def _merge(ranges: List[Range], new: Range) -> List[Range]:
+    """Добавляет полуинтервал [start, end) к отсортированному списку и склеивает соседние."""
+    merged: List[Range] = []
+    start, end = new
+    for r_start, r_end in ranges:
+        if r_end < start or r_start > end:
+            merged.append((r_start, r_end))
+        else:
+            start, end = min(start, r_start), max(end, r_end)
+    merged.append((start, end))
+    return sorted(merged)
+
+
+def _row_to_upload(row: sqlite3.Row) -> Dict[str, Any]:
+    upload = dict(row)
+    upload["ranges"] = [tuple(r) for r in json.loads(upload["ranges"])]
+    upload["name"] = os.path.basename(upload["path"])
+    upload["received"] = sum(end - start for start, end in upload["ranges"])
+    upload["complete"] = upload["received"] == upload["size"]
+    upload["missing_parts"] = missing_parts(upload)
+    return upload
+
+
+def missing_parts(upload: Dict[str, Any]) -> List[int]:
+    """Номера частей, которые ещё не получены полностью."""
+    part_size = upload["part_size"]
+    count = (upload["size"] + part_size - 1) // part_size
+    missing = []
+    for number in range(count):
+        start = number * part_size
+        end = min(start + part_size, upload["size"])
+        if not any(r_start <= start and end <= r_end for r_start, r_end in upload["ranges"]):
+            missing.append(number)
+    return missing
+
+
+def create(
+    session_id: int,
+    dest_path: str,
+    size: int,
+    sha256: Optional[str] = None,
+    part_size: Optional[int] = None,
+) -> Dict[str, Any]:
+    """
+    Создаёт загрузку: файл сразу создаётся на своём месте как .part нужного размера,
+    части пишутся в него по смещениям, а при завершении он только переименовывается.
+    Если заявленный sha256 уже есть в хранилище (см. blobs.py), файл сразу
+    берётся оттуда и загрузка создаётся завершённой — байты передавать не нужно.
+    """
+    if size <= 0:
+        raise ValueError("Размер файла должен быть положительным")
+    if os.path.exists(dest_path):
+        raise FileExistsError(f"Файл {os.path.basename(dest_path)} уже загружен")
+
+    sha256 = sha256.lower() if sha256 else None
+    status, ranges = UPLOADING, []
+    if sha256 and blobs.link_into(sha256, size, dest_path):
+        status, ranges = COMPLETED, [(0, size)]
+    else:
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        with open(part_path(dest_path), "wb") as f:
+            f.truncate(size)
+
+    upload_id = uuid.uuid4().hex
+    now = time.time()
+    conn = _connect()
+    try:
+        conn.execute(
+            "INSERT INTO uploads (id, session_id, path, size, part_size, sha256, ranges, status, created, updated)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                upload_id, session_id, dest_path, size, part_size or default_part_size(),
+                sha256, json.dumps(ranges), status, now, now,
+            ),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+    upload = get(upload_id)
+    upload["deduplicated"] = status == COMPLETED
+    return upload
+
+
+def get(upload_id: str) -> Optional[Dict[str, Any]]:
+    conn = _connect()
+    try:
+        row = conn.execute("SELECT * FROM uploads WHERE id = ?", (upload_id,)).fetchone()
+    finally:
+        conn.close()
+    return None if row is None else _row_to_upload(row)
+
+
+def _record_range(upload_id: str, received: Range) -> Dict[str, Any]:
+    """Отмечает полученный диапазон; параллельные части обновляют список атомарно."""
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("SELECT ranges FROM uploads WHERE id = ?", (upload_id,)).fetchone()
+        ranges = _merge([tuple(r) for r in json.loads(row["ranges"])], received)
+        conn.execute(
+            "UPDATE uploads SET ranges = ?, updated = ? WHERE id = ?",
+            (json.dumps(ranges), time.time(), upload_id),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+    return get(upload_id)
+
+
+async def write(upload_id: str, offset: int, chunks: AsyncIterator[bytes]) -> Dict[str, Any]:
+    """
+    Пишет тело запроса в .part по смещению, не держа его в памяти целиком.
+    Диапазон засчитывается только после того, как записан полностью,
+    поэтому оборванная посередине часть просто отправляется заново.
+    """
+    upload = get(upload_id)
+    if upload is None:
+        raise KeyError(upload_id)
+    if upload["status"] != UPLOADING:
+        raise FileExistsError("Загрузка уже завершена")
+    if offset < 0 or offset >= upload["size"]:
+        raise ValueError(f"Смещение {offset} вне файла размером {upload['size']}")
+
+    position = offset
+    async with await anyio.open_file(part_path(upload["path"]), "r+b") as out:
+        await out.seek(offset)
+        async for chunk in chunks:
+            if position + len(chunk) > upload["size"]:
+                raise ValueError("Часть выходит за пределы файла")
+            await out.write(chunk)
+            position += len(chunk)
+        await out.flush()
+
+    if position == offset:
+        return upload
+    return _record_range(upload_id, (offset, position))
+
+
+def part_offset(upload: Dict[str, Any], number: int) -> int:
+    offset = number * upload["part_size"]
+    if number < 0 or offset >= upload["size"]:
+        raise ValueError(f"Части {number} нет в файле")
+    return offset
+
+
+def _file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(ingest.chunk_size()), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def finalize(upload_id: str) -> Dict[str, Any]:
+    """
+    Проверяет, что получены все байты, заголовок — изображение, а sha256 совпадает
+    с заявленным, и переименовывает .part в итоговый файл (без копирования),
+    после чего файл переводится на хранилище по содержимому.
+    """
+    upload = get(upload_id)
+    if upload is None:
+        raise KeyError(upload_id)
+    if upload["status"] == COMPLETED:
+        return upload
+    if not upload["complete"]:
+        raise ValueError(
+            f"Получено {upload['received']} из {upload['size']} байт, "
+            f"не хватает частей: {upload['missing_parts'][:20]}"
+        )
+
+    path = part_path(upload["path"])
+    with open(path, "rb") as f:
+        fmt = ingest.image_type(f.read(ingest.HEADER_SIZE))
+    if fmt is None:
+        raise ValueError(f"Файл {upload['name']} не является изображением")
+
+    sha256 = _file_sha256(path)
+    if upload["sha256"] and upload["sha256"] != sha256:
+        raise ValueError("Контрольная сумма sha256 не совпадает, файл нужно загрузить заново")
+
+    if os.path.exists(upload["path"]):
+        raise FileExistsError(f"Файл {upload['name']} уже загружен")
+    os.replace(path, upload["path"])
+    deduplicated = blobs.is_enabled() and blobs.adopt(upload["path"], sha256)["deduplicated"]
+
+    conn = _connect()
+    try:
+        conn.execute(
+            "UPDATE uploads SET status = ?, sha256 = ?, updated = ? WHERE id = ?",
+            (COMPLETED, sha256, time.time(), upload_id),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+    upload = get(upload_id)
+    upload["format"] = fmt
+    upload["deduplicated"] = deduplicated
+    return upload
+
+
+def abort(upload_id: str) -> bool:
+    """Отменяет незавершённую загрузку и удаляет её .part."""
+    upload = get(upload_id)
+    if upload is None:
+        return False
+    if upload["status"] == UPLOADING:
+        try:
+            os.remove(part_path(upload["path"]))
+        except FileNotFoundError:
+            pass
+
+    conn = _connect()
+    try:
+        conn.execute("DELETE FROM uploads WHERE id = ?", (upload_id,))
+        conn.commit()
+    finally:
+        conn.close()
+    return True
@@ -0,0 +1,147 @@
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Any, Deque, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+# 0 — инференс в процессе API, без пула
+DEFAULT_WORKERS = 0
+# Сколько батчей может ждать в очереди на каждый процесс пула
+DEFAULT_QUEUE_PER_WORKER = 2
+
+TileResult = Tuple[np.ndarray, np.ndarray, np.ndarray]
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+# Общий для всех запросов лимит батчей «в полёте» — ограниченная очередь пула
+_slots: Optional[threading.BoundedSemaphore] = None
+_names: Optional[Dict[int, str]] = None
+
+
+def resolve_workers() -> int:
+    """Число процессов инференса из переменной окружения AI_WORKERS."""
+    return max(0, int(os.getenv("AI_WORKERS", DEFAULT_WORKERS)))
+
+
+def _resolve_queue_size(workers: int) -> int:
+    """Размер очереди батчей из AI_QUEUE_SIZE или по числу процессов."""
+    default = workers * DEFAULT_QUEUE_PER_WORKER
+    return max(workers, int(os.getenv("AI_QUEUE_SIZE", default)))
+
+
+def _init_worker(threads: int) -> None:
+    """
+    Инициализация процесса пула: делим ядра между процессами
+    и загружаем модель один раз на процесс.
+    """
+    try:
+        import torch
+
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+
+    import ai
+
+    ai._get_model()
+
+
+def _infer_in_worker(
+    tiles: List[np.ndarray],
+    tile_size: int,
+    conf: Optional[float],
+) -> List[TileResult]:
+    import ai
+
+    return ai._infer_tiles(ai._get_model(), tiles, tile_size, conf)
+
+
+def _names_in_worker() -> Dict[int, str]:
+    import ai
+
+    return ai._model_names(ai._get_model())
+
+
+def get_pool() -> Optional[ProcessPoolExecutor]:
+    """Возвращает пул процессов инференса или None, если пул выключен."""
+    global _pool, _slots
+    workers = resolve_workers()
+    if workers == 0:
+        return None
+
+    with _pool_lock:
+        if _pool is None:
+            threads = max(1, (os.cpu_count() or 1) // workers)
+            # spawn: fork процесса с потоками torch и uvicorn небезопасен
+            _pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(threads,),
+            )
+            _slots = threading.BoundedSemaphore(_resolve_queue_size(workers))
+        return _pool
+
+
+def model_names() -> Dict[int, str]:
+    """Имена классов модели, загруженной в процессах пула."""
+    global _names
+    pool = get_pool()
+    if pool is None:
+        raise RuntimeError("Пул инференса выключен")
+    if _names is None:
+        _names = pool.submit(_names_in_worker).result()
+    return _names
+
+
+def map_batches(
+    batches: Iterable[Tuple[Any, List[np.ndarray]]],
+    tile_size: int,
+    conf: Optional[float] = None,
+) -> Iterator[Tuple[Any, List[TileResult]]]:
+    """
+    Раздаёт батчи тайлов процессам пула и отдаёт результаты в исходном порядке.
+    Каждый элемент batches — (ключ, тайлы); ключ возвращается вместе с результатом.
+    Если очередь заполнена, чтение следующих батчей ждёт освобождения места.
+    """
+    pool = get_pool()
+    slots = _slots
+    if pool is None or slots is None:
+        raise RuntimeError("Пул инференса выключен")
+
+    pending: Deque[Tuple[Any, Future]] = deque()
+
+    def release(_: Future) -> None:
+        slots.release()
+
+    try:
+        for key, tiles in batches:
+            # Пока ждём место в очереди, забираем уже готовые результаты
+            while not slots.acquire(timeout=0.05):
+                if pending and pending[0][1].done():
+                    ready_key, ready = pending.popleft()
+                    yield ready_key, ready.result()
+            future = pool.submit(_infer_in_worker, tiles, tile_size, conf)
+            future.add_done_callback(release)
+            pending.append((key, future))
+
+        while pending:
+            ready_key, ready = pending.popleft()
+            yield ready_key, ready.result()
+    finally:
+        for _, future in pending:
+            future.cancel()
+
+
+def shutdown_pool() -> None:
+    """Останавливает пул процессов инференса."""
+    global _pool, _slots, _names
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+        _slots = None
+        _names = None
@@ -4,13 +4,129 @@ import Header from './components/header/header'
 import Sidebar from './components/leftPanel/leftPanel'
 import ImageViewer from './components/imageViewer/imageViewer'
 import Loader from './components/loader/Loader'
+import { uploadFilesResumable } from './uploads'
 
 const API_BASE_URL = import.meta.env.VITE_API_BASE_URL ?? 'http://localhost:8000'
 
+// Подписи шагов пайплайна из потока прогресса
+const STEP_LABELS = {
+  addPhotos: 'Добавление фото',
+  matchPhotos: 'Сопоставление фото',
+  alignCameras: 'Выравнивание камер',
+  buildDepthMaps: 'Карты глубины',
+  buildModel: 'Построение модели',
+  buildDem: 'Построение DEM',
+  buildOrthomosaic: 'Построение ортомозаики',
+  exportRaster: 'Экспорт ортомозаики',
+  buildPyramid: 'Пирамида тайлов',
+  detect: 'Поиск дефектов',
+  projectPhotos: 'Перенос детекций снимков',
+}
+
+const formatElapsed = (seconds) => {
+  const total = Math.floor(seconds)
+  return `${Math.floor(total / 60)}:${String(total % 60).padStart(2, '0')}`
+}
+
+// Текст для индикатора загрузки по статусу задачи с прогрессом
+function describeProgress(status) {
+  if (status.status === 'queued') {
+    return 'Ждём очереди на обработку…'
+  }
+  const progress = status.progress
+  if (!progress?.step) {
+    return 'Обрабатываем…'
+  }
+  const step = progress.steps[progress.steps.length - 1]
+  const parts = [STEP_LABELS[progress.step] ?? progress.step]
+  if (progress.tiles_total) {
+    parts.push(`тайлы ${progress.tiles_done} из ${progress.tiles_total}`)
+  }
+  if (progress.photos_total) {
+    parts.push(`снимки ${progress.photos_done} из ${progress.photos_total}`)
+  }
+  parts.push(formatElapsed(step.elapsed))
+  return parts.join(' · ')
+}
+
+async function fetchJobResult(resultUrl) {
+  const response = await fetch(`${API_BASE_URL}${resultUrl}`)
+  const payload = await response.json().catch(() => null)
+  if (!response.ok) {
+    throw new Error(payload?.detail ?? 'Не удалось получить результат')
+  }
+  return payload
+}
+
+// Ждёт завершения фоновой задачи по потоку прогресса (Server-Sent Events)
+// и возвращает её результат (данные для оверлея). onProgress получает статус задачи,
+// onPreview — предварительный результат двухфазной задачи, как только он готов
+function waitForJob(jobId, onProgress, onPreview) {
+  return new Promise((resolve, reject) => {
+    const source = new EventSource(`${API_BASE_URL}/jobs/${jobId}/progress/stream`)
+    let previewRequested = false
+    source.addEventListener('progress', (event) => {
+      const status = JSON.parse(event.data)
+      onProgress?.(status)
+      if (status.preview_url && onPreview && !previewRequested) {
+        previewRequested = true
+        // Не удался предварительный результат — просто ждём полного
+        fetchJobResult(status.preview_url).then(onPreview).catch(() => {})
+      }
+      if (status.status === 'queued' || status.status === 'running') {
+        return
+      }
+      source.close()
+      if (status.status === 'failed') {
+        reject(new Error(status.error ?? 'Обработка завершилась с ошибкой'))
+      } else if (status.status === 'cancelled') {
+        reject(new Error('Обработка отменена'))
+      } else {
+        fetchJobResult(status.result_url).then(resolve, reject)
+      }
+    })
+    // После обрыва EventSource переподключается сам; CLOSED — сервер отказал
+    source.onerror = () => {
+      if (source.readyState === EventSource.CLOSED) {
+        reject(new Error('Потеряна связь с сервером'))
+      }
+    }
+  })
+}
+
+// Рисует боксы детекций поверх изображения и возвращает ссылку на JPEG
+async function renderDetections(imageUrl, detections) {
+  const image = new Image()
+  image.src = imageUrl
+  await image.decode()
+
+  const canvas = document.createElement('canvas')
+  canvas.width = image.naturalWidth
+  canvas.height = image.naturalHeight
+  const context = canvas.getContext('2d')
+  context.drawImage(image, 0, 0)
+  context.strokeStyle = '#00ff00'
+  context.fillStyle = '#00ff00'
+  context.lineWidth = 2
+  context.font = '16px sans-serif'
+  detections.detections.forEach(({ box, class_name: className, score }) => {
+    const [x1, y1, x2, y2] = box
+    context.strokeRect(x1, y1, x2 - x1, y2 - y1)
+    context.fillText(`${className} ${score.toFixed(2)}`, x1, Math.max(16, y1 - 4))
+  })
+
+  const blob = await new Promise((resolve) => canvas.toBlob(resolve, 'image/jpeg', 0.92))
+  return URL.createObjectURL(blob)
+}
+
 function App() {
   const [imageUrl, setImageUrl] = useState(null)
+  const [tiles, setTiles] = useState(null)
+  const [sourceUrl, setSourceUrl] = useState(null)
+  const [detections, setDetections] = useState(null)
   const [sessionId, setSessionId] = useState(null)
   const [loadingMessage, setLoadingMessage] = useState(null)
+  const [loadingPercent, setLoadingPercent] = useState(null)
   const [infoMessage, setInfoMessage] = useState(null)
   const [error, setError] = useState(null)
   
@@ -70,6 +186,38 @@ function App() {
     return payload.session_id
   }, [sessionId])
 
+  // Ответ в режиме render=client: если для изображения построена пирамида тайлов,
+  // просмотрщик грузит только видимые тайлы, иначе — превью под размер экрана
+  // (исходник целиком качается только для скачивания).
+  // Боксы рисует ImageViewer поверх картинки в координатах исходника
+  const showOverlayResult = useCallback(async (payload) => {
+    let nextTiles = null
+    let url = null
+    if (payload.tiles_url) {
+      const tilesResponse = await fetch(`${API_BASE_URL}${payload.tiles_url}`)
+      // 202 — пирамида ещё строится: пока показываем превью
+      nextTiles = tilesResponse.status === 200 ? await tilesResponse.json() : null
+    }
+
+    if (!nextTiles) {
+      const imageResponse = await fetch(`${API_BASE_URL}${payload.preview_url ?? payload.image_url}`)
+      if (!imageResponse.ok) {
+        throw new Error('Не удалось загрузить изображение')
+      }
+      url = URL.createObjectURL(await imageResponse.blob())
+    }
+
+    setImageUrl((prev) => {
+      if (prev) {
+        URL.revokeObjectURL(prev)
+      }
+      return url
+    })
+    setTiles(nextTiles)
+    setSourceUrl(payload.image_url)
+    setDetections(payload.detections)
+  }, [])
+
   const handleFetchAiImage = useCallback(async () => {
     setError(null)
     setInfoMessage(null)
@@ -77,7 +225,7 @@ function App() {
     try {
       const currentSessionId = await resolveSessionId()
       const response = await fetch(
-        `${API_BASE_URL}/ai/run?session_id=${currentSessionId}`,
+        `${API_BASE_URL}/ai/run?session_id=${currentSessionId}&render=client`,
       )
 
       if (!response.ok) {
@@ -95,20 +243,13 @@ function App() {
         throw new Error(errorMessage)
       }
 
-      const blob = await response.blob()
-      const url = URL.createObjectURL(blob)
-      setImageUrl((prev) => {
-        if (prev) {
-          URL.revokeObjectURL(prev)
-        }
-        return url
-      })
+      await showOverlayResult(await response.json())
     } catch (fetchError) {
       setError(fetchError.message ?? 'Не удалось загрузить изображение')
     } finally {
       setLoadingMessage(null)
     }
-  }, [resolveSessionId])
+  }, [resolveSessionId, showOverlayResult])
 
   const handleStartFlight = useCallback(async () => {
     setError(null)
@@ -142,37 +283,57 @@ function App() {
     setInfoMessage(null)
     setLoadingMessage('Загружаем фотографии и обрабатываем Metashape…')
     try {
-      const formData = new FormData()
-      Array.from(files).forEach((file) => {
-        formData.append('files', file)
+      // Фотографии отправляются докачиваемой загрузкой: обрыв связи не требует начинать заново
+      const uploadedSessionId = await uploadFilesResumable(files, (progress) => {
+        setLoadingMessage(`Загружаем фотографии… ${Math.round(progress * 100)}%`)
+        setLoadingPercent(progress * 100)
       })
+      setSessionId(uploadedSessionId)
+      setLoadingMessage('Обрабатываем Metashape…')
+      setLoadingPercent(null)
 
-      const response = await fetch(`${API_BASE_URL}/data/upload-and-process-metashape`, {
-        method: 'POST',
-        body: formData,
-      })
+      // Двухфазная обработка: сначала быстрый предварительный результат, затем полное качество
+      const response = await fetch(
+        `${API_BASE_URL}/jobs?session_id=${uploadedSessionId}&kind=metashape&render=client&two_phase=true`,
+        { method: 'POST' },
+      )
 
+      const job = await response.json().catch(() => null)
       if (!response.ok) {
-        const payload = await response.json().catch(() => null)
-        throw new Error(payload?.detail ?? 'Не удалось обработать фотографии')
+        throw new Error(job?.detail ?? 'Не удалось обработать фотографии')
       }
 
-      const blob = await response.blob()
-      const url = URL.createObjectURL(blob)
-      setImageUrl((prev) => {
-        if (prev) {
-          URL.revokeObjectURL(prev)
-        }
-        return url
-      })
+      // Metashape работает долго: запрос сразу возвращает задачу, а сервер присылает
+      // её прогресс — текущий шаг, процент и сколько шаг уже идёт. Предварительный
+      // результат показывается сразу, полная обработка продолжается в фоне
+      let previewShown = false
+      const payload = await waitForJob(
+        job.job_id,
+        (status) => {
+          if (previewShown) {
+            setInfoMessage(`Предварительный результат · полная обработка: ${describeProgress(status)}`)
+            return
+          }
+          setLoadingMessage(describeProgress(status))
+          setLoadingPercent(status.progress?.step ? status.progress.percent : null)
+        },
+        async (preview) => {
+          await showOverlayResult(preview)
+          previewShown = true
+          setLoadingMessage(null)
+          setLoadingPercent(null)
+        },
+      )
+      await showOverlayResult(payload)
 
       setInfoMessage('Metashape обработка завершена')
     } catch (uploadError) {
       setError(uploadError.message ?? 'Не удалось загрузить и обработать фотографии')
     } finally {
       setLoadingMessage(null)
+      setLoadingPercent(null)
     }
-  }, [])
+  }, [showOverlayResult])
 
   const handleUploadSingleForAI = useCallback(async (file) => {
     setError(null)
@@ -182,7 +343,7 @@ function App() {
       const formData = new FormData()
       formData.append('file', file)
 
-      const response = await fetch(`${API_BASE_URL}/data/upload-and-process-ai`, {
+      const response = await fetch(`${API_BASE_URL}/data/upload-and-process-ai?render=client`, {
         method: 'POST',
         body: formData,
       })
@@ -203,14 +364,7 @@ function App() {
         throw new Error(errorMessage)
       }
 
-      const blob = await response.blob()
-      const url = URL.createObjectURL(blob)
-      setImageUrl((prev) => {
-        if (prev) {
-          URL.revokeObjectURL(prev)
-        }
-        return url
-      })
+      await showOverlayResult(await response.json())
 
       setInfoMessage('AI обработка завершена')
     } catch (uploadError) {
@@ -218,42 +372,65 @@ function App() {
     } finally {
       setLoadingMessage(null)
     }
-  }, [])
+  }, [showOverlayResult])
 
   const handleClearImage = () => {
     if (imageUrl) {
       URL.revokeObjectURL(imageUrl)
     }
     setImageUrl(null)
+    setTiles(null)
+    setSourceUrl(null)
+    setDetections(null)
     setInfoMessage(null)
   }
 
-  const handleDownloadImage = useCallback(() => {
-    if (!imageUrl) {
+  const handleDownloadImage = useCallback(async () => {
+    if (!imageUrl && !sourceUrl) {
       setError('Нет изображения для скачивания')
       return
     }
 
     try {
+      // На экране тайлы или превью, поэтому исходник целиком качаем только по запросу
+      let original = imageUrl
+      if (sourceUrl) {
+        const response = await fetch(`${API_BASE_URL}${sourceUrl}`)
+        if (!response.ok) {
+          throw new Error('Не удалось загрузить изображение')
+        }
+        original = URL.createObjectURL(await response.blob())
+      }
+
+      // Боксы рисуются на клиенте, поэтому для скачивания накладываем их на копию картинки
+      const href = detections ? await renderDetections(original, detections) : original
       // Создаём временную ссылку для скачивания
       const link = document.createElement('a')
-      link.href = imageUrl
+      link.href = href
       link.download = `processed-image-${Date.now()}.jpg`
       document.body.appendChild(link)
       link.click()
       document.body.removeChild(link)
+      if (href !== original) {
+        URL.revokeObjectURL(href)
+      }
+      if (original !== imageUrl) {
+        URL.revokeObjectURL(original)
+      }
       setInfoMessage('Изображение скачано')
     } catch (downloadError) {
       setError('Не удалось скачать изображение')
     }
-  }, [imageUrl])
+  }, [imageUrl, sourceUrl, detections])
+
+  const hasImage = Boolean(imageUrl || tiles)
 
   return (
-    <div className={`app ${imageUrl ? 'app--fullscreen-view' : ''} ${theme === 'dark' ? 'dark-theme' : ''}`}>
-      {!imageUrl && <Header name="MOPS" theme={theme} onToggleTheme={toggleTheme} />}
+    <div className={`app ${hasImage ? 'app--fullscreen-view' : ''} ${theme === 'dark' ? 'dark-theme' : ''}`}>
+      {!hasImage && <Header name="MOPS" theme={theme} onToggleTheme={toggleTheme} />}
       {loadingMessage && (
         <div className="loader-overlay">
-          <Loader />
+          <Loader percent={loadingPercent} />
           <span className="loader-overlay__text">{loadingMessage}</span>
         </div>
       )}
@@ -264,7 +441,7 @@ function App() {
         onUploadSingleForAI={handleUploadSingleForAI}
         onClearImage={handleClearImage}
         onDownloadImage={handleDownloadImage}
-        hasImage={Boolean(imageUrl)}
+        hasImage={hasImage}
         isLoading={Boolean(loadingMessage)}
       />
       <div className="app-status-panel">
@@ -273,7 +450,7 @@ function App() {
         )}
         {error && <span className="app-status app-status--error">{error}</span>}
       </div>
-      <ImageViewer imageSrc={imageUrl} />
+      <ImageViewer imageSrc={imageUrl} tiles={tiles} detections={detections} />
    </div>
   )
 }
@@ -1,13 +1,21 @@
-import React, { useState, useRef, useCallback, useEffect } from 'react';
+import React, { useState, useRef, useCallback, useEffect, useMemo } from 'react';
+import TileLayer from './tileLayer';
 import './imageViewer.css';
 
-const ImageViewer = ({ imageSrc }) => {
+// Доля окна, которую занимает сцена с изображением
+const FIT_RATIO = 0.9;
+
+const ImageViewer = ({ imageSrc, tiles, detections }) => {
   const [scale, setScale] = useState(1);
+  const [minScore, setMinScore] = useState(0);
+  const [hiddenClasses, setHiddenClasses] = useState([]);
   const [position, setPosition] = useState({ x: 0, y: 0 });
   const [isDragging, setIsDragging] = useState(false);
   const [dragStart, setDragStart] = useState({ x: 0, y: 0 });
   
-  const imageRef = useRef(null);
+  const [windowSize, setWindowSize] = useState({ width: window.innerWidth, height: window.innerHeight });
+
+  const stageRef = useRef(null);
   const containerRef = useRef(null);
 
   const handleWheel = useCallback((e) => {
@@ -40,7 +48,7 @@ const ImageViewer = ({ imageSrc }) => {
 
     // Ограничение перемещения за пределы изображения
     const containerRect = containerRef.current.getBoundingClientRect();
-    const imageRect = imageRef.current.getBoundingClientRect();
+    const imageRect = stageRef.current.getBoundingClientRect();
     
     const maxX = Math.max(0, (imageRect.width * scale - containerRect.width) / 2);
     const maxY = Math.max(0, (imageRect.height * scale - containerRect.height) / 2);
@@ -71,9 +79,53 @@ const ImageViewer = ({ imageSrc }) => {
   useEffect(() => {
     setScale(1);
     setPosition({ x: 0, y: 0 });
-  }, [imageSrc]);
+  }, [imageSrc, tiles]);
+
+  useEffect(() => {
+    const handleResize = () => setWindowSize({ width: window.innerWidth, height: window.innerHeight });
+    window.addEventListener('resize', handleResize);
+    return () => window.removeEventListener('resize', handleResize);
+  }, []);
+
+  // Для пирамиды тайлов размер сцены задаём сами: вписываем изображение в окно
+  const stageSize = useMemo(() => {
+    if (!tiles) {
+      return null;
+    }
+    const fit = Math.min(
+      (windowSize.width * FIT_RATIO) / tiles.width,
+      (windowSize.height * FIT_RATIO) / tiles.height,
+    );
+    return { width: tiles.width * fit, height: tiles.height * fit };
+  }, [tiles, windowSize]);
+
+  useEffect(() => {
+    setMinScore(0);
+    setHiddenClasses([]);
+  }, [detections]);
+
+  const classNames = useMemo(() => (
+    detections ? [...new Set(detections.detections.map((d) => d.class_name))] : []
+  ), [detections]);
+
+  // Фильтрация на клиенте: повторный запрос к серверу не нужен
+  const visibleDetections = useMemo(() => (
+    detections
+      ? detections.detections.filter((d) => (
+        d.score >= minScore && !hiddenClasses.includes(d.class_name)
+      ))
+      : []
+  ), [detections, minScore, hiddenClasses]);
+
+  const toggleClass = (className) => {
+    setHiddenClasses((prev) => (
+      prev.includes(className)
+        ? prev.filter((name) => name !== className)
+        : [...prev, className]
+    ));
+  };
 
-  if (!imageSrc) {
+  if (!imageSrc && !tiles) {
     return (
       <div className="image-viewer image-viewer--empty">
         <p>Результат AI пока не загружен</p>
@@ -90,22 +142,88 @@ const ImageViewer = ({ imageSrc }) => {
       onMouseLeave={handleMouseUp}
     >
       <div className="image-viewer__container" ref={containerRef}>
-        <img
-          ref={imageRef}
-          src={imageSrc}
-          alt="Просмотр"
-          className="image-viewer__img"
+        <div
+          ref={stageRef}
+          className="image-viewer__stage"
           style={{
+            ...stageSize,
             transform: `scale(${scale}) translate(${position.x}px, ${position.y}px)`,
             cursor: scale > 1 ? (isDragging ? 'grabbing' : 'grab') : 'default'
           }}
           onMouseDown={handleMouseDown}
-        />
+        >
+          {tiles ? (
+            <TileLayer
+              tiles={tiles}
+              stageWidth={stageSize.width}
+              stageHeight={stageSize.height}
+              scale={scale}
+              position={position}
+            />
+          ) : (
+            <img
+              src={imageSrc}
+              alt="Просмотр"
+              className="image-viewer__img"
+            />
+          )}
+          {detections && (
+            <svg
+              className="image-viewer__overlay"
+              viewBox={`0 0 ${detections.image.width} ${detections.image.height}`}
+              preserveAspectRatio="none"
+            >
+              {visibleDetections.map(({ box, class_name: className, score }, index) => (
+                <g key={index}>
+                  <rect
+                    x={box[0]}
+                    y={box[1]}
+                    width={box[2] - box[0]}
+                    height={box[3] - box[1]}
+                    className="image-viewer__box"
+                  />
+                  <text x={box[0]} y={box[1] - 4} className="image-viewer__label">
+                    {className} {score.toFixed(2)}
+                  </text>
+                </g>
+              ))}
+            </svg>
+          )}
+        </div>
         
         <div className="image-viewer__zoom-info">
           {Math.round(scale * 100)}%
         </div>
 
+        {detections && (
+          <div className="image-viewer__filters">
+            <label className="image-viewer__filter">
+              Уверенность ≥ {minScore.toFixed(2)}
+              <input
+                type="range"
+                min="0"
+                max="1"
+                step="0.05"
+                value={minScore}
+                onChange={(e) => setMinScore(Number(e.target.value))}
+              />
+            </label>
+            {classNames.map((className) => (
+              <label key={className} className="image-viewer__filter">
+                <input
+                  type="checkbox"
+                  checked={!hiddenClasses.includes(className)}
+                  onChange={() => toggleClass(className)}
+                />
+                {className}
+              </label>
+            ))}
+            <span className="image-viewer__filter">
+              {visibleDetections.length} / {detections.count}
+            </span>
+          </div>
+        )}
+
         <div className="image-viewer__controls">
           <button className="image-viewer__btn" onClick={zoomOut} title="Уменьшить">
             −
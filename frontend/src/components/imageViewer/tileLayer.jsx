@@ -0,0 +1,108 @@
+import React, { useMemo } from 'react';
+
+const API_BASE_URL = import.meta.env.VITE_API_BASE_URL ?? 'http://localhost:8000';
+
+// Фоновый уровень грузится целиком и виден сразу, пока подгружаются детальные тайлы
+const BACKGROUND_MAX_TILES = 4;
+
+const tileUrl = (tiles, level, col, row) => `${API_BASE_URL}${tiles.tiles_url
+  .replace('{level}', level)
+  .replace('{col}', col)
+  .replace('{row}', row)}`;
+
+// Тайлы уровня, попадающие в область изображения (в пикселях исходного разрешения)
+const levelTiles = (tiles, level, region) => {
+  const factor = 2 ** (tiles.max_level - level);
+  const span = tiles.tile_size * factor;
+  const cols = Math.ceil(tiles.width / span);
+  const rows = Math.ceil(tiles.height / span);
+
+  const col1 = Math.max(0, Math.floor(region.x1 / span));
+  const col2 = Math.min(cols - 1, Math.floor((region.x2 - 1) / span));
+  const row1 = Math.max(0, Math.floor(region.y1 / span));
+  const row2 = Math.min(rows - 1, Math.floor((region.y2 - 1) / span));
+
+  const result = [];
+  for (let row = row1; row <= row2; row += 1) {
+    for (let col = col1; col <= col2; col += 1) {
+      const x = col * span;
+      const y = row * span;
+      result.push({
+        key: `${level}/${col}_${row}`,
+        src: tileUrl(tiles, level, col, row),
+        style: {
+          left: `${(x / tiles.width) * 100}%`,
+          top: `${(y / tiles.height) * 100}%`,
+          width: `${(Math.min(span, tiles.width - x) / tiles.width) * 100}%`,
+          height: `${(Math.min(span, tiles.height - y) / tiles.height) * 100}%`,
+        },
+      });
+    }
+  }
+  return result;
+};
+
+/**
+ * Слой тайлов пирамиды DeepZoom внутри сцены просмотрщика.
+ * По масштабу и сдвигу сцены выбирается уровень, чьё разрешение не меньше
+ * экранного, и загружаются только тайлы видимой области.
+ */
+const TileLayer = ({ tiles, stageWidth, stageHeight, scale, position }) => {
+  const background = useMemo(() => {
+    let level = tiles.max_level;
+    while (level > 0) {
+      const span = tiles.tile_size * 2 ** (tiles.max_level - level);
+      if (Math.ceil(tiles.width / span) * Math.ceil(tiles.height / span) <= BACKGROUND_MAX_TILES) {
+        break;
+      }
+      level -= 1;
+    }
+    return levelTiles(tiles, level, { x1: 0, y1: 0, x2: tiles.width, y2: tiles.height });
+  }, [tiles]);
+
+  const detail = useMemo(() => {
+    if (!stageWidth || !stageHeight) {
+      return [];
+    }
+
+    // Сцена трансформируется как scale(s) translate(p) относительно центра:
+    // видимая часть сцены — обратное преобразование рамки контейнера
+    const toImage = tiles.width / stageWidth;
+    const visible = (size, offset) => [
+      Math.max(0, (-size / 2) / scale - offset + size / 2),
+      Math.min(size, (size / 2) / scale - offset + size / 2),
+    ];
+    const [sx1, sx2] = visible(stageWidth, position.x);
+    const [sy1, sy2] = visible(stageHeight, position.y);
+    if (sx2 <= sx1 || sy2 <= sy1) {
+      return [];
+    }
+
+    const screenWidth = stageWidth * scale * (window.devicePixelRatio || 1);
+    const level = Math.max(0, Math.min(
+      tiles.max_level,
+      tiles.max_level - Math.floor(Math.log2(tiles.width / screenWidth)),
+    ));
+
+    return levelTiles(tiles, level, {
+      x1: sx1 * toImage,
+      y1: sy1 * toImage,
+      x2: sx2 * toImage,
+      y2: sy2 * toImage,
+    });
+  }, [tiles, stageWidth, stageHeight, scale, position]);
+
+  // Если детальный уровень совпал с фоновым, тайлы не дублируем
+  const backgroundKeys = new Set(background.map(({ key }) => key));
+  const visibleTiles = [...background, ...detail.filter(({ key }) => !backgroundKeys.has(key))];
+
+  return (
+    <div className="image-viewer__tiles">
+      {visibleTiles.map(({ key, src, style }) => (
+        <img key={key} src={src} alt="" className="image-viewer__tile" style={style} draggable={false} />
+      ))}
+    </div>
+  );
+};
+
+export default TileLayer;
@@ -1,16 +1,38 @@
 import React from 'react'
 import styled from 'styled-components'
 
-const Loader = () => (
+// percent — процент текущего шага (0..100); без него показывается только спиннер
+const Loader = ({ percent = null }) => (
   <StyledWrapper aria-live="polite" aria-busy="true">
     <span className="loader" />
+    {percent !== null && (
+      <div className="loader__bar" role="progressbar" aria-valuenow={Math.round(percent)} aria-valuemin={0} aria-valuemax={100}>
+        <div className="loader__bar-fill" style={{ width: `${Math.min(100, Math.max(0, percent))}%` }} />
+      </div>
+    )}
   </StyledWrapper>
 )
 
 const StyledWrapper = styled.div`
   display: flex;
+  flex-direction: column;
   align-items: center;
   justify-content: center;
+  gap: 16px;
+
+  .loader__bar {
+    width: 200px;
+    height: 4px;
+    border-radius: 2px;
+    background: rgba(0, 0, 0, 0.15);
+    overflow: hidden;
+  }
+
+  .loader__bar-fill {
+    height: 100%;
+    background: #ff3d00;
+    transition: width 0.3s ease;
+  }
 
   .loader {
     width: 48px;
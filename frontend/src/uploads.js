@@ -0,0 +1,79 @@
+const API_BASE_URL = import.meta.env.VITE_API_BASE_URL ?? 'http://localhost:8000'
+
+// Сколько раз повторяем часть при обрыве связи и пауза между попытками
+const PART_RETRIES = 5
+const RETRY_DELAY_MS = 2000
+
+const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms))
+
+async function requestJson(url, options) {
+  const response = await fetch(url, options)
+  const payload = await response.json().catch(() => null)
+  if (!response.ok) {
+    const error = new Error(payload?.detail ?? 'Ошибка загрузки')
+    error.status = response.status
+    throw error
+  }
+  return payload
+}
+
+async function putPart(upload, file, number) {
+  const start = number * upload.part_size
+  const body = file.slice(start, Math.min(start + upload.part_size, file.size))
+
+  for (let attempt = 1; ; attempt += 1) {
+    try {
+      return await requestJson(`${API_BASE_URL}/uploads/${upload.upload_id}/parts/${number}`, {
+        method: 'PUT',
+        body,
+      })
+    } catch (error) {
+      // Ошибки клиента (4xx) повтором не исправить
+      if (attempt >= PART_RETRIES || (error.status >= 400 && error.status < 500)) {
+        throw error
+      }
+      await sleep(RETRY_DELAY_MS * attempt)
+    }
+  }
+}
+
+// Загружает один файл частями; после обрыва докачивает только недостающие части
+async function uploadFile(sessionId, file, onProgress) {
+  let upload = await requestJson(
+    `${API_BASE_URL}/uploads?${new URLSearchParams({
+      session_id: sessionId,
+      filename: file.name,
+      size: file.size,
+    })}`,
+    { method: 'POST' },
+  )
+
+  while (!upload.complete) {
+    for (const number of upload.missing_parts) {
+      upload = await putPart(upload, file, number)
+      onProgress?.(upload.received)
+    }
+    // Сверяемся с сервером: части могли дойти не полностью
+    upload = await requestJson(`${API_BASE_URL}/uploads/${upload.upload_id}`)
+  }
+
+  return requestJson(`${API_BASE_URL}/uploads/${upload.upload_id}/finalize`, { method: 'POST' })
+}
+
+/**
+ * Докачиваемая загрузка набора фотографий в data/ новой сессии.
+ * onProgress получает долю переданных байт (0..1). Возвращает ID сессии.
+ */
+export async function uploadFilesResumable(files, onProgress) {
+  const { session_id: sessionId } = await requestJson(`${API_BASE_URL}/session/new`)
+  const list = Array.from(files)
+  const total = list.reduce((sum, file) => sum + file.size, 0) || 1
+  let done = 0
+
+  for (const file of list) {
+    await uploadFile(sessionId, file, (received) => onProgress?.((done + received) / total))
+    done += file.size
+  }
+
+  return sessionId
+}